@@ -59,9 +59,13 @@ def plots_closest_to_point(request, instance, lat, lng):
                         .filter(instance=instance)\
                         .filter(geom__distance_lte=(point, D(m=distance)))\
                         .order_by('distance')[0:max_plots]
+    plots = list(plots)
+
+    benefits = Plot.benefits.benefits_for_objects(instance, plots)
 
     def ctxt_for_plot(plot):
-        return context_dict_for_plot(request, plot)
+        return context_dict_for_plot(request, plot,
+                                     eco_benefits=benefits[plot.pk])
 
     return [ctxt_for_plot(plot) for plot in plots]
 
@@ -186,11 +186,14 @@ def get_plot_list(request, instance):
     end = size + start
 
     # order_by prevents testing weirdness
-    plots = Plot.objects.filter(instance=instance)\
-                        .order_by('id')[start:end]
+    plots = list(Plot.objects.filter(instance=instance)
+                             .order_by('id')[start:end])
+
+    benefits = Plot.benefits.benefits_for_objects(instance, plots)
 
     def ctxt_for_plot(plot):
-        return context_dict_for_plot(request, plot)
+        return context_dict_for_plot(request, plot,
+                                     eco_benefits=benefits[plot.pk])
 
     return [ctxt_for_plot(plot) for plot in plots]
 
@@ -2,6 +2,17 @@ from __future__ import unicode_literals
 from __future__ import print_function
 from __future__ import division
 
+import datetime
+import hashlib
+import json
+
+from django.db.models import Count, Max
+
+from treemap.models import Species
+from treemap.util import safe_get_model_class
+
+from exporter.models import ExportJob
+
 
 def export_enabled_for(instance, user):
     if instance.feature_enabled('exports'):
@@ -18,3 +29,90 @@ def export_enabled_for(instance, user):
     else:
         # No one can export if the feature is not enabled
         return False
+
+
+def export_fingerprint(instance, user, model, query, display_filters,
+                       data_format):
+    """
+    Hash everything that the contents of an export depend on
+    """
+    if model == 'species':
+        model_names = ['Species']
+    else:
+        model_names = ['Plot', 'Tree', 'Species']
+
+    visible_fields = {}
+    for model_name in model_names:
+        dummy_instance = safe_get_model_class(model_name)()
+        dummy_instance.instance = instance
+        visible_fields[model_name] = sorted(
+            dummy_instance.visible_fields(user))
+
+    # Editing species does not change the universal_rev
+    species = Species.objects \
+        .filter(instance=instance) \
+        .aggregate(count=Count('pk'), updated_at=Max('updated_at'))
+
+    inputs = {
+        'model': model,
+        'data_format': data_format,
+        'query': _normalize_json(query),
+        'display_filters': _normalize_json(display_filters),
+        'visible_fields': visible_fields,
+        'universal_rev': instance.universal_rev,
+        'species': [species['count'], str(species['updated_at'])],
+        # Includes the instance's units and decimal digits
+        'value_display': instance.config.get('value_display', {}),
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+def _normalize_json(value):
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def get_reusable_export(instance, fingerprint):
+    """
+    Return the most recent completed export with the given fingerprint
+    whose file still exists
+    """
+    job = ExportJob.objects \
+        .filter(instance=instance, fingerprint=fingerprint,
+                status=ExportJob.COMPLETE) \
+        .exclude(outfile='') \
+        .order_by('-created') \
+        .first()
+    if job is not None and job.outfile.storage.exists(job.outfile.name):
+        return job
+    return None
+
+
+def delete_old_exports(max_age_days):
+    """
+    Delete export jobs created more than `max_age_days` ago, and the files
+    of those jobs that are not shared by a newer job that reused them.
+
+    Returns the number of jobs and files deleted.
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=max_age_days)
+    old_jobs = ExportJob.objects.filter(created__lt=cutoff)
+    filenames = set(old_jobs
+                    .exclude(outfile='')
+                    .values_list('outfile', flat=True))
+
+    n_jobs = old_jobs.count()
+    old_jobs.delete()
+
+    in_use = set(ExportJob.objects
+                 .filter(outfile__in=filenames)
+                 .values_list('outfile', flat=True))
+    storage = ExportJob._meta.get_field('outfile').storage
+    for filename in filenames - in_use:
+        storage.delete(filename)
+
+    return n_jobs, len(filenames - in_use)
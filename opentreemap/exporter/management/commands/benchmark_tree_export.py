@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import csv
+import resource
+import time
+from tempfile import TemporaryFile
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+
+from treemap.instance import Instance
+from treemap.models import Plot, User
+from treemap.search import Filter
+
+from exporter.sql import write_plot_csv
+from exporter.tasks import _plot_export_fields, _write_plot_csv_with_orm
+
+
+class Command(BaseCommand):
+    help = ('Times exporting the trees of an instance to CSV with COPY '
+            'and through the ORM')
+
+    def add_arguments(self, parser):
+        parser.add_argument('instance_url_name')
+        parser.add_argument(
+            '-u', '--user',
+            action='store',
+            dest='username',
+            default=None,
+            help='Export the fields visible to this user '
+                 '(defaults to an anonymous export)')
+        parser.add_argument(
+            '-q', '--query',
+            action='store',
+            dest='query',
+            default='',
+            help='Search query limiting the exported plots')
+
+    def handle(self, *args, **options):
+        url_name = options['instance_url_name']
+        try:
+            instance = Instance.objects.get(url_name=url_name)
+        except ObjectDoesNotExist:
+            raise CommandError('Instance "%s" not found' % url_name)
+
+        user = None
+        if options['username']:
+            try:
+                user = User.objects.get(username=options['username'])
+            except ObjectDoesNotExist:
+                raise CommandError('User "%s" not found'
+                                   % options['username'])
+
+        plot_qs = Filter(options['query'], '', instance).get_objects(Plot)
+        field_header_map, select, select_params = \
+            _plot_export_fields(instance, user)
+
+        self.stdout.write('%s columns, %s plots'
+                          % (len(field_header_map), plot_qs.count()))
+
+        # COPY goes first so that the growth in peak memory use measured
+        # for the ORM export is not hidden by it
+        self._time('COPY', lambda f: write_plot_csv(
+            instance, plot_qs, field_header_map, f))
+        self._time('ORM', lambda f: _write_plot_csv_with_orm(
+            instance, plot_qs, field_header_map, select, select_params, f))
+
+    def _time(self, label, write_fn):
+        csv_file = TemporaryFile()
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        write_fn(csv_file)
+        elapsed = time.time() - start
+        rss_growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss -
+                      max_rss)
+
+        size = csv_file.tell()
+        csv_file.seek(0)
+        n_rows = sum(1 for __ in csv.reader(csv_file)) - 1
+        csv_file.close()
+
+        self.stdout.write('%s: %s rows (%s bytes) in %.2f seconds, '
+                          'peak memory grew by %s KB'
+                          % (label, n_rows, size, elapsed, rss_growth))
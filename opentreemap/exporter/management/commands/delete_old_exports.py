@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from exporter.lib import delete_old_exports
+
+
+class Command(BaseCommand):
+    help = 'Deletes old export jobs and the files they produced'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-d', '--days',
+            action='store',
+            type=int,
+            dest='days',
+            default=settings.EXPORT_JOB_MAX_AGE_DAYS,
+            help='Delete jobs created more than this many days ago')
+
+    def handle(self, *args, **options):
+        n_jobs, n_files = delete_old_exports(options['days'])
+        self.stdout.write('Deleted %s export jobs and %s files'
+                          % (n_jobs, n_files))
@@ -43,6 +43,9 @@ class ExportJob(models.Model):
     created = models.DateTimeField(null=True, blank=True)
     modified = models.DateTimeField(null=True, blank=True)
     description = models.CharField(max_length=255)
+    # Identifies the inputs of a csv export, so that its file can be
+    # reused by later requests for the same export
+    fingerprint = models.CharField(max_length=64, db_index=True, blank=True)
 
     def save(self, *args, **kwargs):
         now = datetime.datetime.now()
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import codecs
+import csv
+
+from django.conf import settings
+from django.db import connection
+
+from treemap.lib.object_caches import udf_defs
+from treemap.udf import UserDefinedCollectionValue
+from treemap.units import (storage_to_instance_units_factor,
+                           get_value_display_attr)
+
+from exporter.util import sanitize_unicode_value
+
+# Compiles the fields of a tree export into a single statement and streams
+# its result into the export file with COPY, so that rows never pass
+# through the ORM or a Python serializer. Values are formatted the way
+# djqscsv formats what the ORM returns for the same fields.
+#
+# GeoJSON exports select the same values as the properties of features
+# built by PostGIS.
+
+_PLOT_EXPORT_SQL = """
+SELECT {select}
+FROM treemap_mapfeature mf
+JOIN treemap_plot p ON p.mapfeature_ptr_id = mf.id
+CROSS JOIN LATERAL (
+    SELECT ST_Transform(mf.the_geom_webmercator, 4326) AS ll
+) g
+LEFT JOIN treemap_tree t ON t.plot_id = mf.id
+LEFT JOIN treemap_species s ON s.id = t.species_id
+LEFT JOIN treemap_user u ON u.id = mf.updated_by_id
+{joins}
+WHERE mf.id IN ({plot_ids})
+ORDER BY mf.id
+"""
+
+# The properties of a feature are the same text values written to CSV
+# exports, keyed by their column headers
+_FEATURE_SELECT = """json_build_object(
+    'type', 'Feature',
+    'id', mf.id,
+    'geometry', ST_AsGeoJSON(g.ll)::json,
+    'properties', json_object(%s::text[], ARRAY[{values}]::text[])
+)::text"""
+
+# The point coordinates are in the geometry of a feature
+_NON_FEATURE_PROPERTIES = {'geom__x', 'geom__y'}
+
+# Pre-aggregate each collection UDF once, instead of running a correlated
+# subquery for every exported row
+_COLLECTION_UDF_JOIN = """
+LEFT JOIN (
+    SELECT model_id,
+           string_agg(concat('(', data, ')'), ', ') AS value
+    FROM {table}
+    WHERE field_definition_id = {field_definition_id}
+    GROUP BY model_id
+) {alias} ON {alias}.model_id = {model_id}
+"""
+
+_PLOT_ID_RANGES_SQL = """
+SELECT min(plot_id), max(plot_id)
+FROM (
+    SELECT plot_id, ntile(%s) OVER (ORDER BY plot_id) AS part
+    FROM ({plot_ids}) plot_ids (plot_id)
+) parts
+GROUP BY part
+ORDER BY 1
+"""
+
+_SIMPLE_COLUMNS = {
+    'address_street': 'mf.address_street',
+    'address_city': 'mf.address_city',
+    'address_zip': 'mf.address_zip',
+    'id': 'mf.id::text',
+    'owner_orig_id': 'p.owner_orig_id',
+    'updated_by__username': 'u.username',
+    'tree__id': 't.id::text',
+    'tree_present': "CASE WHEN t.id IS NULL THEN 'False' ELSE 'True' END",
+    'tree__species__genus': 's.genus',
+    'tree__species__species': 's.species',
+    'tree__species__cultivar': 's.cultivar',
+    'tree__species__other_part_of_name': 's.other_part_of_name',
+    'tree__species__common_name': 's.common_name',
+    'tree__date_planted': "to_char(t.date_planted, 'YYYY-MM-DD')",
+    'tree__date_removed': "to_char(t.date_removed, 'YYYY-MM-DD')",
+}
+
+# Fields which are exported in the instance's display units
+_CONVERTIBLE_COLUMNS = {
+    'width': ('p.width', 'plot', 'width'),
+    'length': ('p.length', 'plot', 'length'),
+    'tree__diameter': ('t.diameter', 'tree', 'diameter'),
+    'tree__height': ('t.height', 'tree', 'height'),
+    'tree__canopy_height': ('t.canopy_height', 'tree', 'canopy_height'),
+}
+
+_UDF_TABLE_ALIASES = {'udf:': ('Plot', 'mf'),
+                      'tree__udf:': ('Tree', 't')}
+
+
+def _trim_zeros(numeric_text):
+    # Drop trailing zeros but keep one decimal place, like `str(float)`
+    return ("regexp_replace(%s, '(\\.[0-9]*?[0-9])0+$', '\\1')"
+            % numeric_text)
+
+
+def _rounded(column, factor, digits):
+    value = '(%s * %r)::numeric' % (column, factor)
+    if digits > 0:
+        return _trim_zeros('round(%s, %d)::text' % (value, digits))
+    else:
+        return "round(%s)::text || '.0'" % value
+
+
+def _float_text(column):
+    # Python 2 formats floats with 12 significant digits
+    value = '%s::numeric' % column
+    return ("CASE WHEN {v} = 0 THEN '0.0' ELSE {trimmed} END".format(
+        v=value,
+        trimmed=_trim_zeros(
+            'round({v}, greatest(1, 11 - floor(log(abs({v})))::int))::text'
+            .format(v=value))))
+
+
+def _timestamp_text(column):
+    # Matches `datetime.isoformat()` for the UTC datetimes Django returns
+    utc = "%s AT TIME ZONE 'UTC'" % column
+    return ("to_char({utc}, 'YYYY-MM-DD\"T\"HH24:MI:SS') || "
+            "CASE WHEN to_char({utc}, 'US') = '000000' THEN '' "
+            "ELSE to_char({utc}, '.US') END || '+00:00'").format(utc=utc)
+
+
+def _plot_export_columns(instance, field_names):
+    """
+    Compile the tree export columns named by `field_names` into SQL text
+    expressions, along with the joins and parameters they need
+    """
+    columns = []
+    joins = []
+    params = []
+
+    for name in field_names:
+        if name in _SIMPLE_COLUMNS:
+            column = _SIMPLE_COLUMNS[name]
+        elif name in _CONVERTIBLE_COLUMNS:
+            column, model_name, field = _CONVERTIBLE_COLUMNS[name]
+            factor = storage_to_instance_units_factor(instance, model_name,
+                                                      field)
+            _, digits = get_value_display_attr(instance, model_name, field,
+                                               'digits')
+            column = _rounded(column, factor, int(digits))
+        elif name == 'geom__x':
+            column = _float_text('ST_X(g.ll)')
+        elif name == 'geom__y':
+            column = _float_text('ST_Y(g.ll)')
+        elif name == 'updated_at':
+            column = _timestamp_text('mf.updated_at')
+        else:
+            prefix, __, udf_name = name.partition('udf:')
+            prefix += 'udf:'
+            if prefix not in _UDF_TABLE_ALIASES or not udf_name:
+                raise ValueError('Unrecognized export field name %s' % name)
+            model, table_alias = _UDF_TABLE_ALIASES[prefix]
+            udfd = next((udfd for udfd in udf_defs(instance, model)
+                         if udfd.iscollection and udfd.name == udf_name),
+                        None)
+            if udfd is None:
+                column = '%s.udfs -> %%s' % table_alias
+                params.append(udf_name)
+            else:
+                alias = 'cudf%d' % len(joins)
+                joins.append(_COLLECTION_UDF_JOIN.format(
+                    table=UserDefinedCollectionValue._meta.db_table,
+                    field_definition_id=int(udfd.pk),
+                    alias=alias,
+                    model_id='%s.id' % table_alias))
+                column = '%s.value' % alias
+
+        # COPY quotes empty strings to tell them apart from NULL, but the
+        # ORM export writes both as an empty field
+        columns.append("nullif(%s, '')" % column)
+
+    return columns, joins, params
+
+
+def _plot_export_sql(plot_qs, select, joins, params):
+    plot_ids_sql, plot_ids_params = (plot_qs.order_by()
+                                     .values('pk').query.sql_with_params())
+    sql = _PLOT_EXPORT_SQL.format(select=select,
+                                  joins=''.join(joins),
+                                  plot_ids=plot_ids_sql)
+    return sql, list(params) + list(plot_ids_params)
+
+
+def _plot_csv_sql(instance, plot_qs, field_names):
+    """
+    Compile the tree export columns named by `field_names`, for the plots
+    in `plot_qs`, into a single SQL statement and its parameters
+    """
+    columns, joins, params = _plot_export_columns(instance, field_names)
+    return _plot_export_sql(plot_qs, ',\n       '.join(columns), joins,
+                            params)
+
+
+def _plot_feature_sql(instance, plot_qs, field_header_map):
+    """
+    Compile a statement selecting a GeoJSON feature for each plot in
+    `plot_qs`, with a property for each field in `field_header_map`
+    """
+    field_names = [name for name in field_header_map.keys()
+                   if name not in _NON_FEATURE_PROPERTIES]
+    headers = [field_header_map[name] for name in field_names]
+
+    columns, joins, params = _plot_export_columns(instance, field_names)
+    select = _FEATURE_SELECT.format(values=', '.join(columns))
+    # The headers are the first parameter in the select clause
+    return _plot_export_sql(plot_qs, select, joins, [headers] + params)
+
+
+def write_plot_csv(instance, plot_qs, field_header_map, csv_file):
+    """
+    Write a CSV of the plots in `plot_qs` to `csv_file`, with a column for
+    each field in `field_header_map` under its header
+    """
+    write_csv_header(field_header_map.values(), csv_file)
+    copy_plot_csv_rows(instance, plot_qs, field_header_map.keys(), csv_file)
+
+
+def write_csv_header(headers, csv_file):
+    csv_file.write(codecs.BOM_UTF8)
+    writer = csv.writer(csv_file, lineterminator=b'\n')
+    writer.writerow([sanitize_unicode_value(header) for header in headers])
+
+
+def copy_plot_csv_rows(instance, plot_qs, field_names, csv_file):
+    sql, params = _plot_csv_sql(instance, plot_qs, field_names)
+
+    with connection.cursor() as cursor:
+        query = unicode(cursor.mogrify(sql, params), 'utf-8')
+        cursor.copy_expert('COPY (%s) TO STDOUT WITH CSV' % query, csv_file)
+
+
+def plot_id_ranges(plot_qs, n_ranges):
+    """
+    Split the plots in `plot_qs` into at most `n_ranges` contiguous ranges
+    of ids holding roughly the same number of plots each, returned as a
+    list of (min id, max id) pairs
+    """
+    plot_ids_sql, plot_ids_params = (plot_qs.order_by()
+                                     .values('pk').query.sql_with_params())
+    sql = _PLOT_ID_RANGES_SQL.format(plot_ids=plot_ids_sql)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [n_ranges] + list(plot_ids_params))
+        return [tuple(row) for row in cursor.fetchall()]
+
+
+def write_plot_features(instance, plot_qs, field_header_map, out_file,
+                        data_format):
+    """
+    Write the plots in `plot_qs` to `out_file` as a GeoJSON feature
+    collection, or with one feature per line if `data_format` is 'ndjson'.
+    Features are fetched in batches from a server-side cursor, so the
+    export needs the same memory however many plots it has.
+    """
+    sql, params = _plot_feature_sql(instance, plot_qs, field_header_map)
+
+    if data_format == 'geojson':
+        out_file.write(b'{"type": "FeatureCollection", "features": [\n')
+        separator, terminator = b',\n', b'\n]}\n'
+    else:
+        separator, terminator = b'\n', b'\n'
+
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        is_first = True
+        while True:
+            rows = cursor.fetchmany(settings.EXPORT_FEATURES_FETCH_SIZE)
+            if not rows:
+                break
+            for (feature,) in rows:
+                if not is_first:
+                    out_file.write(separator)
+                out_file.write(sanitize_unicode_value(feature))
+                is_first = False
+
+    if data_format == 'geojson' or not is_first:
+        out_file.write(terminator)
@@ -5,13 +5,16 @@ from __future__ import division
 
 import csv
 import logging
+import math
+import shutil
 
 from contextlib import contextmanager
 from functools import wraps
 from collections import OrderedDict
-from celery import shared_task
+from celery import shared_task, chord
 from tempfile import TemporaryFile
 
+from django.conf import settings
 from django.core.files import File
 
 from treemap.search import Filter
@@ -29,6 +32,9 @@ from djqscsv import write_csv, generate_filename
 from opentreemap.util import add_rollbar_handler
 
 from exporter.models import ExportJob
+from exporter.sql import (write_plot_csv, write_csv_header,
+                          copy_plot_csv_rows, plot_id_ranges,
+                          write_plot_features)
 from exporter.user import write_users
 from exporter.util import sanitize_unicode_record
 
@@ -59,7 +65,7 @@ def _job_transaction(fn):
 
 
 def _values_for_model(
-        instance, job, table, model,
+        instance, user, table, model,
         select, select_params, prefix=None):
     if prefix:
         prefix += '__'
@@ -73,7 +79,7 @@ def _values_for_model(
     if hasattr(model_class, 'instance'):
         dummy_instance.instance = instance
 
-    for field_name in dummy_instance.visible_fields(job.user):
+    for field_name in dummy_instance.visible_fields(user):
         prefixed_name = prefix + field_name
 
         if field_name.startswith('udf:'):
@@ -134,93 +140,231 @@ def async_users_export(job, data_format):
 
 @shared_task
 @_job_transaction
-def async_csv_export(job, model, query, display_filters):
+def async_csv_export(job, model, query, display_filters, data_format='csv'):
     instance = job.instance
 
-    select = OrderedDict()
-    select_params = []
-    field_header_map = {}
-    field_serializer_map = {}
     if model == 'species':
+        select = OrderedDict()
+        select_params = []
         initial_qs = (Species.objects.
                       filter(instance=instance))
-        values = _values_for_model(instance, job, 'treemap_species',
+        values = _values_for_model(instance, job.user, 'treemap_species',
                                    'Species', select, select_params)
         field_names = values + select.keys()
         limited_qs = (initial_qs
                       .extra(select=select,
                              select_params=select_params)
                       .values(*field_names))
+        has_fields = limited_qs.exists()
     else:
         # model == 'tree'
 
-        # TODO: if an anonymous job with the given query has been
-        # done since the last update to the audit records table,
-        # just return that job
-
         # get the plots for the provided
         # query and turn them into a tree queryset
         initial_qs = Filter(query, display_filters, instance)\
             .get_objects(Plot)
-
-        tree_fields = _values_for_model(
-            instance, job, 'treemap_tree', 'Tree',
-            select, select_params,
-            prefix='tree')
-        plot_fields = _values_for_model(
-            instance, job, 'treemap_mapfeature', 'Plot',
-            select, select_params)
-        species_fields = _values_for_model(
-            instance, job, 'treemap_species', 'Species',
-            select, select_params,
-            prefix='tree__species')
-
-        if 'geom' in plot_fields:
-            plot_fields = [f for f in plot_fields if f != 'geom']
-            plot_fields += ['geom__x', 'geom__y']
-
-        if tree_fields:
-            select['tree_present'] = "treemap_tree.id is not null"
-            plot_fields += ['tree_present']
-
-        get_ll = 'ST_Transform(treemap_mapfeature.the_geom_webmercator, 4326)'
-        select['geom__x'] = 'ST_X(%s)' % get_ll
-        select['geom__y'] = 'ST_Y(%s)' % get_ll
-
-        plot_fields += ['updated_by__username']
-
-        field_names = set(tree_fields + plot_fields + species_fields)
-
-        if field_names:
-            field_header_map = _csv_field_header_map(field_names)
-            field_serializer_map = _csv_field_serializer_map(instance,
-                                                             field_names)
-            limited_qs = (initial_qs
-                          .extra(select=select,
-                                 select_params=select_params)
-                          .values(*field_header_map.keys()))
-        else:
-            limited_qs = initial_qs.none()
+        field_header_map, select, select_params = \
+            _plot_export_fields(instance, job.user)
+        has_fields = bool(field_header_map)
 
     if not initial_qs.exists():
         job.status = ExportJob.EMPTY_QUERYSET_ERROR
 
-    # if the initial queryset was not empty but the limited queryset
-    # is empty, it means that there were no fields which the user
+    # if the initial queryset was not empty but there were no fields
+    # to select, it means that there were no fields which the user
     # was allowed to export.
-    elif not limited_qs.exists():
+    elif not has_fields:
         job.status = ExportJob.MODEL_PERMISSION_ERROR
+    elif model == 'species':
+        csv_file = TemporaryFile()
+        write_csv(limited_qs, csv_file)
+        job.complete_with(generate_filename(limited_qs), File(csv_file))
+    elif data_format != 'csv':
+        # GeoJSON or newline-delimited GeoJSON
+        out_file = TemporaryFile()
+        write_plot_features(instance, initial_qs, field_header_map,
+                            out_file, data_format)
+        filename = 'tree_export.%s' % data_format
+        job.complete_with(filename, File(out_file))
     else:
+        filename = generate_filename(initial_qs).replace('plot', 'tree')
+        id_ranges = _plot_export_shards(initial_qs)
+
+        if len(id_ranges) > 1:
+            # The job is completed by the chord's callback, which may
+            # already have run and saved it, so it must not be saved here
+            _start_sharded_plot_csv_export(job, query, display_filters,
+                                           field_header_map, filename,
+                                           id_ranges)
+            return
+        else:
+            csv_file = TemporaryFile()
+            if settings.EXPORT_TREE_CSV_WITH_COPY:
+                write_plot_csv(instance, initial_qs, field_header_map,
+                               csv_file)
+            else:
+                _write_plot_csv_with_orm(instance, initial_qs,
+                                         field_header_map, select,
+                                         select_params, csv_file)
+            job.complete_with(filename, File(csv_file))
+
+    job.save()
+
+
+def _plot_export_shards(plot_qs):
+    """
+    Returns the plot id ranges to export in parallel, or an empty list if
+    the export is small enough for a single task
+    """
+    if not settings.EXPORT_TREE_CSV_WITH_COPY:
+        return []
+    n_shards = int(math.ceil(plot_qs.count() /
+                             settings.EXPORT_PLOTS_PER_SHARD))
+    if n_shards < 2:
+        return []
+    return plot_id_ranges(plot_qs, n_shards)
+
+
+def _start_sharded_plot_csv_export(job, query, display_filters,
+                                   field_header_map, filename, id_ranges):
+    field_names = field_header_map.keys()
+    shard_tasks = [
+        _export_plot_csv_shard.si(job.pk, query, display_filters,
+                                  field_names, min_id, max_id)
+        for min_id, max_id in id_ranges]
+
+    finish_task = _finish_sharded_plot_csv_export.s(
+        job.pk, filename, field_header_map.values())
+    finish_task.on_error(_fail_sharded_csv_export.si(job.pk))
+
+    chord(shard_tasks, finish_task).delay()
+
+
+def _shard_storage():
+    return ExportJob._meta.get_field('outfile').storage
+
+
+def _shard_dir(job_pk):
+    return 'exports/shards/%s' % job_pk
+
+
+@shared_task
+def _export_plot_csv_shard(job_pk, query, display_filters, field_names,
+                           min_id, max_id):
+    """
+    Write the rows of the plots with ids from `min_id` to `max_id` to a
+    file in the export storage, shared by all workers, and return its name
+    """
+    job = ExportJob.objects.get(pk=job_pk)
+    plot_qs = Filter(query, display_filters, job.instance) \
+        .get_objects(Plot) \
+        .filter(pk__gte=min_id, pk__lte=max_id)
+
+    part_file = TemporaryFile()
+    copy_plot_csv_rows(job.instance, plot_qs, field_names, part_file)
+    name = '%s/%s.csv' % (_shard_dir(job_pk), min_id)
+    return _shard_storage().save(name, File(part_file))
+
+
+@shared_task
+def _finish_sharded_plot_csv_export(part_names, job_pk, filename, headers):
+    storage = _shard_storage()
+
+    with _job_transaction_manager(job_pk) as job:
         csv_file = TemporaryFile()
-        write_csv(limited_qs, csv_file,
-                  field_order=field_header_map.keys(),
-                  field_header_map=field_header_map,
-                  field_serializer_map=field_serializer_map)
-        filename = generate_filename(limited_qs).replace('plot', 'tree')
+        write_csv_header(headers, csv_file)
+        # Chord results are in the order of the shards, which is plot id
+        for name in part_names:
+            part_file = storage.open(name)
+            try:
+                shutil.copyfileobj(part_file, csv_file)
+            finally:
+                part_file.close()
+
         job.complete_with(filename, File(csv_file))
+        job.save()
+
+    _delete_shards(job_pk)
 
+
+@shared_task
+def _fail_sharded_csv_export(job_pk):
+    job = ExportJob.objects.get(pk=job_pk)
+    job.fail()
     job.save()
 
+    _delete_shards(job_pk)
+
+
+def _delete_shards(job_pk):
+    storage = _shard_storage()
+    shard_dir = _shard_dir(job_pk)
+    try:
+        __, names = storage.listdir(shard_dir)
+    except OSError:
+        return
+    for name in names:
+        storage.delete('%s/%s' % (shard_dir, name))
+
+
+def _plot_export_fields(instance, user):
+    """
+    Returns an ordered map of the plot, tree and species fields that `user`
+    may export to their column headers, along with the extra select
+    clauses and parameters the ORM export needs to query them.
+    """
+    select = OrderedDict()
+    select_params = []
+
+    tree_fields = _values_for_model(
+        instance, user, 'treemap_tree', 'Tree',
+        select, select_params,
+        prefix='tree')
+    plot_fields = _values_for_model(
+        instance, user, 'treemap_mapfeature', 'Plot',
+        select, select_params)
+    species_fields = _values_for_model(
+        instance, user, 'treemap_species', 'Species',
+        select, select_params,
+        prefix='tree__species')
+
+    if 'geom' in plot_fields:
+        plot_fields = [f for f in plot_fields if f != 'geom']
+        plot_fields += ['geom__x', 'geom__y']
+
+    if tree_fields:
+        select['tree_present'] = "treemap_tree.id is not null"
+        plot_fields += ['tree_present']
+
+    get_ll = 'ST_Transform(treemap_mapfeature.the_geom_webmercator, 4326)'
+    select['geom__x'] = 'ST_X(%s)' % get_ll
+    select['geom__y'] = 'ST_Y(%s)' % get_ll
+
+    plot_fields += ['updated_by__username']
+
+    field_names = set(tree_fields + plot_fields + species_fields)
+
+    if field_names:
+        field_header_map = _csv_field_header_map(field_names)
+    else:
+        field_header_map = OrderedDict()
+
+    return field_header_map, select, select_params
+
+
+def _write_plot_csv_with_orm(instance, plot_qs, field_header_map,
+                             select, select_params, csv_file):
+    field_serializer_map = _csv_field_serializer_map(instance,
+                                                     field_header_map.keys())
+    limited_qs = (plot_qs
+                  .extra(select=select,
+                         select_params=select_params)
+                  .values(*field_header_map.keys()))
+    write_csv(limited_qs, csv_file,
+              field_order=field_header_map.keys(),
+              field_header_map=field_header_map,
+              field_serializer_map=field_serializer_map)
+
 
 def _csv_field_header_map(field_names):
     map = OrderedDict()
@@ -229,6 +373,7 @@ def _csv_field_header_map(field_names):
     omit = {'feature_type',
             'hide_at_zoom',
             'instance',
+            'itree_region_code',
             'mapfeature_ptr',
             'readonly',
             'udfs',
@@ -5,6 +5,7 @@ from __future__ import division
 
 import csv
 import json
+from StringIO import StringIO
 
 from treemap.udf import UserDefinedFieldDefinition
 from treemap.lib.dates import DATETIME_FORMAT
@@ -13,14 +14,17 @@ from treemap.tests import (make_instance, make_commander_user, make_request,
                            set_write_permissions, make_commander_role,
                            make_admin_user)
 from treemap.tests.base import OTMTestCase
+from treemap.tests.test_udfs import make_collection_udf
 from treemap.models import Species, Plot, Tree, User, InstanceUser
 from treemap.audit import Audit, add_default_permissions
 
 from exporter.models import ExportJob
 from exporter import tasks
-from exporter.lib import export_enabled_for
+from exporter.lib import export_enabled_for, delete_old_exports
+from exporter.user import iter_users
 from exporter.views import begin_export, check_export, users_json, users_csv
 
+from django.core.files.storage import default_storage
 from django.test.utils import override_settings
 from django.utils.timezone import now
 from django.core.exceptions import ValidationError
@@ -143,6 +147,122 @@ class ExportTreeTaskTest(AsyncCSVTestCase):
         self.assertPsuedoAsyncTaskWorks('tree', self.user, 'Diameter', '2.0',
                                         '.*tree_export(_\d+)?\.csv')
 
+    @media_dir
+    def test_sharded_export_matches_single_export(self):
+        for address in ['1 Elm St', '2 Elm St']:
+            Plot(geom=self.instance.center, instance=self.instance,
+                 address_street=address).save_with_user(self.user)
+
+        single_rows = self._export_rows()
+        with override_settings(EXPORT_PLOTS_PER_SHARD=2):
+            sharded_rows = self._export_rows()
+
+        self.assertEqual(4, len(sharded_rows))
+        self.assertEqual(single_rows, sharded_rows)
+        job = ExportJob.objects.latest('pk')
+        __, shards = default_storage.listdir('exports/shards/%s' % job.pk)
+        self.assertEqual([], shards)
+
+    def _export_features(self, data_format):
+        job = ExportJob(instance=self.instance, user=self.user)
+        job.save()
+        tasks.async_csv_export(job.pk, 'tree', '', '', data_format)
+        job = ExportJob.objects.get(pk=job.pk)
+        self.assertTrue(job.outfile.name.endswith('.' + data_format))
+        return job.outfile.read()
+
+    @media_dir
+    def test_geojson_export(self):
+        collection = json.loads(self._export_features('geojson'))
+
+        self.assertEqual('FeatureCollection', collection['type'])
+        feature, = collection['features']
+        self.assertEqual('Point', feature['geometry']['type'])
+        properties = feature['properties']
+        self.assertEqual('2.0', properties['Diameter'])
+        self.assertEqual('a', properties['Planting Site: Test choice'])
+        self.assertNotIn('Point X', properties)
+
+    @media_dir
+    def test_ndjson_export(self):
+        Plot(geom=self.instance.center,
+             instance=self.instance).save_with_user(self.user)
+
+        lines = self._export_features('ndjson').splitlines()
+
+        self.assertEqual(2, len(lines))
+        features = [json.loads(line) for line in lines]
+        self.assertEqual({'Feature'}, {f['type'] for f in features})
+        self.assertEqual(sorted(f['id'] for f in features),
+                         [f['id'] for f in features])
+
+    def _begin_export(self):
+        ctx = begin_export(make_request(user=self.user), self.instance,
+                           'tree')
+        return ExportJob.objects.get(pk=ctx['job_id'])
+
+    @media_dir
+    @override_settings(FEATURE_BACKEND_FUNCTION=None)
+    def test_export_is_reused_until_data_changes(self):
+        first = self._begin_export()
+        second = self._begin_export()
+
+        self.assertNotEqual(first.pk, second.pk)
+        self.assertEqual(ExportJob.COMPLETE, second.status)
+        self.assertEqual(first.outfile.name, second.outfile.name)
+
+        self.instance.update_universal_rev()
+        third = self._begin_export()
+
+        self.assertEqual(ExportJob.COMPLETE, third.status)
+        self.assertNotEqual(first.outfile.name, third.outfile.name)
+
+    @media_dir
+    @override_settings(FEATURE_BACKEND_FUNCTION=None)
+    def test_delete_old_exports_keeps_shared_files(self):
+        first = self._begin_export()
+        second = self._begin_export()
+        storage = first.outfile.storage
+        long_ago = datetime.datetime.now() - datetime.timedelta(days=30)
+
+        ExportJob.objects.filter(pk=first.pk).update(created=long_ago)
+        self.assertEqual((1, 0), delete_old_exports(7))
+        self.assertTrue(storage.exists(second.outfile.name))
+
+        ExportJob.objects.filter(pk=second.pk).update(created=long_ago)
+        self.assertEqual((1, 1), delete_old_exports(7))
+        self.assertFalse(storage.exists(second.outfile.name))
+
+    def _export_rows(self):
+        job = ExportJob(instance=self.instance, user=self.user)
+        job.save()
+        tasks.async_csv_export(job.pk, 'tree', '', '')
+        job = ExportJob.objects.get(pk=job.pk)
+        return list(csv.reader(job.outfile))
+
+    @media_dir
+    def test_copy_export_matches_orm_export(self):
+        make_collection_udf(self.instance, 'Stewardship')
+        set_write_permissions(self.instance, self.user,
+                              'Plot', ['udf:Stewardship'])
+        plot = Plot.objects.get(instance=self.instance)
+        plot.udfs['Stewardship'] = [{'action': 'water', 'height': 42}]
+        plot.width = 3.25
+        plot.save_with_user(self.user)
+
+        Plot(geom=self.instance.center, instance=self.instance,
+             address_street='').save_with_user(self.user)
+
+        with override_settings(EXPORT_TREE_CSV_WITH_COPY=False):
+            orm_rows = self._export_rows()
+        with override_settings(EXPORT_TREE_CSV_WITH_COPY=True):
+            copy_rows = self._export_rows()
+
+        self.assertEqual(3, len(copy_rows))
+        self.assertEqual(orm_rows[0], copy_rows[0])
+        self.assertEqual(sorted(orm_rows[1:]), sorted(copy_rows[1:]))
+        self.assertIn('Planting Site: Stewardship', copy_rows[0])
+
 
 class ExportSpeciesTaskTest(AsyncCSVTestCase):
 
@@ -213,13 +333,15 @@ class UserExportsTestCase(OTMTestCase):
 
 class UserExportsTest(UserExportsTestCase):
 
+    def get_streaming_content(self, resp):
+        return b''.join(resp.streaming_content)
+
     def get_csv_data_with_base_assertions(self):
         resp = users_csv(make_request(), self.instance)
-        reader = csv.reader(resp)
+        content = self.get_streaming_content(resp)
 
-        # Skip BOM and entry line
-        reader.next()
-        reader.next()
+        # Skip BOM
+        reader = csv.reader(StringIO(content[3:]))
 
         header = reader.next()
 
@@ -272,7 +394,7 @@ class UserExportsTest(UserExportsTestCase):
     def test_export_users_json_keep_info_private(self):
         resp = users_json(make_request(), self.instance)
 
-        data = json.loads(resp.content)
+        data = json.loads(self.get_streaming_content(resp))
 
         commander, user1data, user2data = data
         self.assertFalse('first_name' in user1data)
@@ -283,7 +405,7 @@ class UserExportsTest(UserExportsTestCase):
 
         resp = users_json(make_request(), self.instance)
 
-        data = json.loads(resp.content)
+        data = json.loads(self.get_streaming_content(resp))
 
         commander, user1data, user2data = data
 
@@ -307,6 +429,18 @@ class UserExportsTest(UserExportsTestCase):
                              'email': 'genly@example.com',
                              'email_hash': self.user2.email_hash})
 
+    def test_export_users_in_one_query(self):
+        for i in range(3):
+            user = make_commander_user(self.instance, 'commander%s' % i)
+            Plot(geom=self.instance.center,
+                 instance=self.instance).save_with_user(user)
+
+        with self.assertNumQueries(1):
+            data = json.loads(b''.join(iter_users('json', self.instance)))
+
+        self.assertEqual(6, len(data))
+        self.assertEqual('Plot', data[1]['last_edit_model'])
+
     def test_min_edit_date(self):
         last_week = now() - datetime.timedelta(days=7)
         two_days_ago = now() - datetime.timedelta(days=2)
@@ -324,7 +458,7 @@ class UserExportsTest(UserExportsTestCase):
 
         resp = users_json(make_request({'minEditDate': tda_ts}), self.instance)
 
-        data = json.loads(resp.content)
+        data = json.loads(self.get_streaming_content(resp))
 
         self.assertEquals(len(data), 1)
 
@@ -351,7 +485,7 @@ class UserExportsTest(UserExportsTestCase):
 
         resp = users_json(make_request({'minJoinDate': tda_ts}), self.instance)
 
-        data = json.loads(resp.content)
+        data = json.loads(self.get_streaming_content(resp))
 
         self.assertEquals(len(data), 1)
 
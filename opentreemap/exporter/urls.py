@@ -9,6 +9,8 @@ from exporter.views import begin_export_endpoint, check_export_endpoint
 urlpatterns = [
     url(r'(?P<model>(tree|species))/$',
         begin_export_endpoint, name='begin_export'),
+    url(r'(?P<model>tree)/(?P<data_format>(geojson|ndjson))/$',
+        begin_export_endpoint, name='begin_export_with_format'),
     url(r'check/(?P<job_id>\d+)/$',
         check_export_endpoint, name='check_export'),
 ]
@@ -4,104 +4,184 @@ from __future__ import unicode_literals
 from __future__ import division
 
 import csv
+import hashlib
 import json
 
 from datetime import datetime
 
 from contextlib import contextmanager
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db.models import Q
+from django.db import connection
+from django.utils import timezone
 
 from treemap.lib.dates import DATETIME_FORMAT
-from treemap.models import User, Audit
 
 from exporter.util import sanitize_unicode_record
 
 
-def write_users(data_format, *args, **kwargs):
-    fn = _write_users_csv if data_format == 'csv' else _write_users_json
-    fn(*args, **kwargs)
-
-
-def _write_users_csv(csv_obj, instance, min_join_ts=None, min_edit_ts=None):
-    field_names = ['username', 'email', 'first_name',
-                   'last_name', 'email_hash',
-                   'allow_email_contact', 'role', 'created', 'organization',
-                   'last_edit_model', 'last_edit_model_id',
-                   'last_edit_instance_id', 'last_edit_field',
-                   'last_edit_previous_value', 'last_edit_current_value',
-                   'last_edit_user_id', 'last_edit_action',
-                   'last_edit_requires_auth', 'last_edit_ref',
-                   'last_edit_created']
-    writer = csv.DictWriter(csv_obj, field_names)
-    writer.writeheader()
-    for user in _users_export(instance, min_join_ts, min_edit_ts):
-        writer.writerow(_user_as_dict(user, instance))
-
-
-def _write_users_json(json_obj, instance, min_join_ts=None, min_edit_ts=None):
-    users = _users_export(instance, min_join_ts, min_edit_ts)
-    users_list = [_user_as_dict(user, instance) for user in users]
-    json_obj.write(json.dumps(users_list))
-
-
-def _users_export(instance, min_join_ts, min_edit_ts):
-    users = User.objects.filter(instance=instance)\
-                        .order_by('username')
+# Selects the users of an instance with their roles, when their accounts
+# were created and their most recent edit in the instance in one query,
+# instead of running several queries for each user
+_USERS_SQL = """
+SELECT u.username, u.email, u.first_name, u.last_name, u.organization,
+       u.make_info_public, u.allow_email_contact,
+       r.name AS role,
+       joined.created,
+       edit.model AS last_edit_model,
+       edit.model_id AS last_edit_model_id,
+       edit.instance_id AS last_edit_instance_id,
+       edit.field AS last_edit_field,
+       edit.previous_value AS last_edit_previous_value,
+       edit.current_value AS last_edit_current_value,
+       edit.user_id AS last_edit_user_id,
+       edit.action AS last_edit_action,
+       edit.requires_auth AS last_edit_requires_auth,
+       edit.ref_id AS last_edit_ref,
+       edit.created AS last_edit_created
+FROM treemap_user u
+JOIN treemap_instanceuser iu ON iu.user_id = u.id
+JOIN treemap_role r ON r.id = iu.role_id
+LEFT JOIN (
+    SELECT DISTINCT ON (model_id) model_id, created
+    FROM treemap_audit
+    WHERE instance_id IS NULL AND model = 'User'
+      AND model_id IN (SELECT user_id FROM treemap_instanceuser
+                       WHERE instance_id = %(instance_id)s)
+    ORDER BY model_id, created
+) joined ON joined.model_id = u.id
+LEFT JOIN (
+    SELECT DISTINCT ON (user_id) *
+    FROM treemap_audit
+    WHERE instance_id = %(instance_id)s
+    ORDER BY user_id, updated DESC, id DESC
+) edit ON edit.user_id = u.id
+WHERE iu.instance_id = %(instance_id)s
+{filters}
+ORDER BY u.username
+"""
+
+_MIN_JOIN_DATE_FILTER = """
+AND iu.id IN (SELECT model_id FROM treemap_audit
+              WHERE instance_id = %(instance_id)s
+                AND model = 'InstanceUser'
+                AND created > %(min_join_date)s)
+"""
+
+_MIN_EDIT_DATE_FILTER = """
+AND u.id IN (SELECT user_id FROM treemap_audit
+             WHERE instance_id = %(instance_id)s
+               AND (created > %(min_edit_date)s
+                    OR updated > %(min_edit_date)s))
+"""
+
+_USERS_FETCH_SIZE = 1000
+
+_CSV_FIELD_NAMES = ['username', 'email', 'first_name',
+                    'last_name', 'email_hash',
+                    'allow_email_contact', 'role', 'created', 'organization',
+                    'last_edit_model', 'last_edit_model_id',
+                    'last_edit_instance_id', 'last_edit_field',
+                    'last_edit_previous_value', 'last_edit_current_value',
+                    'last_edit_user_id', 'last_edit_action',
+                    'last_edit_requires_auth', 'last_edit_ref',
+                    'last_edit_created']
+
+
+def write_users(data_format, file_obj, *args, **kwargs):
+    for chunk in iter_users(data_format, *args, **kwargs):
+        file_obj.write(chunk)
+
+
+def iter_users(data_format, instance, min_join_ts=None, min_edit_ts=None):
+    """
+    Returns an iterator over the chunks of a user export, which reads
+    users from the database as it goes. Invalid filter timestamps raise
+    a ValidationError right away rather than during iteration.
+    """
+    sql, params = _users_sql(instance, min_join_ts, min_edit_ts)
+    users = _iter_user_dicts(sql, params)
+    if data_format == 'csv':
+        return _iter_users_csv(users)
+    else:
+        return _iter_users_json(users)
+
+
+class _Echo(object):
+    """A file-like object whose writes return what was written"""
+    def write(self, value):
+        return value
+
+
+def _iter_users_csv(users):
+    writer = csv.DictWriter(_Echo(), _CSV_FIELD_NAMES)
+    yield writer.writerow(dict(zip(_CSV_FIELD_NAMES, _CSV_FIELD_NAMES)))
+    for user in users:
+        yield writer.writerow(user)
+
+
+def _iter_users_json(users):
+    # Writes the same text as `json.dumps` of a list of the users
+    yield b'['
+    separator = b''
+    for user in users:
+        yield separator + json.dumps(user)
+        separator = b', '
+    yield b']'
+
+
+def _users_sql(instance, min_join_ts, min_edit_ts):
+    filters = []
+    params = {'instance_id': instance.pk}
 
     if min_join_ts:
         with _date_filter(min_join_ts, 'minJoinDate') as min_join_date:
-            iuser_ids = Audit.objects.filter(instance=instance)\
-                                     .filter(model='InstanceUser')\
-                                     .filter(created__gt=min_join_date)\
-                                     .distinct('model_id')\
-                                     .values_list('model_id', flat=True)
-            users = users.filter(instanceuser__in=iuser_ids)
+            filters.append(_MIN_JOIN_DATE_FILTER)
+            params['min_join_date'] = min_join_date
 
     if min_edit_ts:
         with _date_filter(min_edit_ts, 'minEditDate') as min_edit_date:
-            user_ids = Audit.objects\
-                            .filter(instance=instance)\
-                            .filter(Q(created__gt=min_edit_date) |
-                                    Q(updated__gt=min_edit_date))\
-                            .distinct('user')\
-                            .values_list('user_id', flat=True)
-            users = users.filter(id__in=user_ids)
+            filters.append(_MIN_EDIT_DATE_FILTER)
+            params['min_edit_date'] = min_edit_date
 
-    return users
+    return _USERS_SQL.format(filters=''.join(filters)), params
 
 
-def _user_as_dict(user, instance):
-    iuser = user.get_instance_user(instance)
-    role_name = None
-    if iuser:
-        role_name = iuser.role.name
+def _iter_user_dicts(sql, params):
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        columns = [column[0] for column in cursor.description]
+        while True:
+            rows = cursor.fetchmany(_USERS_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield _user_as_dict(dict(zip(columns, row)))
 
-    email = ''
 
-    if user.allow_email_contact:
-        email = user.email
+def _user_as_dict(row):
+    is_public = row['make_info_public']
 
-    modeldata = {'username': user.username,
-                 'organization': user.get_organization(),
-                 'first_name': user.get_first_name(),
-                 'last_name': user.get_last_name(),
-                 'email': email,
-                 'email_hash': user.email_hash,
-                 'allow_email_contact': str(user.allow_email_contact),
-                 'created': str(user.created),
-                 'role': role_name}
+    email = ''
 
-    last_edits = Audit.objects.filter(instance=instance,
-                                      user=user)\
-                              .order_by('-updated')[:1]
+    if row['allow_email_contact']:
+        email = row['email']
 
-    if last_edits:
-        last_edit = last_edits[0]
+    modeldata = {'username': row['username'],
+                 'organization': row['organization'] if is_public else '',
+                 'first_name': row['first_name'] if is_public else '',
+                 'last_name': row['last_name'] if is_public else '',
+                 'email': email,
+                 'email_hash': hashlib.sha512(row['email']).hexdigest(),
+                 'allow_email_contact': str(row['allow_email_contact']),
+                 'created': str(row['created']),
+                 'role': row['role']}
 
-        modeldata.update({'last_edit_%s' % k: v
-                          for (k, v) in last_edit.dict().iteritems()})
+    if row['last_edit_user_id'] is not None:
+        modeldata.update({k: v for (k, v) in row.iteritems()
+                          if k.startswith('last_edit_')})
+        modeldata['last_edit_created'] = str(row['last_edit_created'])
 
     return sanitize_unicode_record(modeldata)
 
@@ -116,4 +196,8 @@ def _date_filter(timestamp, filter_name):
                               % {"ts": timestamp,
                                  "format": DATETIME_FORMAT,
                                  "filter_name": filter_name})
+    if settings.USE_TZ:
+        # Interpret the timestamp the way the ORM would
+        filter_date = timezone.make_aware(filter_date,
+                                          timezone.get_default_timezone())
     yield filter_date
@@ -11,14 +11,16 @@ from tasks import async_csv_export, async_users_export
 from django_tinsel.utils import decorate as do
 from django_tinsel.decorators import json_api_call
 
-from treemap.util import get_csv_response, get_json_response
+from treemap.util import (get_streaming_csv_response,
+                          get_streaming_json_response)
 from treemap.decorators import instance_request
 
 from exporter import (EXPORTS_NOT_ENABLED_CONTEXT,
                       EXPORTS_FEATURE_DISABLED_CONTEXT)
-from exporter.lib import export_enabled_for
+from exporter.lib import (export_enabled_for, export_fingerprint,
+                          get_reusable_export)
 from exporter.models import ExportJob
-from exporter.user import write_users
+from exporter.user import iter_users
 
 ############################################
 # synchronous exports
@@ -40,18 +42,16 @@ def _get_user_extra_args(request):
 
 
 def users_csv(request, instance):
-    "Return a user csv synchronously"
-    response = get_csv_response('users.csv')
+    "Stream a user csv synchronously"
     extra = _get_user_extra_args(request)
-    write_users('csv', response, instance, *extra)
-    return response
+    return get_streaming_csv_response(
+        'users.csv', iter_users('csv', instance, *extra))
 
 
 def users_json(request, instance):
-    response = get_json_response('user_export.json')
     extra = _get_user_extra_args(request)
-    write_users('json', response, instance, *extra)
-    return response
+    return get_streaming_json_response(
+        'user_export.json', iter_users('json', instance, *extra))
 
 
 ############################################
@@ -77,7 +77,11 @@ def begin_export_users(request, instance, data_format):
     return {'start_status': 'OK', 'job_id': job.pk}
 
 
-def begin_export(request, instance, model):
+def begin_export(request, instance, model, data_format='csv'):
+    if model != 'tree' and data_format != 'csv':
+        # Only trees have locations to export as GeoJSON
+        raise Http404()
+
     if not instance.feature_enabled('exports'):
         return EXPORTS_FEATURE_DISABLED_CONTEXT
     elif not export_enabled_for(instance, request.user):
@@ -87,13 +91,24 @@ def begin_export(request, instance, model):
     display_filters = request.GET.get('show', None)
 
     job = ExportJob(instance=instance,
-                    description='csv export of %s' % model)
+                    description='%s export of %s' % (data_format, model))
 
     if request.user.is_authenticated():
         job.user = request.user
-    job.save()
 
-    async_csv_export.delay(job.pk, model, query, display_filters)
+    job.fingerprint = export_fingerprint(instance, job.user, model, query,
+                                         display_filters, data_format)
+    reusable_job = get_reusable_export(instance, job.fingerprint)
+
+    if reusable_job is not None:
+        # Nothing the export depends on has changed, so share the file
+        job.outfile = reusable_job.outfile.name
+        job.status = ExportJob.COMPLETE
+        job.save()
+    else:
+        job.save()
+        async_csv_export.delay(job.pk, model, query, display_filters,
+                               data_format)
 
     return {'start_status': 'OK', 'job_id': job.pk}
 
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import csv
+import random
+import time
+from StringIO import StringIO
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+
+from treemap.instance import Instance
+from treemap.models import Species, User
+
+from importer.models.trees import TreeImportEvent, TreeImportRow
+from importer.tasks import _create_rows_for_event
+
+
+class Command(BaseCommand):
+    help = ('Times validating a synthetic tree import CSV row by row and '
+            'in batches. The import event is deleted afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('instance_url_name')
+        parser.add_argument(
+            '-n', '--number-of-rows',
+            action='store',
+            type=int,
+            dest='n',
+            default=100000,
+            help='Number of rows in the synthetic CSV'),
+        parser.add_argument(
+            '-s', '--per-row-sample',
+            action='store',
+            type=int,
+            dest='sample',
+            default=1000,
+            help='Number of rows to validate one at a time')
+
+    def handle(self, *args, **options):
+        url_name = options['instance_url_name']
+        try:
+            instance = Instance.objects.get(url_name=url_name)
+        except ObjectDoesNotExist:
+            raise CommandError('Instance "%s" not found' % url_name)
+
+        csv_file = _make_csv(instance, options['n'])
+
+        ie = TreeImportEvent(file_name='benchmark.csv',
+                             owner=User.system_user(),
+                             instance=instance)
+        ie.save()
+        try:
+            self._time('Loaded', options['n'],
+                       lambda: _create_rows_for_event(ie, csv_file))
+
+            rows = list(ie.rows())
+            sample = rows[:options['sample']]
+
+            def validate_one_at_a_time():
+                for row in sample:
+                    row.validate_row()
+
+            def validate_in_batches():
+                batch_size = settings.IMPORT_BATCH_SIZE
+                for i in xrange(0, len(rows), batch_size):
+                    TreeImportRow.validate_rows(rows[i:(i + batch_size)])
+
+            self._time('Validated one at a time', len(sample),
+                       validate_one_at_a_time)
+            self._time('Validated in batches', len(rows),
+                       validate_in_batches)
+        finally:
+            ie.rows().delete()
+            ie.delete()
+
+    def _time(self, label, n_rows, fn):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        self.stdout.write('%s: %s rows in %.2f seconds (%d rows/s)'
+                          % (label, n_rows, elapsed, n_rows / elapsed))
+
+
+def _make_csv(instance, n):
+    random.seed(1)
+    xmin, ymin, xmax, ymax = instance.bounds.geom.extent
+    species = list(Species.objects.filter(instance=instance)[:100])
+
+    f = StringIO()
+    writer = csv.writer(f)
+    writer.writerow(['point x', 'point y', 'genus', 'species', 'diameter'])
+    for __ in xrange(n):
+        p = Point(random.uniform(xmin, xmax), random.uniform(ymin, ymax),
+                  srid=3857)
+        p.transform(4326)
+        s = random.choice(species) if species else None
+        writer.writerow([p.x, p.y,
+                         s.genus.encode('utf-8') if s else '',
+                         s.species.encode('utf-8') if s else '',
+                         random.randint(1, 40)])
+    f.seek(0)
+    return f
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('importer', '0006_add_index_to_tree_import_row'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='speciesimportevent',
+            name='bytes_loaded',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='speciesimportevent',
+            name='file_size',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='speciesimportevent',
+            name='loaded_row_count',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='treeimportevent',
+            name='bytes_loaded',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='treeimportevent',
+            name='file_size',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='treeimportevent',
+            name='loaded_row_count',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+    ]
@@ -56,6 +56,14 @@ class GenericImportEvent(models.Model):
     # The id of a running verification task.  Used for canceling imports
     task_id = models.CharField(max_length=50, default='', blank=True)
 
+    # Number of rows, recorded once they have all been loaded
+    loaded_row_count = models.IntegerField(null=True, blank=True)
+
+    # Size of the uploaded file and how much of it has been loaded so far,
+    # used to show progress while loading
+    file_size = models.IntegerField(null=True, blank=True)
+    bytes_loaded = models.IntegerField(null=True, blank=True)
+
     def save(self, *args, **kwargs):
         if self.pk is None:
             # Record current import schema version (defined in subclass)
@@ -64,8 +72,15 @@ class GenericImportEvent(models.Model):
 
     @property
     def row_count(self):
+        if self.loaded_row_count is not None:
+            return self.loaded_row_count
         return self.rows().count()
 
+    def loading_summary(self):
+        if self.file_size and self.bytes_loaded is not None:
+            return '{:.0%}'.format(self.bytes_loaded / self.file_size)
+        return ''
+
     def status_summary(self):
         t = "Unknown Error While %s" if self.is_lost else "%s"
         return t % self.status_description()
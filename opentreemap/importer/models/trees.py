@@ -5,13 +5,18 @@ from __future__ import division
 
 import json
 
-from django.core.exceptions import ValidationError, MultipleObjectsReturned
+from django.core.exceptions import ValidationError
 from django.contrib.gis.db import models
-from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.geos import Point
+from django.utils import timezone
 from django.utils.translation import ugettext as _
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models.functions import Lower
 
-from treemap.models import Species, Plot, Tree, MapFeature
+from treemap.audit import bulk_create_with_user
+from treemap.ecoaggregate import record_tree_changes, region_code_lookup
+from treemap.models import Species, Plot, Tree, User
+from treemap.lib.itree_region import assign_itree_region_codes
 from treemap.lib.object_caches import udf_defs
 from treemap.units import storage_to_instance_units_factor
 
@@ -119,6 +124,10 @@ class TreeImportRow(GenericImportRow):
     # The main import event
     import_event = models.ForeignKey(TreeImportEvent)
 
+    # (plot id, old point, old hide_at_zoom) if committing this row moved
+    # an existing plot
+    moved_plot = None
+
     class Meta:
         app_label = 'importer'
         index_together = ('import_event', 'idx')
@@ -136,7 +145,44 @@ class TreeImportRow(GenericImportRow):
         if self.status == TreeImportRow.SUCCESS:
             return  # nothing changed so no need to commit
 
-        # Get our data
+        data = self._get_commit_data()
+        self._commit_row(data, self._get_plot_for_commit(data))
+
+    @staticmethod
+    def commit_rows(rows):
+        """
+        Commit rows of a single import event like commit_row.
+
+        Rows creating new plots are inserted in bulk: their plots, trees
+        and insert audits are created with a few queries in one
+        transaction. Rows updating existing plots or trees, and rows whose
+        models fail to validate, are committed one at a time.
+        """
+        rows = list(rows)
+        if not rows:
+            return
+
+        ie = rows[0].import_event
+        results = TreeImportRow.validate_rows(rows)
+
+        new_rows = []
+        for row, is_valid in zip(rows, results):
+            if not is_valid or row.status == TreeImportRow.SUCCESS:
+                continue
+
+            data = row._get_commit_data()
+            if row._creates_plot(data):
+                plot, tree = row._build_new_plot_and_tree(data)
+                if plot is not None:
+                    new_rows.append((row, plot, tree))
+                    continue
+
+            row._commit_row(data, row._get_plot_for_commit(data))
+
+        if new_rows:
+            _bulk_commit_new_plots(ie, new_rows)
+
+    def _get_commit_data(self):
         data = self.cleaned
 
         self.convert_units(data, {
@@ -156,20 +202,26 @@ class TreeImportRow(GenericImportRow):
             self.import_event.canopy_height_conversion_factor
         })
 
+        return data
+
+    def _creates_plot(self, data):
+        return (self.plot_id is None and
+                not data.get(self.model_fields.OPENTREEMAP_PLOT_ID, None) and
+                not data.get(self.model_fields.OPENTREEMAP_TREE_ID, None))
+
+    def _get_plot_for_commit(self, data):
         plot_id = data.get(self.model_fields.OPENTREEMAP_PLOT_ID, None)
         tree_id = data.get(self.model_fields.OPENTREEMAP_TREE_ID, None)
 
         # Check for an existing plot, use it if we're not already:
         if plot_id and (self.plot is None or self.plot.pk != plot_id):
-            plot = Plot.objects.get(pk=plot_id)
+            return Plot.objects.get(pk=plot_id)
         elif self.plot is not None:
-            plot = self.plot
+            return self.plot
         elif tree_id:
-            plot = Tree.objects.get(pk=tree_id).plot
+            return Tree.objects.get(pk=tree_id).plot
         else:
-            plot = Plot(instance=self.import_event.instance)
-
-        self._commit_row(data, plot)
+            return Plot(instance=self.import_event.instance)
 
     @transaction.atomic
     def _commit_row(self, data, plot):
@@ -193,6 +245,45 @@ class TreeImportRow(GenericImportRow):
         self.status = TreeImportRow.SUCCESS
         self.save()
 
+    def _build_new_plot_and_tree(self, data):
+        """
+        Make the unsaved plot and tree (or None) that committing the row
+        would create, or return (None, None) if they are not valid and the
+        row should be committed by itself to report the error
+        """
+        instance = self.import_event.instance
+        plot = Plot(instance=instance)
+        tree = None
+
+        tree_present = data.get(self.model_fields.TREE_PRESENT, None)
+        if tree_present:
+            tree = Tree(instance=instance)
+        if tree_present or tree_present is None:
+            tree = self._set_tree_data(data, plot, tree, bool(tree_present))
+
+        if not self._set_plot_data(data, plot):
+            return None, None
+
+        try:
+            # The full_clean done by save_with_user also checks that each
+            # foreign key exists, which costs a query per field and row
+            for model in (plot, tree):
+                if model is not None:
+                    model.clean_fields(exclude=[
+                        f.name for f in model._meta.fields
+                        if isinstance(f, models.ForeignKey)])
+                    model.clean()
+            plot.validate_positive_nullable_float_field('width')
+            plot.validate_positive_nullable_float_field('length')
+            if tree is not None:
+                tree.validate_diameter()
+                tree.validate_height()
+                tree.validate_canopy_height()
+        except ValidationError:
+            return None, None
+
+        return plot, tree
+
     def _import_value_to_udf_value(self, udf_def, value):
         if udf_def.datatype_dict['type'] == 'multichoice':
             # multichoice fields are represented in the import file as
@@ -205,7 +296,8 @@ class TreeImportRow(GenericImportRow):
         else:
             return value
 
-    def _commit_plot_data(self, data, plot):
+    def _set_plot_data(self, data, plot):
+        """Set plot fields from the row data. Returns whether any were set"""
         plot_edited = False
         for plot_attr, field_name in TreeImportRow.PLOT_MAP.iteritems():
             value = data.get(field_name, None)
@@ -223,11 +315,23 @@ class TreeImportRow(GenericImportRow):
                 plot.udfs[udf_def.name] = self._import_value_to_udf_value(
                     udf_def, value)
 
-        if plot_edited:
+        return plot_edited
+
+    def _commit_plot_data(self, data, plot):
+        old_geom = plot.geom if plot.pk else None
+
+        if self._set_plot_data(data, plot):
             plot.save_with_system_user_bypass_auth()
-            plot.update_updated_fields(ie.owner)
+            plot.update_updated_fields(self.import_event.owner)
 
-    def _commit_tree_data(self, data, plot, tree, tree_edited):
+            if old_geom is not None and not old_geom.equals(plot.geom):
+                self.moved_plot = (plot.pk, old_geom, plot.hide_at_zoom)
+
+    def _set_tree_data(self, data, plot, tree, tree_edited):
+        """
+        Set tree fields from the row data, making a tree if needed.
+        Returns the tree if it was edited, otherwise None.
+        """
         for tree_attr, field_name in TreeImportRow.TREE_MAP.iteritems():
             value = data.get(field_name, None)
             if value:
@@ -251,8 +355,14 @@ class TreeImportRow(GenericImportRow):
 
         if tree_edited:
             tree.plot = plot
+            return tree
+        return None
+
+    def _commit_tree_data(self, data, plot, tree, tree_edited):
+        tree = self._set_tree_data(data, plot, tree, tree_edited)
+        if tree is not None:
             tree.save_with_system_user_bypass_auth()
-            tree.plot.update_updated_fields(ie.owner)
+            tree.plot.update_updated_fields(self.import_event.owner)
 
     def validate_geom(self):
         x = self.cleaned.get(fields.trees.POINT_X, None)
@@ -285,38 +395,36 @@ class TreeImportRow(GenericImportRow):
 
         return True
 
-    def validate_plot_id_and_tree_id(self):
+    def validate_plot_id_and_tree_id(self, lookups):
         result = True
         plot_id = self.cleaned.get(fields.trees.OPENTREEMAP_PLOT_ID, None)
         tree_id = self.cleaned.get(fields.trees.OPENTREEMAP_TREE_ID, None)
 
         if tree_id:
-            tree = Tree.objects.filter(pk=tree_id,
-                                       instance=self.import_event.instance)
-            if not tree.exists():
+            if tree_id not in lookups.plot_id_by_tree_id:
                 self.append_error(errors.INVALID_TREE_ID,
                                   fields.trees.OPENTREEMAP_TREE_ID)
                 result = False
             elif plot_id:
-                if tree[0].plot_id != plot_id:
+                if lookups.plot_id_by_tree_id[tree_id] != plot_id:
                     self.append_error(errors.PLOT_TREE_MISMATCH,
                                       (fields.trees.OPENTREEMAP_PLOT_ID,
                                        fields.trees.OPENTREEMAP_TREE_ID))
                     result = False
 
         if plot_id:
-            has_plot = Plot.objects \
-                .filter(pk=plot_id, instance=self.import_event.instance) \
-                .exists()
-
-            if not has_plot:
+            if plot_id not in lookups.plot_ids:
                 self.append_error(errors.INVALID_PLOT_ID,
                                   fields.trees.OPENTREEMAP_PLOT_ID)
                 result = False
 
         return result
 
-    def validate_proximity(self, point):
+    def validate_proximity(self, nearby):
+        """
+        `nearby` is a list of (plot id, distance) tuples for the closest
+        plots to this row's point, as found by _BatchLookups
+        """
         # This block must stay at the top of the function and
         # effectively disables proximity validation when the import
         # row includes an OTM plot id or tree id. Proximity validation can
@@ -327,37 +435,13 @@ class TreeImportRow(GenericImportRow):
         if plot_id is not None or tree_id is not None:
             return True
 
-        offset = 3.048  # 10ft in meters
-        nearby_bbox = Polygon(((point.x - offset, point.y - offset),
-                               (point.x - offset, point.y + offset),
-                               (point.x + offset, point.y + offset),
-                               (point.x + offset, point.y - offset),
-                               (point.x - offset, point.y - offset)))
-
-        # This gets called while committing each row.
-        # Assume that the creator of the csv knows best,
-        # and avoid proximity checks against other plots in the same csv.
-        already_committed = self.import_event.rows()\
-            .filter(plot_id__isnull=False)\
-            .values_list('plot_id')
-
-        # Using MapFeature directly avoids a join between the
-        # treemap_plot and treemap_mapfeature tables.
-        nearby = MapFeature.objects\
-                           .filter(instance=self.import_event.instance)\
-                           .filter(feature_type='Plot')\
-                           .exclude(pk__in=already_committed)\
-                           .filter(geom__intersects=nearby_bbox)
-
-        nearby = nearby.distance(point).order_by('distance')[:5]
-
         if len(nearby) > 0:
             flds = (fields.trees.POINT_X, fields.trees.POINT_Y)
-            if nearby[0].distance.m < 0.001:
+            if nearby[0][1] < 0.001:
                 self.append_error(errors.DUPLICATE_TREE, flds)
             else:
                 self.append_error(errors.NEARBY_TREES, flds,
-                                  [p.pk for p in nearby])
+                                  [id for id, __ in nearby])
             return False
         else:
             return True
@@ -386,7 +470,7 @@ class TreeImportRow(GenericImportRow):
             fields.trees.TREE_HEIGHT, 'height',
             species.max_height, errors.SPECIES_HEIGHT_TOO_HIGH)
 
-    def validate_species(self):
+    def validate_species(self, lookups):
         fs = fields.trees
         genus = self.datadict.get(fs.GENUS, '')
         species = self.datadict.get(fs.SPECIES, '')
@@ -399,26 +483,20 @@ class TreeImportRow(GenericImportRow):
             error_txt = ' '.join(error_fields).strip()
             self.append_error(error, fs.SPECIES_FIELDS, error_txt)
 
-        if genus != '' or species != '' or cultivar != '' or other_part != '':
-            kwargs = {
-                'instance_id': self.import_event.instance_id,
-                'genus__iexact': genus,
-                'species__iexact': species,
-                'cultivar__iexact': cultivar,
-                'other_part_of_name__iexact': other_part,
-            }
-
-            if common_name != '':
-                kwargs['common_name__iexact'] = common_name
-        else:
+        if not (genus or species or cultivar or other_part):
             return
 
-        try:
-            matching_species = Species.objects.get(**kwargs)
-            self.cleaned[fields.trees.SPECIES_OBJECT] = matching_species
-        except Species.DoesNotExist:
+        matches = lookups.species_by_name.get(
+            _species_name_key(genus, species, cultivar, other_part), [])
+        if common_name != '':
+            matches = [s for s in matches
+                       if (s.common_name or '').lower() == common_name.lower()]
+
+        if len(matches) == 1:
+            self.cleaned[fields.trees.SPECIES_OBJECT] = matches[0]
+        elif not matches:
             append_species_error(errors.INVALID_SPECIES)
-        except MultipleObjectsReturned:
+        else:
             append_species_error(errors.DUPLICATE_SPECIES)
 
     def validate_user_defined_fields(self):
@@ -449,44 +527,247 @@ class TreeImportRow(GenericImportRow):
         - The 'cleaned' field on self will be set as fields
           get validated
         """
-        # Clear errrors
-        self.errors = ''
+        return TreeImportRow.validate_rows([self])[0]
 
-        # Convert all fields to correct datatypes
-        self.validate_and_convert_datatypes()
+    @staticmethod
+    def validate_rows(rows):
+        """
+        Validate rows of a single import event like validate_row, but
+        look up species, plots, trees and nearby plots for all of them
+        with a few queries. Returns a list of validate_row results.
+        """
+        rows = list(rows)
+        if not rows:
+            return []
 
-        self.validate_user_defined_fields()
+        for row in rows:
+            # Clear errrors
+            row.errors = ''
 
-        # We can work on the 'cleaned' data from here on out
-        self.validate_plot_id_and_tree_id()
+            # Convert all fields to correct datatypes
+            row.validate_and_convert_datatypes()
 
-        # Attaches a GEOS point to fields.trees.POINT
-        self.validate_geom()
+            row.validate_user_defined_fields()
 
-        # This could be None or not set if there was an earlier error
-        pt = self.cleaned.get(fields.trees.POINT, None)
+        lookups = _BatchLookups(rows[0].import_event, rows)
 
-        self.validate_species()
+        for row in rows:
+            # We can work on the 'cleaned' data from here on out
+            row.validate_plot_id_and_tree_id(lookups)
 
-        # This could be None or unset if species data were not given
-        species = self.cleaned.get(fields.trees.SPECIES_OBJECT, None)
+            # Attaches a GEOS point to fields.trees.POINT
+            row.validate_geom()
 
-        # These validations are non-fatal
-        if species:
-            self.validate_species_dbh_max(species)
-            self.validate_species_height_max(species)
+            row.validate_species(lookups)
 
-        if pt:
-            self.validate_proximity(pt)
+            # This could be None or unset if species data were not given
+            species = row.cleaned.get(fields.trees.SPECIES_OBJECT, None)
 
-        fatal = False
-        if self.has_fatal_error():
-            self.status = TreeImportRow.ERROR
-            fatal = True
-        elif self.has_errors():  # Has 'warning'/tree watch errors
-            self.status = TreeImportRow.WARNING
-        else:
-            self.status = TreeImportRow.VERIFIED
+            # These validations are non-fatal
+            if species:
+                row.validate_species_dbh_max(species)
+                row.validate_species_height_max(species)
 
-        self.save()
-        return not fatal
+        nearby_by_row = lookups.find_nearby_plots(rows)
+
+        for i, row in enumerate(rows):
+            # This could be None or not set if there was an earlier error
+            if row.cleaned.get(fields.trees.POINT, None):
+                row.validate_proximity(nearby_by_row.get(i, []))
+
+            if row.has_fatal_error():
+                row.status = TreeImportRow.ERROR
+            elif row.has_errors():  # Has 'warning'/tree watch errors
+                row.status = TreeImportRow.WARNING
+            else:
+                row.status = TreeImportRow.VERIFIED
+
+        _save_statuses(rows)
+        return [row.status != TreeImportRow.ERROR for row in rows]
+
+
+def _species_name_key(*name_parts):
+    return tuple((part or '').lower() for part in name_parts)
+
+
+class _BatchLookups(object):
+    """
+    Database lookups needed to validate a batch of tree import rows,
+    made with one query each for the whole batch
+    """
+    def __init__(self, import_event, rows):
+        self.import_event = import_event
+        instance = import_event.instance
+
+        tree_ids = {row.cleaned.get(fields.trees.OPENTREEMAP_TREE_ID)
+                    for row in rows} - {None}
+        plot_ids = {row.cleaned.get(fields.trees.OPENTREEMAP_PLOT_ID)
+                    for row in rows} - {None}
+        genera = {(row.datadict.get(fields.trees.GENUS) or '').lower()
+                  for row in rows}
+
+        self.plot_id_by_tree_id = dict(
+            Tree.objects
+            .filter(pk__in=tree_ids, instance=instance)
+            .values_list('pk', 'plot_id')) if tree_ids else {}
+
+        self.plot_ids = set(
+            Plot.objects
+            .filter(pk__in=plot_ids, instance=instance)
+            .values_list('pk', flat=True)) if plot_ids else set()
+
+        # Species names are matched case-insensitively, so index the
+        # species with any of the batch's genera by lowercased name
+        self.species_by_name = {}
+        species = Species.objects \
+            .filter(instance=instance) \
+            .annotate(genus_lower=Lower('genus')) \
+            .filter(genus_lower__in=genera)
+        for s in species:
+            key = _species_name_key(s.genus, s.species, s.cultivar,
+                                    s.other_part_of_name)
+            self.species_by_name.setdefault(key, []).append(s)
+
+    def find_nearby_plots(self, rows):
+        """
+        Return a dict mapping the index of each row with a point to a list
+        of (plot id, distance) tuples for the closest plots within 10 feet,
+        nearest first, using a single spatial query
+        """
+        def needs_proximity_check(row):
+            # Rows with a plot or tree id skip the proximity check
+            cleaned = row.cleaned
+            return (cleaned.get(fields.trees.POINT, None) and
+                    cleaned.get(fields.trees.OPENTREEMAP_PLOT_ID) is None and
+                    cleaned.get(fields.trees.OPENTREEMAP_TREE_ID) is None)
+
+        points = [(i, row.cleaned[fields.trees.POINT])
+                  for i, row in enumerate(rows)
+                  if needs_proximity_check(row)]
+        if not points:
+            return {}
+
+        idxs, points = zip(*points)
+        with connection.cursor() as cursor:
+            cursor.execute(_SQL_NEARBY_PLOTS % {
+                'row_table': TreeImportRow._meta.db_table
+            }, {
+                'idxs': list(idxs),
+                'xs': [p.x for p in points],
+                'ys': [p.y for p in points],
+                'offset': 3.048,  # 10ft in meters
+                'instance_id': self.import_event.instance_id,
+                'import_event_id': self.import_event.pk,
+            })
+            rows = cursor.fetchall()
+
+        nearby_by_row = {}
+        for idx, plot_id, distance in rows:
+            nearby_by_row.setdefault(idx, []).append((plot_id, distance))
+        return nearby_by_row
+
+
+def _bulk_commit_new_plots(import_event, new_rows):
+    """
+    Insert the plots and trees of (row, unsaved plot, unsaved tree or None)
+    tuples and their audits, and mark the rows committed, all in one
+    transaction. Audits are attributed to the system user as they are when
+    committing a single row, which bypasses reputation adjustments.
+    """
+    system_user = User.system_user()
+    now = timezone.now()
+
+    plots = [plot for __, plot, __ in new_rows]
+    for plot in plots:
+        plot.updated_at = now
+        plot.updated_by = import_event.owner
+    assign_itree_region_codes(import_event.instance, plots)
+
+    with transaction.atomic():
+        bulk_create_with_user(plots, system_user)
+
+        trees = []
+        for __, plot, tree in new_rows:
+            if tree is not None:
+                # Set the plot again now that it has an id
+                tree.plot = plot
+                trees.append(tree)
+        if trees:
+            bulk_create_with_user(trees, system_user)
+
+        for row, plot, __ in new_rows:
+            row.plot = plot
+            row.status = TreeImportRow.SUCCESS
+        _save_statuses([row for row, __, __ in new_rows])
+
+        # bulk_create does not send the post_save signals that keep the
+        # instance's benefit totals up to date
+        region_code_for = region_code_lookup(import_event.instance)
+        record_tree_changes(import_event.instance, [
+            (None, (tree.species_id, tree.diameter,
+                    region_code_for(tree.plot.itree_region_code,
+                                    tree.plot.geom)))
+            for tree in trees])
+
+
+def _save_statuses(rows):
+    saved = [row for row in rows if row.pk is not None]
+    for row in rows:
+        if row.pk is None:
+            row.save()
+
+    if saved:
+        with connection.cursor() as cursor:
+            cursor.execute(_SQL_SAVE_STATUSES % {
+                'row_table': TreeImportRow._meta.db_table
+            }, {
+                'ids': [row.pk for row in saved],
+                'statuses': [row.status for row in saved],
+                'errors': [row.errors for row in saved],
+                'plot_ids': [row.plot_id for row in saved],
+            })
+
+
+# This gets called while committing each row.
+# Assume that the creator of the csv knows best,
+# and avoid proximity checks against other plots in the same csv.
+#
+# Using treemap_mapfeature directly avoids a join between the
+# treemap_plot and treemap_mapfeature tables.
+_SQL_NEARBY_PLOTS = """
+    SELECT point.idx, nearby.id, nearby.distance
+    FROM unnest(%%(idxs)s::integer[], %%(xs)s::float8[], %%(ys)s::float8[])
+        AS point(idx, x, y)
+    CROSS JOIN LATERAL (
+        SELECT f.id,
+               ST_Distance(f.the_geom_webmercator,
+                           ST_SetSRID(ST_MakePoint(point.x, point.y), 3857))
+                   AS distance
+        FROM treemap_mapfeature f
+        WHERE f.instance_id = %%(instance_id)s
+          AND f.feature_type = 'Plot'
+          AND ST_Intersects(
+                f.the_geom_webmercator,
+                ST_MakeEnvelope(point.x - %%(offset)s, point.y - %%(offset)s,
+                                point.x + %%(offset)s, point.y + %%(offset)s,
+                                3857))
+          AND f.id NOT IN (
+                SELECT plot_id
+                FROM %(row_table)s
+                WHERE import_event_id = %%(import_event_id)s
+                  AND plot_id IS NOT NULL)
+        ORDER BY distance
+        LIMIT 5
+    ) nearby
+    ORDER BY point.idx, nearby.distance;
+    """
+
+_SQL_SAVE_STATUSES = """
+    UPDATE %(row_table)s r
+    SET status = saved.status, errors = saved.errors,
+        plot_id = saved.plot_id
+    FROM unnest(%%(ids)s::integer[], %%(statuses)s::integer[],
+                %%(errors)s::text[], %%(plot_ids)s::integer[])
+        AS saved(id, status, errors, plot_id)
+    WHERE r.id = saved.id;
+    """
@@ -3,13 +3,18 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
+import csv
 import json
+import os
+from StringIO import StringIO
 
 from celery import shared_task, chord
 from celery.result import GroupResult
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, transaction
+
+from treemap.lib.hide_at_zoom import update_hide_at_zoom_after_bulk_move
 
 from importer.models.base import GenericImportEvent, GenericImportRow
 from importer.models.species import SpeciesImportEvent, SpeciesImportRow
@@ -22,6 +27,11 @@ from importer.util import (clean_row_data, clean_field_name,
 def _create_rows_for_event(ie, csv_file):
     # Don't use a transaction for this possibly long-running operation
     # so we can show progress. Caller does manual cleanup if necessary.
+    csv_file.seek(0, os.SEEK_END)
+    ie.file_size = csv_file.tell()
+    ie.bytes_loaded = 0
+    csv_file.seek(0)
+
     reader = utf8_file_to_csv_dictreader(csv_file)
 
     field_names = [f.strip().decode('utf-8') for f in reader.fieldnames
@@ -33,7 +43,7 @@ def _create_rows_for_event(ie, csv_file):
     file_valid = ie.validate_field_names(field_names)
 
     if file_valid:
-        _create_rows(ie, reader)
+        _create_rows(ie, reader, csv_file)
 
         if ie.row_count == 0:
             file_valid = False
@@ -47,25 +57,54 @@ def _create_rows_for_event(ie, csv_file):
         return False
 
 
-def _create_rows(ie, reader):
+def _create_rows(ie, reader, csv_file):
+    """
+    Stream rows into the import row table with COPY, recording how much of
+    `csv_file` has been read after each batch and the number of rows once
+    they have all been loaded
+    """
     RowModel = get_import_row_model(ie.import_type)
-    rows = []
+    fields = [f for f in RowModel._meta.concrete_fields if not f.primary_key]
+    copy_sql = _SQL_COPY_ROWS % {
+        'row_table': RowModel._meta.db_table,
+        'columns': ', '.join(f.column for f in fields)
+    }
+
+    # Take the values of the other columns from an unsaved row
+    template = RowModel(import_event=ie)
+
+    buf = StringIO()
+    writer = csv.writer(buf)
     idx = 0
 
+    def copy_batch():
+        buf.seek(0)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(copy_sql, buf)
+        buf.seek(0)
+        buf.truncate()
+
+        ie.bytes_loaded = csv_file.tell()
+        ie.update_progress_timestamp_and_save()
+
     for row in reader:
         data = clean_row_data(row)
         if len(filter(None, data.values())) > 0:  # skip blank rows
-            data = json.dumps(data)
-            rows.append(RowModel(data=data, import_event=ie, idx=idx))
+            template.idx = idx
+            template.data = json.dumps(data)
+            writer.writerow([_copy_value(getattr(template, f.attname))
+                             for f in fields])
 
             idx += 1
-            if ((int(idx / settings.IMPORT_BATCH_SIZE) *
-                 settings.IMPORT_BATCH_SIZE == idx)):
-                RowModel.objects.bulk_create(rows)
-                rows = []
+            if idx % settings.IMPORT_COPY_BATCH_SIZE == 0:
+                copy_batch()
+
+    if idx % settings.IMPORT_COPY_BATCH_SIZE != 0:
+        copy_batch()  # copy final partial batch
 
-    if rows:
-        RowModel.objects.bulk_create(rows)  # create final partial block
+    ie.loaded_row_count = idx
+    ie.bytes_loaded = ie.file_size
+    ie.save()
 
 
 @shared_task()
@@ -139,8 +178,11 @@ def _assure_status_is_at_least_verifying(ie):
 def _validate_rows(import_type, import_event_id, start_row_id):
     ie = _get_import_event(import_type, import_event_id)
     rows = ie.rows()[start_row_id:(start_row_id+settings.IMPORT_BATCH_SIZE)]
-    for row in rows:
-        row.validate_row()
+    if import_type == TreeImportEvent.import_type:
+        TreeImportRow.validate_rows(rows)
+    else:
+        for row in rows:
+            row.validate_row()
     ie.update_progress_timestamp_and_save()
 
 
@@ -162,9 +204,10 @@ def _finalize_validation(import_type, import_event_id):
 def commit_import_event(import_type, import_event_id):
     ie = _get_import_event(import_type, import_event_id)
 
+    batch_size = _get_commit_batch_size(import_type)
     commit_tasks = [
         _commit_rows.s(import_type, import_event_id, i)
-        for i in xrange(0, ie.row_count, settings.IMPORT_BATCH_SIZE)]
+        for i in xrange(0, ie.row_count, batch_size)]
 
     finalize_task = _finalize_commit.si(import_type, import_event_id)
 
@@ -182,11 +225,31 @@ def commit_import_event(import_type, import_event_id):
 def _commit_rows(import_type, import_event_id, i):
     ie = _get_import_event(import_type, import_event_id)
 
-    for row in ie.rows()[i:(i + settings.IMPORT_BATCH_SIZE)]:
-        row.commit_row()
+    rows = list(ie.rows()[i:(i + _get_commit_batch_size(import_type))])
+    if _use_bulk_commit(import_type):
+        TreeImportRow.commit_rows(rows)
+    else:
+        for row in rows:
+            row.commit_row()
+
+    if import_type == TreeImportEvent.import_type:
+        update_hide_at_zoom_after_bulk_move(
+            ie.instance, [row.moved_plot for row in rows if row.moved_plot])
+
     ie.update_progress_timestamp_and_save()
 
 
+def _use_bulk_commit(import_type):
+    return (import_type == TreeImportEvent.import_type and
+            settings.IMPORT_BULK_COMMIT)
+
+
+def _get_commit_batch_size(import_type):
+    if _use_bulk_commit(import_type):
+        return settings.IMPORT_BULK_COMMIT_BATCH_SIZE
+    return settings.IMPORT_BATCH_SIZE
+
+
 @shared_task()
 def _finalize_commit(import_type, import_event_id):
     ie = _get_import_event(import_type, import_event_id)
@@ -203,6 +266,22 @@ def _finalize_commit(import_type, import_event_id):
     ie.instance.update_revs(*rev_updates)
 
 
+def _copy_value(value):
+    if value is None:
+        return r'\N'
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+_SQL_COPY_ROWS = r"""
+    COPY %(row_table)s (%(columns)s)
+    FROM STDIN WITH (FORMAT csv, NULL '\N', ENCODING 'UTF8')
+    """
+
+
 def _get_import_event(import_type, import_event_id):
     Model = get_import_event_model(import_type)
     try:
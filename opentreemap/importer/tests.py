@@ -291,6 +291,85 @@ class TreeValidationTest(TreeValidationTestBase):
         self.assertNotHasError(r2, errors.NEARBY_TREES)
         self.assertEqual(after_r2_count, 2)
 
+    def test_validate_rows_batch(self):
+        p1 = mkPlot(self.instance, self.user,
+                    geom=Point(25.0000001, 25.0000001, srid=4326))
+        Species(instance=self.instance, genus='g1', species='s1',
+                cultivar='').save_with_system_user_bypass_auth()
+
+        duplicate = self.mkrow({'point x': '25.0000001',
+                                'point y': '25.0000001'}, idx=1)
+        moved = self.mkrow({'point x': '25.0000001',
+                            'point y': '25.0000001',
+                            'planting site id': p1.id}, idx=2)
+        bad_plot = self.mkrow({'point x': '25.01',
+                               'point y': '25.01',
+                               'planting site id': p1.id + 1000}, idx=3)
+        species = self.mkrow({'point x': '25.02',
+                              'point y': '25.02',
+                              'genus': 'G1',
+                              'species': 'S1'}, idx=4)
+        bad_species = self.mkrow({'point x': '25.03',
+                                  'point y': '25.03',
+                                  'genus': 'g2'}, idx=5)
+
+        results = TreeImportRow.validate_rows(
+            [duplicate, moved, bad_plot, species, bad_species])
+
+        self.assertEqual([False, True, False, True, False], results)
+        self.assertHasError(duplicate, errors.DUPLICATE_TREE)
+        self.assertNotHasError(moved, errors.DUPLICATE_TREE)
+        self.assertHasError(bad_plot, errors.INVALID_PLOT_ID)
+        self.assertEqual(
+            'g1', species.cleaned[fields.trees.SPECIES_OBJECT].genus)
+        self.assertHasError(bad_species, errors.INVALID_SPECIES)
+
+        saved = TreeImportRow.objects.get(pk=bad_species.pk)
+        self.assertEqual(TreeImportRow.ERROR, saved.status)
+        self.assertEqual(bad_species.errors, saved.errors)
+
+    def test_commit_rows_bulk(self):
+        p1 = mkPlot(self.instance, self.user,
+                    geom=Point(25.003, 25.003, srid=4326))
+        Species(instance=self.instance, genus='g1', species='s1',
+                cultivar='').save_with_system_user_bypass_auth()
+
+        new_with_tree = self.mkrow({'point x': '25.001',
+                                    'point y': '25.001',
+                                    'genus': 'g1',
+                                    'species': 's1',
+                                    'diameter': '12'}, idx=1)
+        new_without_tree = self.mkrow({'point x': '25.002',
+                                       'point y': '25.002',
+                                       'tree present': 'false'}, idx=2)
+        existing = self.mkrow({'point x': '25.003',
+                               'point y': '25.003',
+                               'planting site id': p1.id,
+                               'diameter': '4'}, idx=3)
+
+        TreeImportRow.commit_rows([new_with_tree, new_without_tree, existing])
+
+        rows = TreeImportRow.objects.filter(import_event=self.ie)
+        self.assertEqual({TreeImportRow.SUCCESS},
+                         {row.status for row in rows})
+        self.assertEqual(3, Plot.objects.filter(instance=self.instance)
+                                        .count())
+
+        plot = TreeImportRow.objects.get(pk=new_with_tree.pk).plot
+        tree = plot.current_tree()
+        self.assertEqual(12, tree.diameter)
+        self.assertEqual('g1', tree.species.genus)
+        self.assertEqual(self.user, plot.updated_by)
+        self.assertTrue(plot.audits().filter(field='id').exists())
+        self.assertTrue(tree.audits().filter(field='diameter').exists())
+
+        plot = TreeImportRow.objects.get(pk=new_without_tree.pk).plot
+        self.assertIsNone(plot.current_tree())
+
+        self.assertEqual(p1.id, TreeImportRow.objects.get(pk=existing.pk)
+                                            .plot_id)
+        self.assertEqual(4, p1.current_tree().diameter)
+
     def test_species_id(self):
         s1_gsc = Species(instance=self.instance, genus='g1', species='s1',
                          cultivar='c1')
@@ -920,6 +999,30 @@ class FileLevelTreeValidationTest(ValidationTest):
         self.assertTrue(len(ierrors), 1)
         self.assertHasError(ie, errors.EMPTY_FILE)
 
+    def test_rows_loaded(self):
+        ie = TreeImportEvent(file_name='file', owner=self.user,
+                             instance=self.instance)
+        ie.save()
+
+        c = self.write_csv([['point x', 'point y', 'street address'],
+                            ['5', '5', '123 "Beach", St'],
+                            ['', '', ''],
+                            ['8', '8', '']])
+
+        rslt = _create_rows_for_event(ie, c)
+
+        self.assertTrue(rslt)
+        self.assertEqual(2, ie.loaded_row_count)
+        self.assertEqual(ie.file_size, ie.bytes_loaded)
+
+        rows = list(ie.rows())
+        self.assertEqual([0, 1], [row.idx for row in rows])
+        self.assertEqual('123 "Beach", St',
+                         rows[0].datadict['street address'])
+        self.assertEqual(TreeImportRow.WAITING, rows[1].status)
+        self.assertEqual('', rows[1].errors)
+        self.assertIsNone(rows[1].plot)
+
     def test_missing_point_field(self):
         ie = TreeImportEvent(file_name='file', owner=self.user,
                              instance=self.instance)
@@ -19,6 +19,12 @@ function ModelingUrls(urls) {
                 instanceUrl,
                 util.format('modeling/plans/%d/', planId)
             );
+        },
+        modelRunUrl: function(runId) {
+            return url.resolve(
+                instanceUrl,
+                util.format('modeling/run/%d/', runId)
+            );
         }
     });
 
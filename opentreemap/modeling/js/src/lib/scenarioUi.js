@@ -60,6 +60,8 @@ var templates = {
     disambiguateArea: '#disambiguate-area-tmpl'
 };
 
+var MODEL_RUN_POLL_INTERVAL = 1000;  // ms
+
 var _state = null,
     _strings = null,
     _urls = null,
@@ -609,7 +611,8 @@ function calculateScenario(data) {
     scenarioResults.clear();
 
     var resultsStream = BU.jsonRequest(
-            'POST', _urls.calculateScenarioUrl())(data.scenario);
+            'POST', _urls.calculateScenarioUrl())(data.scenario)
+        .flatMap(waitForModelRun);
 
     resultsStream.onError(function (xhr) {
         $calculateScenario.prop('disabled', false);
@@ -627,6 +630,27 @@ function calculateScenario(data) {
     });
 }
 
+// Model runs happen in the background. Poll until the run finishes and
+// return a stream of its results (or an error if it failed).
+function waitForModelRun(modelRun) {
+    function isFinished(run) {
+        return run.status === 'COMPLETE' || run.status === 'FAILED';
+    }
+
+    var runStream = isFinished(modelRun) ? Bacon.once(modelRun) :
+        Bacon.interval(MODEL_RUN_POLL_INTERVAL)
+            .flatMapFirst(function () {
+                return BU.getJsonFromUrl(_urls.modelRunUrl(modelRun.run_id));
+            })
+            .filter(isFinished)
+            .take(1);
+
+    return runStream.flatMap(function (run) {
+        return run.status === 'COMPLETE' ?
+            Bacon.once(run.results) : new Bacon.Error(run.error);
+    });
+}
+
 // Return a stream that will emit a LatLng if the user successfully
 // placed a map marker.
 function placeMarker(message) {
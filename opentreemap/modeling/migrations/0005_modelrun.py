@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import treemap.json_field
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('treemap', '0048_mapfeature_itree_region_code'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('modeling', '0004_plan_revision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ModelRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('input_hash', models.CharField(db_index=True, max_length=64)),
+                ('model_params', treemap.json_field.JSONField()),
+                ('scenario', treemap.json_field.JSONField()),
+                ('language', models.CharField(blank=True, max_length=10)),
+                ('status', models.IntegerField(choices=[(0, 'PENDING'), (1, 'RUNNING'), (2, 'COMPLETE'), (-1, 'FAILED')], default=0)),
+                ('progress', models.IntegerField(default=0)),
+                ('results', treemap.json_field.JSONField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('instance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='treemap.Instance')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
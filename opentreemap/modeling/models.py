@@ -55,3 +55,53 @@ class Plan(models.Model):
 
     def __unicode__(self):
         return self.name
+
+
+class ModelRun(models.Model):
+    """
+    A run of the growth and mortality model and of the ecoservice scenario
+    for one scenario. Runs happen in a Celery task; "input_hash" identifies
+    everything the results depend on, so a request with the same inputs
+    can be answered from an earlier run.
+    """
+    FAILED = -1
+    PENDING = 0
+    RUNNING = 1
+    COMPLETE = 2
+
+    STATUS_STRINGS = {
+        FAILED: 'FAILED',
+        PENDING: 'PENDING',
+        RUNNING: 'RUNNING',
+        COMPLETE: 'COMPLETE',
+    }
+
+    instance = models.ForeignKey(Instance)
+    user = models.ForeignKey(User, null=True, blank=True)
+    input_hash = models.CharField(max_length=64, db_index=True)
+    model_params = JSONField()
+    scenario = JSONField()
+    language = models.CharField(max_length=10, blank=True)
+    status = models.IntegerField(choices=STATUS_STRINGS.items(),
+                                 default=PENDING)
+    # Percent complete
+    progress = models.IntegerField(default=0)
+    results = JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    modified = models.DateTimeField(auto_now=True, editable=False)
+
+    def set_progress(self, progress, status=RUNNING):
+        self.progress = progress
+        self.status = status
+        ModelRun.objects.filter(pk=self.pk).update(progress=progress,
+                                                   status=status)
+
+    def to_json(self):
+        return {
+            'run_id': self.id,
+            'status': self.STATUS_STRINGS[self.status],
+            'progress': self.progress,
+            'results': self.results if self.status == self.COMPLETE else None,
+            'error': self.error or None,
+        }
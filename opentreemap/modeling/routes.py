@@ -13,7 +13,8 @@ from treemap.decorators import (instance_request, json_api_edit,
 
 from modeling.views import (get_plans_context, get_modeling_context,
                             add_plan, update_plan, delete_plan, get_plan,
-                            run_model, get_boundaries_at_point)
+                            run_model, get_model_run,
+                            get_boundaries_at_point)
 
 
 def modeling_instance_request(view_fn, redirect=True):
@@ -44,6 +45,13 @@ run_model_view = do(
     run_model)
 
 
+model_run_view = do(
+    login_or_401,
+    json_api_call,
+    modeling_instance_request,
+    get_model_run)
+
+
 plan_view = do(
     login_or_401,
     modeling_instance_request,
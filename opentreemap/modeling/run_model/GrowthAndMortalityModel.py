@@ -4,7 +4,6 @@ from __future__ import unicode_literals
 from __future__ import division
 
 import random
-from copy import copy
 
 from jsonschema import validate
 
@@ -91,59 +90,127 @@ class GrowthAndMortalityModel(object):
         # Use a fixed seed so results will be repeatable
         random.seed(42)
 
-        # Build list of live trees
-        live_trees = [Tree(self.growth_model, self.mortality_model, spec=spec)
-                      for spec in tree_specs]
+        simulation = _CohortSimulation(self.growth_model,
+                                       self.mortality_model, n_years)
+        for spec in tree_specs:
+            simulation.plant(spec)
         for group in group_specs:
-            live_trees += self._make_trees_for_group(group)
-
-        for i, tree in enumerate(live_trees):
-            tree.id = i
-
-        return self._growth_kill_cycle(
-            n_years, n_replant_years, live_trees)
-
-    # ------------------------------------------------------------------------
-    # Create trees
-
-    def _make_trees_for_group(self, spec):
-        n_trees = int(spec['count'])
-        trees = [
-            Tree(self.growth_model, self.mortality_model, spec=spec)
-            for i in range(n_trees)
-        ]
-        return trees
-
-    # ------------------------------------------------------------------------
-    # Run model
+            for i in range(int(group['count'])):
+                simulation.plant(group)
+
+        return simulation.run(n_replant_years)
+
+
+class _CohortSimulation(object):
+    """
+    Simulates trees by cohort rather than one Tree object at a time.
+
+    Trees with the same species, initial diameter and year planted grow
+    identically, so each cohort's diameters are computed once for the whole
+    simulation. Each simulated tree is then just a cohort index, and is
+    turned into a Tree object when the simulation ends.
+
+    Trees are kept in planting order and killed with the same sequence of
+    random numbers as killing Tree objects one year at a time, so results
+    are identical.
+    """
+
+    def __init__(self, growth_model, mortality_model, n_years):
+        self.growth_model = growth_model
+        self.mortality_model = mortality_model
+        self.n_years = n_years
+
+        # Per cohort
+        self.cohort_index = {}
+        self.prototypes = []
+        self.names = []
+
+        # Per planted tree
+        self.cohorts = []
+        self.death_years = []
+
+    def plant(self, spec, year_planted=0):
+        # Django model instances without a pk can't be hashed
+        key = (id(spec['species']), spec['diameter'], spec.get('name'),
+               year_planted)
+        cohort = self.cohort_index.get(key)
+        if cohort is None:
+            cohort = len(self.prototypes)
+            self.cohort_index[key] = cohort
+            self.prototypes.append(self._grow_prototype(spec, year_planted))
+            self.names.append(spec.get('name'))
+
+        self.cohorts.append(cohort)
+        self.death_years.append(None)
+        return len(self.cohorts) - 1
+
+    def _grow_prototype(self, spec, year_planted):
+        tree = Tree(self.growth_model, self.mortality_model, spec=spec,
+                    year_planted=year_planted)
+        for year in range(year_planted + 1, self.n_years + 1):
+            self.growth_model.grow_tree(tree, year)
+        return tree
+
+    def _diameter_at_start_of(self, cohort, year):
+        prototype = self.prototypes[cohort]
+        n_grown = year - 1 - prototype.year_planted
+        if n_grown == 0:
+            return prototype.initial_diameter
+        else:
+            return prototype.yearly_diameters[n_grown - 1]
 
-    def _growth_kill_cycle(self, n_years, n_replant_years,
-                           live_trees):
-        planted_trees = copy(live_trees)
+    def run(self, n_replant_years):
+        # Replanted trees have no id
+        self.n_initial_trees = len(self.cohorts)
+        live_trees = range(self.n_initial_trees)
         yearly_counts = [len(live_trees)]
         remainders = {}
 
-        for year in range(1, n_years + 1):
+        for year in range(1, self.n_years + 1):
             # Select and kill trees
-            live_trees, dead_trees, remainders = self.mortality_model \
-                .kill_trees(live_trees, remainders)
-
-            # Add growth to living trees
-            for tree in live_trees:
-                self.growth_model.grow_tree(tree, year)
+            category_keys = [
+                self.mortality_model.category_key(
+                    prototype.species.otm_code,
+                    self._diameter_at_start_of(cohort, year))
+                for cohort, prototype in enumerate(self.prototypes)]
+            keys = [category_keys[self.cohorts[i]] for i in live_trees]
+            killed, remainders = self.mortality_model.choose_trees_to_kill(
+                keys, remainders)
+
+            dead_trees = [live_trees[i] for i in sorted(killed)]
+            live_trees = [t for i, t in enumerate(live_trees)
+                          if i not in killed]
+            for i in dead_trees:
+                self.death_years[i] = year
+
+            # Growth of living trees is already in their cohort's diameters
 
             # Replant
             if year <= n_replant_years:
-                new_trees = self._replant(dead_trees, year)
-                planted_trees.extend(new_trees)
-                live_trees.extend(new_trees)
+                for i in dead_trees:
+                    spec = self.prototypes[self.cohorts[i]]
+                    live_trees.append(self.plant({
+                        'name': self.names[self.cohorts[i]],
+                        'species': spec.species,
+                        'diameter': spec.initial_diameter,
+                    }, year))
 
             yearly_counts.append(len(live_trees))
 
-        return yearly_counts, planted_trees
-
-    def _replant(self, dead_trees, year):
-        new_trees = [Tree(self.growth_model, self.mortality_model, tree=tree,
-                          year_planted=year)
-                     for tree in dead_trees]
-        return new_trees
+        return yearly_counts, self._planted_trees()
+
+    def _planted_trees(self):
+        planted_trees = []
+        for i, cohort in enumerate(self.cohorts):
+            prototype = self.prototypes[cohort]
+            death_year = self.death_years[i]
+            last_year = self.n_years if death_year is None else death_year - 1
+
+            tree = Tree.__new__(Tree)
+            tree.__dict__.update(prototype.__dict__)
+            tree.id = i if i < self.n_initial_trees else None
+            tree.is_alive = death_year is None
+            tree.yearly_diameters = \
+                prototype.yearly_diameters[:last_year - prototype.year_planted]
+            planted_trees.append(tree)
+        return planted_trees
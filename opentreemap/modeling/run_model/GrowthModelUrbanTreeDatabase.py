@@ -9,7 +9,7 @@ from operator import itemgetter
 
 from math import exp, log, sqrt
 
-from treemap.models import Species
+from treemap.lib.object_caches import species_resolver
 from treemap.species import species_for_otm_code
 
 
@@ -103,9 +103,8 @@ def _get_species_for_planting(instance):
     species = [species_for_otm_code(otm_code) for otm_code in otm_codes]
     species = sorted(species, key=itemgetter('common_name'))
 
-    def can_get_species(otm_code):
-        return Species.get_by_code(instance, otm_code, itree_region.code) is not None
-    species = [s for s in species if can_get_species(s['otm_code'])]
+    get_species = species_resolver(instance, itree_region.code)
+    species = [s for s in species if get_species(s['otm_code']) is not None]
 
     return species
 
@@ -80,7 +80,35 @@ class MortalityModelUrbanTreeDatabase(object):
     #   2        46         2.3 + 0.4          3          -0.3
 
     def kill_trees(self, trees, remainders):
-        categories = self._categorize(trees)
+        keys = [self.category_key(tree.species.otm_code, tree.diameter)
+                for tree in trees]
+        killed, new_remainders = self.choose_trees_to_kill(keys, remainders)
+
+        for i in killed:
+            trees[i].is_alive = False
+
+        live_trees = [t for t in trees if t.is_alive]
+        dead_trees = [t for t in trees if not t.is_alive]
+
+        return live_trees, dead_trees, new_remainders
+
+    def category_key(self, otm_code, diameter):
+        return (otm_code, self._get_diameter_index(diameter))
+
+    def choose_trees_to_kill(self, keys, remainders):
+        """
+        Given the category key of each live tree, choose trees to kill.
+        Returns the set of positions (in "keys") of the chosen trees and the
+        new remainders.
+        """
+        categories = {}
+        for i, key in enumerate(keys):
+            if key not in categories:
+                mortality = self._get_mortality(*key)
+                categories[key] = self.Category(mortality)
+            categories[key].trees.append(i)
+
+        killed = set()
         new_remainders = {}
         for key, c in categories.iteritems():
             remainder = remainders.get(key, 0)
@@ -88,37 +116,19 @@ class MortalityModelUrbanTreeDatabase(object):
             int_to_kill = int(round(float_to_kill))
             new_remainders[key] = float_to_kill - int_to_kill
 
-            for i in range(0, int_to_kill):
-                index = int(random() * len(c.trees))
-                tree = c.trees.pop(index)
-                tree.is_alive = False
-
-        live_trees = [t for t in trees if t.is_alive]
-        dead_trees = [t for t in trees if not t.is_alive]
+            killed.update(_pop_random_items(c.trees, int_to_kill))
 
-        return live_trees, dead_trees, new_remainders
+        return killed, new_remainders
 
     class Category(object):
         def __init__(self, mortality):
             self.trees = []
             self.mortality = mortality / 100.0
 
-    def _categorize(self, trees):
-        categories = {}
-        for tree in trees:
-            otm_code = tree.species.otm_code
-            index = self._get_diameter_index(tree)
-            key = (otm_code, index)
-            if key not in categories:
-                mortality = self._get_mortality(otm_code, index)
-                categories[key] = self.Category(mortality)
-            categories[key].trees.append(tree)
-        return categories
-
-    def _get_diameter_index(self, tree):
+    def _get_diameter_index(self, diameter):
         i = 0
         while i < len(DIAMETER_BREAKS):
-            if tree.diameter <= DIAMETER_BREAKS[i]:
+            if diameter <= DIAMETER_BREAKS[i]:
                 return i
             i += 1
         return i
@@ -134,3 +144,47 @@ class MortalityModelUrbanTreeDatabase(object):
 
         raise Exception('Mortality rate mode not supported "{}"'
                         .format(self.mode))
+
+
+def _pop_random_items(items, n_to_pop):
+    """
+    Return the items that calling items.pop(int(random() * len(items)))
+    n_to_pop times would return (without modifying "items").
+
+    Remaining items are counted in a binary indexed tree, so finding and
+    removing each one takes O(log n) rather than the O(n) of list.pop().
+    """
+    size = len(items)
+    n_to_pop = min(n_to_pop, size)
+    if n_to_pop <= 0:
+        return []
+
+    # counts[i] is the number of remaining items in 1-based positions
+    # (i - lowbit(i), i], which is lowbit(i) before any are popped
+    counts = [i & -i for i in range(size + 1)]
+
+    top_step = 1
+    while top_step * 2 <= size:
+        top_step *= 2
+
+    popped = []
+    for n_left in range(size, size - n_to_pop, -1):
+        rank = int(random() * n_left) + 1
+
+        # Find the position of the remaining item with this rank
+        position = 0
+        step = top_step
+        while step:
+            next_position = position + step
+            if next_position <= size and counts[next_position] < rank:
+                position = next_position
+                rank -= counts[next_position]
+            step //= 2
+        popped.append(items[position])
+
+        i = position + 1
+        while i <= size:
+            counts[i] -= 1
+            i += i & -i
+
+    return popped
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import logging
+
+from celery import shared_task
+
+from opentreemap.util import add_rollbar_handler
+
+from modeling.models import ModelRun
+from modeling.views import execute_model_run
+
+
+logger = logging.getLogger(__name__)
+add_rollbar_handler(logger, level=logging.INFO)
+
+
+@shared_task
+def run_model_task(model_run_pk):
+    model_run = ModelRun.objects.get(pk=model_run_pk)
+    model_run.set_progress(0, ModelRun.RUNNING)
+    try:
+        execute_model_run(model_run)
+    except Exception as e:
+        logger.exception('Model run %s failed' % model_run_pk)
+        model_run.status = ModelRun.FAILED
+        model_run.error = unicode(e) or e.__class__.__name__
+        model_run.save()
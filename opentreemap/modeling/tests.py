@@ -1,20 +1,27 @@
 
 from django.http import Http404, HttpResponse
 import json
+import random
 
 from django.test import SimpleTestCase
 from django.core.exceptions import PermissionDenied
 
+from treemap import ecobackend
 from treemap.models import Species
 from treemap.tests import make_request, make_instance, make_plain_user
 from treemap.tests.base import OTMTestCase
 
-from modeling.models import Plan
+from modeling.models import Plan, ModelRun
+from modeling.tasks import run_model_task
 from modeling.views import (add_plan, get_plan,
-                            update_plan, delete_plan, get_plans_context)
+                            update_plan, delete_plan, get_plans_context,
+                            get_model_run, _get_reusable_model_run,
+                            _model_run_hash,
+                            _model_trees_to_eco_cohorts, _eco_scenario)
 from modeling.run_model.GrowthAndMortalityModel import GrowthAndMortalityModel
 from modeling.run_model.GrowthModelUrbanTreeDatabase import bisect
-from modeling.run_model.MortalityModelUrbanTreeDatabase import DIAMETER_BREAKS
+from modeling.run_model.MortalityModelUrbanTreeDatabase import (
+    DIAMETER_BREAKS, _pop_random_items)
 
 
 class TestPlanCrud(OTMTestCase):
@@ -205,6 +212,132 @@ class TestGrowthModel(OTMTestCase):
         return planted_trees
 
 
+class TestModelRuns(OTMTestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.user = make_plain_user('a', 'a')
+
+    def _make_run(self, status, input_hash='abc'):
+        return ModelRun.objects.create(
+            instance=self.instance, user=self.user, input_hash=input_hash,
+            model_params={}, scenario={}, status=status)
+
+    def test_reuses_complete_run(self):
+        self._make_run(ModelRun.FAILED)
+        run = self._make_run(ModelRun.COMPLETE)
+        self._make_run(ModelRun.PENDING)
+        self.assertEqual(_get_reusable_model_run(self.instance, 'abc'), run)
+
+    def test_reuses_run_in_progress(self):
+        run = self._make_run(ModelRun.RUNNING)
+        self.assertEqual(_get_reusable_model_run(self.instance, 'abc'), run)
+
+    def test_does_not_reuse_failed_or_other_runs(self):
+        self._make_run(ModelRun.FAILED)
+        self._make_run(ModelRun.COMPLETE, input_hash='def')
+        self.assertIsNone(_get_reusable_model_run(self.instance, 'abc'))
+
+    def test_hash_ignores_unrelated_config(self):
+        def run_hash():
+            prepared_scenario = {'trees': [], 'groups': [], 'years': 5}
+            return _model_run_hash(self.instance, {}, {}, prepared_scenario,
+                                   'NoEastXXX')
+
+        input_hash = run_hash()
+        self.instance.config['hide_at_zoom_geo_rev'] = 10
+        self.assertEqual(input_hash, run_hash())
+
+        self.instance.config['value_display'] = {
+            'tree': {'diameter': {'units': 'cm'}}}
+        self.assertNotEqual(input_hash, run_hash())
+
+    def test_failed_run_is_reported(self):
+        run = ModelRun.objects.create(
+            instance=self.instance, user=self.user, input_hash='abc',
+            model_params={'growth': {'model_name': 'foo', 'params': {}}},
+            scenario={})
+        run_model_task.delay(run.pk)
+
+        result = get_model_run(make_request(user=self.user), self.instance,
+                               run.pk)
+        self.assertEqual(result['status'], 'FAILED')
+        self.assertIsNone(result['results'])
+        self.assertIn('foo', result['error'])
+
+
+def _per_tree_eco(eco_trees, n_years):
+    # Benefits an eco_scenario.json stand-in gives a list of trees: one
+    # value per year, derived from each tree's diameter that year
+    years = [{'energy': sum(t['diameters'][year] for t in eco_trees),
+              'co2': sum(2 * t['diameters'][year] + 1 for t in eco_trees)}
+             for year in range(n_years)]
+    total = {key: sum(year[key] for year in years) for key in years[0]}
+    return {'Total': total, 'Years': years}
+
+
+class TestEcoScenario(OTMTestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.n_years = 3
+        self.calls = []
+
+        def fake_eco_scenario(endpoint, params, post, convert_params):
+            self.calls.append(params['scenario_trees'])
+            return _per_tree_eco(params['scenario_trees'], self.n_years), None
+
+        self.orig_benefits_fn = ecobackend.json_benefits_call
+        ecobackend.json_benefits_call = fake_eco_scenario
+
+    def tearDown(self):
+        ecobackend.json_benefits_call = self.orig_benefits_fn
+
+    def _cohort(self, otm_code, diameter, count):
+        eco_tree = {'otmcode': otm_code, 'species_id': 1,
+                    'region': 'NoEastXXX',
+                    'diameters': [diameter + 0.5 * year
+                                  for year in range(self.n_years)]}
+        return eco_tree, count
+
+    def assert_scenario_matches_per_tree_eco(self, cohorts, expected_calls):
+        eco = _eco_scenario(self.instance, 'NoEastXXX', self.n_years,
+                            cohorts)
+
+        self.assertEqual(expected_calls, len(self.calls))
+        every_tree = [eco_tree for eco_tree, count in cohorts
+                      for __ in range(count)]
+        expected = _per_tree_eco(every_tree, self.n_years)
+        for key, value in expected['Total'].iteritems():
+            self.assertAlmostEqual(value, eco['Total'][key])
+        self.assertEqual(self.n_years, len(eco['Years']))
+        for year, expected_year in zip(eco['Years'], expected['Years']):
+            for key, value in expected_year.iteritems():
+                self.assertAlmostEqual(value, year[key])
+
+    def test_single_cohorts(self):
+        for count in (1, 3, 20):
+            self.calls = []
+            self.assert_scenario_matches_per_tree_eco(
+                [self._cohort('ACRU', 10, count)], expected_calls=1)
+
+    def test_groups_by_count(self):
+        # Powers of two would need calls for 1, 2, 4 and 16
+        self.assert_scenario_matches_per_tree_eco(
+            [self._cohort('ACRU', 10, 1), self._cohort('GLTR', 4, 3),
+             self._cohort('QURU', 7, 20)],
+            expected_calls=3)
+
+    def test_groups_by_powers_of_two(self):
+        # Counts would need calls for 1, 2 and 3
+        self.assert_scenario_matches_per_tree_eco(
+            [self._cohort('ACRU', 10, 1), self._cohort('GLTR', 4, 2),
+             self._cohort('QURU', 7, 3)],
+            expected_calls=2)
+
+    def test_empty_scenario(self):
+        self.assert_scenario_matches_per_tree_eco([], expected_calls=1)
+        self.assertEqual([[]], self.calls)
+
+
 class TestBisect(SimpleTestCase):
     def setUp(self):
         self.choices = range(10)
@@ -254,6 +387,24 @@ class TestBisect(SimpleTestCase):
         self.assert_bisect_exception(1.5)
 
 
+class TestPopRandomItems(SimpleTestCase):
+    def _pop_with_list(self, items, n_to_pop):
+        items = list(items)
+        return [items.pop(int(random.random() * len(items)))
+                for i in range(n_to_pop)]
+
+    def test_same_as_list_pop(self):
+        items = range(1000)
+        for n_to_pop in (0, 1, 17, 500, 1000):
+            random.seed(n_to_pop)
+            expected = self._pop_with_list(items, n_to_pop)
+            random.seed(n_to_pop)
+            self.assertEqual(_pop_random_items(items, n_to_pop), expected)
+
+    def test_pop_more_than_available(self):
+        self.assertEqual(sorted(_pop_random_items([1, 2, 3], 5)), [1, 2, 3])
+
+
 class TestGrowthModelUrbanTreeDatabase(TestGrowthModel):
     # Parameters for our test tree, a Honeylocust in GulfCoCHS:
     #   age_to_diameter() is a quadratic function
@@ -475,3 +626,36 @@ class TestGrowthAndMortalityModel(TestGrowthModel):
         self.assertEqual(len(planted_trees), 16)
         for tree in planted_trees:
             self.assertEqual(tree.initial_diameter, 10)
+
+    def test_replanted_tree_diameters(self):
+        self.add_group(8, species=self.maple, diameter=10)
+        self.scenario['years'] = 3
+        self.scenario['replant_years'] = 1
+        self.model_params['mortality']['params']['default'] = 100
+        growth_model = GrowthAndMortalityModel(self.model_params,
+                                               self.instance)
+        __, planted_trees = growth_model.run(self.scenario)
+
+        original, replanted = planted_trees[0], planted_trees[8]
+        self.assertEqual(original.id, 0)
+        self.assertEqual(original.diameters_for_export(), [10])
+        self.assertIsNone(replanted.id)
+        self.assertEqual(replanted.year_planted, 1)
+        self.assertEqual(replanted.diameters_for_export(), [0, 10])
+        self.assertFalse(replanted.is_alive)
+
+    def test_eco_cohorts(self):
+        self.add_group(20, species=self.maple, diameter=10)
+        self.add_group(5, species=self.honeylocust, diameter=10)
+        self.add_tree(10, self.maple)
+        self.scenario['years'] = 3
+        self.model_params['mortality']['params']['default'] = 0
+        planted_trees = self.run_model(expected_n_trees=26,
+                                       expected_n_years=3)
+
+        cohorts = _model_trees_to_eco_cohorts(planted_trees, 'GulfCoCHS')
+
+        self.assertEqual([(t['otmcode'], count) for t, count in cohorts],
+                         [('ACRU', 21), ('GLTR', 5)])
+        self.assertEqual(cohorts[0][0]['diameters'],
+                         planted_trees[0].diameters_for_eco())
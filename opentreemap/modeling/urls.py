@@ -6,7 +6,7 @@ from __future__ import division
 from django.conf.urls import url
 
 from opentreemap.urls import instance_pattern
-from modeling.routes import (run_model_view,
+from modeling.routes import (run_model_view, model_run_view,
                              modeling_view,
                              get_boundaries_at_point_view,
                              plans_view, plan_view)
@@ -23,4 +23,6 @@ urlpatterns = [
         get_boundaries_at_point_view, name='boundaries_at_point'),
     url(r'%s/modeling/run/$' % instance_pattern, run_model_view,
         name='run_model'),
+    url(r'%s/modeling/run/(?P<run_id>\d+)/$' % instance_pattern,
+        model_run_view, name='model_run'),
 ]
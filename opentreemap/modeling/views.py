@@ -11,21 +11,29 @@ from django.db import transaction
 from django.http import HttpResponse, Http404
 from django.shortcuts import get_object_or_404
 from django.contrib.gis.geos import Point
+from django.utils import timezone, translation
 from django.utils.translation import ugettext_lazy as _
 
+from django_tinsel.utils import LazyEncoder
+
+import hashlib
 import json
 import logging
+from collections import OrderedDict
+from datetime import timedelta
 
 import itertools
 
 from treemap import ecobackend
 from treemap.ecobenefits import compute_currency_and_transform_units
+from treemap.ecocache import get_itree_code_override_rev
 from treemap.lib import format_benefits
-from treemap.models import Species, Boundary
+from treemap.lib.object_caches import species_resolver
+from treemap.models import Boundary
 from treemap.units import (get_units, storage_to_instance_units_factor)
 
 from modeling.run_model.GrowthAndMortalityModel import GrowthAndMortalityModel
-from modeling.models import Plan
+from modeling.models import Plan, ModelRun
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -166,29 +174,123 @@ def delete_plan(request, instance, plan_id):
 
 
 def run_model(request, instance):
+    from modeling.tasks import run_model_task
+
     params = json.loads(request.body)
 
     model_params = params['model_params']
     scenario = params['scenario_params']
 
-    growth_model = GrowthAndMortalityModel(model_params, instance)
-
+    # Validate the parameters and species before queueing a run
+    GrowthAndMortalityModel(model_params, instance)
+    region_code = _get_region_code(instance)
+    prepared_scenario = _prepare_scenario(scenario, instance, region_code)
+
+    input_hash = _model_run_hash(instance, model_params, scenario,
+                                 prepared_scenario, region_code)
+
+    model_run = _get_reusable_model_run(instance, input_hash)
+    if model_run is None:
+        model_run = ModelRun.objects.create(
+            instance=instance,
+            user=request.user,
+            input_hash=input_hash,
+            model_params=model_params,
+            scenario=scenario,
+            language=translation.get_language() or '')
+        run_model_task.delay(model_run.pk)
+        # Pick up results if the task ran eagerly
+        model_run.refresh_from_db()
+
+    return model_run.to_json()
+
+
+def get_model_run(request, instance, run_id):
+    model_run = get_object_or_404(ModelRun, instance=instance, pk=run_id)
+    return model_run.to_json()
+
+
+def execute_model_run(model_run):
+    """
+    Run the model and ecoservice scenario for a ModelRun, storing the
+    results on it. Called by a Celery task.
+    """
+    instance = model_run.instance
+    with translation.override(model_run.language or None):
+        growth_model = GrowthAndMortalityModel(model_run.model_params,
+                                               instance)
+        region_code = _get_region_code(instance)
+        scenario = _prepare_scenario(model_run.scenario, instance,
+                                     region_code)
+
+        results = _run_model(instance, growth_model, scenario, region_code,
+                             model_run.set_progress)
+
+    # Results contain lazily translated labels
+    model_run.results = json.loads(json.dumps(results, cls=LazyEncoder))
+    model_run.status = ModelRun.COMPLETE
+    model_run.progress = 100
+    model_run.save()
+
+
+def _get_region_code(instance):
     # TODO: look up region code for each tree and group
     # TODO: this will crash if run for an instance outside
     # of the united states
-    region_code = instance.itree_regions()[0].code
+    return instance.itree_regions()[0].code
+
+
+def _model_run_hash(instance, model_params, scenario, prepared_scenario,
+                    region_code):
+    """
+    Hash everything that the results of a model run depend on
+    """
+    species = {spec['species'] for spec in
+               prepared_scenario['trees'] + prepared_scenario['groups']}
+    conversion = instance.eco_benefits_conversion
+    inputs = {
+        'model_params': model_params,
+        'scenario': scenario,
+        'years': prepared_scenario['years'],
+        'region_code': region_code,
+        'species': sorted([s.pk, s.otm_code, s.common_name,
+                           s.scientific_name] for s in species),
+        'itree_code_override_rev': get_itree_code_override_rev(),
+        'eco_benefits_conversion': conversion.hash if conversion else None,
+        # Includes the instance's units and decimal digits
+        'value_display': instance.config.get('value_display', {}),
+        'language': translation.get_language(),
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
 
-    scenario = _prepare_scenario(scenario, instance, region_code)
 
-    return _run_model(instance, growth_model, scenario, region_code)
+def _get_reusable_model_run(instance, input_hash):
+    """
+    Return a completed run with the same inputs, or one that is still in
+    progress and was started recently enough to be expected to finish.
+    """
+    runs = ModelRun.objects \
+        .filter(instance=instance, input_hash=input_hash) \
+        .order_by('-created')
+    started_after = timezone.now() - timedelta(
+        seconds=settings.MODEL_RUN_TIMEOUT_SECONDS)
+    return (runs.filter(status=ModelRun.COMPLETE).first() or
+            runs.filter(status__in=(ModelRun.PENDING, ModelRun.RUNNING),
+                        created__gte=started_after).first())
 
 
 def _prepare_scenario(scenario, instance, region_code):
     cm_to_instance = _cm_to_instance_diameter_units(instance)
     to_cm = 1.0 / cm_to_instance
 
+    species_for_code = species_resolver(instance, region_code)
+    # Resolve each code once, so trees of a species share a Species object
+    species_by_code = {}
+
     def get_species(otm_code, region_code):
-        species = Species.get_by_code(instance, otm_code, region_code)
+        if otm_code in species_by_code:
+            return species_by_code[otm_code]
+        species = species_for_code(otm_code)
         if species is None:
             raise Http404(
                 "Could not find species with OTM code %s in instance %s"
@@ -198,7 +300,7 @@ def _prepare_scenario(scenario, instance, region_code):
         # it so it is available for the downstream code.
         if species.otm_code != otm_code:
             species.otm_code = otm_code
-        print(species.common_name)
+        species_by_code[otm_code] = species
         return species
 
     def prepare_tree(tree):
@@ -256,25 +358,17 @@ def get_boundaries_at_point(request, instance):
     return boundaries
 
 
-def _run_model(instance, growth_model, scenario, region_code):
+def _run_model(instance, growth_model, scenario, region_code,
+               set_progress=None):
+    set_progress = set_progress or (lambda progress: None)
     n_years = scenario['years']
 
     yearly_counts, planted_trees = growth_model.run(scenario)
+    set_progress(40)
 
-    eco_trees = _model_trees_to_eco_trees(planted_trees, region_code)
-    eco_input = {
-        'region': region_code,
-        'instance_id': str(instance.id),
-        'years': n_years,
-        'scenario_trees': eco_trees
-    }
-
-    eco, err = ecobackend.json_benefits_call('eco_scenario.json',
-                                             eco_input,
-                                             post=True,
-                                             convert_params=False)
-    if err:
-        raise Exception(err)
+    eco_cohorts = _model_trees_to_eco_cohorts(planted_trees, region_code)
+    eco = _eco_scenario(instance, region_code, n_years, eco_cohorts)
+    set_progress(80)
 
     total_eco = compute_currency_and_transform_units(instance, eco['Total'])
     total_eco = format_benefits(instance, total_eco, None, digits=0)
@@ -327,16 +421,89 @@ def _list_for_display(benefits):
     return the_list
 
 
-def _model_trees_to_eco_trees(planted_trees, region_code):
-    eco_trees = [
-        {
-            'otmcode': tree.species.otm_code,
-            'species_id': tree.species.id,
+def _model_trees_to_eco_cohorts(planted_trees, region_code):
+    """
+    Collapse trees with the same species and yearly diameters, which have
+    the same benefits, into cohorts. Returns (eco tree, count) pairs.
+    """
+    cohorts = OrderedDict()
+    for tree in planted_trees:
+        diameters = tree.diameters_for_eco()
+        key = (tree.species.otm_code, tree.species.id, tuple(diameters))
+        if key in cohorts:
+            cohorts[key][1] += 1
+        else:
+            cohorts[key] = [{
+                'otmcode': tree.species.otm_code,
+                'species_id': tree.species.id,
+                'region': region_code,
+                'diameters': diameters
+            }, 1]
+    return [tuple(cohort) for cohort in cohorts.values()]
+
+
+def _eco_scenario(instance, region_code, n_years, eco_cohorts):
+    """
+    Get benefits of the cohorts from the ecoservice.
+
+    eco_scenario.json evaluates each tree it is sent and can't weight them,
+    but benefits add up across trees. So send each cohort once, in calls
+    grouped either by cohort count or by the powers of two in the cohort
+    counts (whichever takes fewer calls), and scale each call's results.
+    """
+    by_count = OrderedDict()
+    by_power_of_two = OrderedDict()
+    for eco_tree, count in eco_cohorts:
+        by_count.setdefault(count, []).append(eco_tree)
+        power = 1
+        while power <= count:
+            if count & power:
+                by_power_of_two.setdefault(power, []).append(eco_tree)
+            power *= 2
+
+    calls = min(by_count.items(), by_power_of_two.items(), key=len)
+    # Still make a call for a scenario without trees
+    calls = calls or [(1, [])]
+
+    eco = None
+    for weight, eco_trees in calls:
+        eco_input = {
             'region': region_code,
-            'diameters': tree.diameters_for_eco()
+            'instance_id': str(instance.id),
+            'years': n_years,
+            'scenario_trees': eco_trees
+        }
+
+        call_eco, err = ecobackend.json_benefits_call('eco_scenario.json',
+                                                      eco_input,
+                                                      post=True,
+                                                      convert_params=False)
+        if err:
+            raise Exception(err)
+
+        call_eco = {
+            'Total': _scale_benefits(call_eco['Total'], weight),
+            'Years': [_scale_benefits(benefits, weight)
+                      for benefits in call_eco['Years']],
         }
-        for tree in planted_trees]
-    return eco_trees
+        if eco is None:
+            eco = call_eco
+        else:
+            eco = {
+                'Total': _add_benefits(eco['Total'], call_eco['Total']),
+                'Years': [_add_benefits(b1, b2) for b1, b2
+                          in zip(eco['Years'], call_eco['Years'])],
+            }
+    return eco
+
+
+def _scale_benefits(benefits, factor):
+    return {key: value * factor for key, value in benefits.iteritems()}
+
+
+def _add_benefits(benefits1, benefits2):
+    return {key: benefits1.get(key, 0) + benefits2.get(key, 0)
+            for key in set(benefits1) | set(benefits2)}
 
 
 def _eco_csv_header(year_headers):
@@ -27,6 +27,34 @@ SYSTEM_USER_ID = -1
 #
 ECO_SERVICE_URL = 'http://localhost:13000'
 
+# Connect and read timeouts, in seconds, for ecoservice requests
+ECO_SERVICE_TIMEOUT = (3.05, 30)
+# Open connections to the ecoservice kept per process. Requests wait for a
+# free connection, which bounds concurrent requests from threads.
+ECO_SERVICE_MAX_CONNECTIONS = 4
+# Retries of ecoservice requests that failed to connect or got a 502, 503
+# or 504 response, waiting ECO_SERVICE_RETRY_BACKOFF * 2^n seconds between
+ECO_SERVICE_RETRIES = 2
+ECO_SERVICE_RETRY_BACKOFF = 0.2
+# After this many consecutive failed ecoservice requests, fail immediately
+# for ECO_SERVICE_CIRCUIT_RESET_SECONDS before trying again
+ECO_SERVICE_CIRCUIT_FAILURES = 5
+ECO_SERVICE_CIRCUIT_RESET_SECONDS = 30
+
+# Benefits for a whole instance are read from per-species running totals
+# (see treemap/ecoaggregate.py) once they have been built with the
+# rebuild_eco_aggregate management command
+USE_ECO_AGGREGATE = True
+
+# Threads per process used to compute the benefits of an instance's map
+# feature classes concurrently. Each thread uses its own database
+# connection. Set to 1 to compute them one after another.
+ECO_BENEFITS_THREADS = 4
+
+# Modeling runs still pending or running after this long are assumed to
+# have died, and identical requests start a new run
+MODEL_RUN_TIMEOUT_SECONDS = 600
+
 # This should be the google analytics id without
 # the 'GTM-' prefix
 GOOGLE_ANALYTICS_ID = None
@@ -376,15 +404,52 @@ DOUBLE_CLICK_INTERVAL = 300
 # The number of plots to import per task
 IMPORT_BATCH_SIZE = 85
 
+# The number of rows loaded from an uploaded file with each COPY
+IMPORT_COPY_BATCH_SIZE = 10000
+
 # The rate limit for how frequently batches of imports can happen per worker
 IMPORT_COMMIT_RATE_LIMIT = "1/m"
 
+# Insert the plots and trees created by a tree import in bulk, committing
+# this many rows per task instead of IMPORT_BATCH_SIZE
+IMPORT_BULK_COMMIT = True
+IMPORT_BULK_COMMIT_BATCH_SIZE = 2500
+
+# Stream tree exports out of the database with COPY instead of loading
+# each row through the ORM
+EXPORT_TREE_CSV_WITH_COPY = True
+
+# Tree exports of more plots than this are split into parts of about this
+# many plots, each exported by its own Celery task
+EXPORT_PLOTS_PER_SHARD = 250000
+
+# The number of features fetched from the database at a time by GeoJSON
+# exports
+EXPORT_FEATURES_FETCH_SIZE = 2000
+
+# Export jobs and their files are deleted by the delete_old_exports command
+# this many days after they were created
+EXPORT_JOB_MAX_AGE_DAYS = 7
+
 IE_VERSION_MINIMUM = 11
 
 IE_VERSION_UNSUPPORTED_REDIRECT_PATH = '/unsupported'
 
 USE_OBJECT_CACHES = True
 USE_ECO_CACHE = True
+# Recompute cached unfiltered counts and benefits in a Celery task
+# whenever an instance's revs change
+WARM_ECO_CACHE = True
+# Wait this long before warming, so a burst of edits to an instance only
+# warms the cache for the revs left by the last one
+WARM_ECO_CACHE_DELAY_SECONDS = 10
+USE_FILTER_CACHE = True
+# Number of single-tree benefit results memoized per process (the shared
+# cache keeps them all)
+ECO_TREE_BENEFITS_LRU_SIZE = 10000
+# Most trees sent in one eco_scenario.json call when computing the benefits
+# of a list of plots. The request size grows with the square of this.
+ECO_BENEFITS_BATCH_SIZE = 200
 
 BING_API_KEY = None
 GOOGLE_MAPS_API_KEY = os.environ.get('GOOGLE_MAPS_KEY', None)
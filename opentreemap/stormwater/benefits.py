@@ -3,7 +3,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
-from django.db.models import Sum
+from django.db.models import Case, Count, FloatField, Q, Sum, When
 from django.utils.translation import ugettext_lazy as _
 
 from treemap.ecobenefits import (BenefitCalculator, FEET_SQ_PER_METER_SQ,
@@ -26,21 +26,27 @@ class PolygonalBasinBenefitCalculator(BenefitCalculator):
         return stats, basis, None
 
     def _benefits_for_feature_qs(self, feature_qs, instance):
-        from stormwater.models import PolygonalMapFeature
-        feature_count = feature_qs.count()
-        feature_qs = feature_qs.filter(drainage_area__isnull=False)
-        poly_qs = PolygonalMapFeature.objects.filter(id__in=feature_qs)
+        # Only features with a drainage area contribute benefits
+        has_drainage = Q(drainage_area__isnull=False)
+        totals = feature_qs.order_by().aggregate(
+            feature_count=Count('pk'),
+            features_used=Count('drainage_area'),
+            total_drainage_area=Sum('drainage_area'),
+            total_area=Sum(Case(When(has_drainage, then='calculated_area'),
+                                output_field=FloatField())),
+            missing_area_count=Count(Case(
+                When(has_drainage & Q(calculated_area__isnull=True),
+                     then='pk'))))
+
+        feature_count = totals['feature_count']
+        features_used = totals['features_used']
+        total_drainage_area = totals['total_drainage_area']
         config = self.MapFeatureClass.get_config(instance)
         diversion_rate = config['diversion_rate']
         should_compute = (instance.annual_rainfall_inches is not None and
                           diversion_rate is not None and
-                          config['should_show_eco'])
-        if should_compute:
-            total_drainage_area = feature_qs.aggregate(
-                total_drainage_area=Sum('drainage_area')).get(
-                'total_drainage_area')
-            if total_drainage_area is None:
-                should_compute = False
+                          config['should_show_eco'] and
+                          total_drainage_area is not None)
         if should_compute:
             annual_rainfall_ft = instance.annual_rainfall_inches * \
                 FEET_PER_INCH
@@ -48,14 +54,16 @@ class PolygonalBasinBenefitCalculator(BenefitCalculator):
             #     annual rainfall x (total feature area +
             #     (total drainage area x fraction stormwater diverted))
             total_drainage_area *= FEET_SQ_PER_METER_SQ
-            feature_areas = \
-                self.MapFeatureClass.feature_qs_areas(poly_qs)
-            total_area = sum(feature_areas) * FEET_SQ_PER_METER_SQ
+            total_area = totals['total_area'] or 0
+            if totals['missing_area_count']:
+                # Areas not yet stored (see the "fill_polygon_areas"
+                # command) are calculated from the polygons
+                total_area += sum(self._missing_feature_areas(feature_qs))
+            total_area *= FEET_SQ_PER_METER_SQ
             runoff_reduced = annual_rainfall_ft * (
                 total_area + total_drainage_area * diversion_rate)
             runoff_reduced *= GALLONS_PER_CUBIC_FT
             stats = self._format_stats(instance, runoff_reduced)
-            features_used = poly_qs.count()
             basis = self._get_basis(features_used,
                                     feature_count - features_used)
         else:
@@ -63,6 +71,13 @@ class PolygonalBasinBenefitCalculator(BenefitCalculator):
             basis = self._get_basis(0, feature_count)
         return stats, basis
 
+    def _missing_feature_areas(self, feature_qs):
+        from stormwater.models import PolygonalMapFeature
+        feature_qs = feature_qs.filter(drainage_area__isnull=False,
+                                       calculated_area__isnull=True)
+        poly_qs = PolygonalMapFeature.objects.filter(id__in=feature_qs)
+        return self.MapFeatureClass.feature_qs_areas(poly_qs)
+
     def _format_stats(self, instance, runoff_reduced):
         factor_conversions = instance.eco_benefits_conversion
         if factor_conversions:
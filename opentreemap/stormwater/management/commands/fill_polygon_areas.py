@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ObjectDoesNotExist
+
+from treemap.instance import Instance
+from stormwater.models import PolygonalMapFeature
+
+
+class Command(BaseCommand):
+    help = ('Stores the area of each polygonal map feature, for all '
+            'instances or specified instance')
+
+    def add_arguments(self, parser):
+        parser.add_argument('instance_url_name', nargs='?', default=None)
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help='Recompute areas that are already stored')
+
+    def handle(self, *args, **options):
+        instance = None
+        if options['instance_url_name'] is not None:
+            url_name = options['instance_url_name']
+            try:
+                instance = Instance.objects.get(url_name=url_name)
+            except ObjectDoesNotExist:
+                raise CommandError('Instance "%s" not found' % url_name)
+
+        n_updated = PolygonalMapFeature.fill_calculated_areas(
+            instance, options['force'])
+        self.stdout.write('Stored areas for %s polygonal map features'
+                          % n_updated)
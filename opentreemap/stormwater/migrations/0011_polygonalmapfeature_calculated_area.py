@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stormwater', '0010_stormwater_blank_true'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='polygonalmapfeature',
+            name='calculated_area',
+            field=models.FloatField(default=None, null=True, blank=True),
+        ),
+    ]
@@ -18,12 +18,16 @@ class PolygonalMapFeature(MapFeature):
     enable_detail_next = True
 
     polygon = models.MultiPolygonField(srid=3857)
+    # Area of the polygon in square meters, kept up to date on save so
+    # that benefit summaries can sum it without a per-row PostGIS call.
+    # Use the "fill_polygon_areas" command to fill in missing values.
+    calculated_area = models.FloatField(null=True, blank=True, default=None)
 
     objects = models.GeoManager()
 
     @classproperty
     def always_writable(cls):
-        return MapFeature.always_writable | {'polygon'}
+        return MapFeature.always_writable | {'polygon', 'calculated_area'}
 
     def __init__(self, *args, **kwargs):
         super(PolygonalMapFeature, self).__init__(*args, **kwargs)
@@ -31,7 +35,18 @@ class PolygonalMapFeature(MapFeature):
 
     @classproperty
     def do_not_track(cls):
-        return MapFeature.do_not_track | {'polygonalmapfeature_ptr'}
+        return MapFeature.do_not_track | {'polygonalmapfeature_ptr',
+                                          'calculated_area'}
+
+    def save_with_user(self, user, *args, **kwargs):
+        old_polygon = self.get_previous_state().get('polygon')
+        if self.polygon is None:
+            self.calculated_area = None
+        elif self.calculated_area is None or old_polygon is None or \
+                not old_polygon.equals(self.polygon):
+            self.calculated_area = self.polygon_area(self.polygon)
+
+        super(PolygonalMapFeature, self).save_with_user(user, *args, **kwargs)
 
     @property
     def is_editable(self):
@@ -66,6 +81,35 @@ class PolygonalMapFeature(MapFeature):
             .values_list(area_col_name, flat=True)
         return feature_areas
 
+    @classmethod
+    def fill_calculated_areas(cls, instance=None, force=False):
+        """
+        Store the area of each polygon whose area is missing (or of every
+        polygon if "force" is set), optionally limited to one instance.
+        Returns the number of features updated.
+        """
+        where = []
+        params = []
+        if not force:
+            where.append('f.calculated_area IS NULL')
+        if instance is not None:
+            where.append('m.instance_id = %s')
+            params.append(instance.pk)
+
+        sql = """
+            UPDATE stormwater_polygonalmapfeature AS f
+            SET calculated_area =
+                ST_Area(ST_Transform(f.polygon, 4326)::geography)
+            FROM treemap_mapfeature AS m
+            WHERE m.id = f.mapfeature_ptr_id
+            """
+        if where:
+            sql += ' AND ' + ' AND '.join(where)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
     @classmethod
     def field_display_name(cls, field_name):
         if field_name == 'polygon':
@@ -77,6 +121,8 @@ class PolygonalMapFeature(MapFeature):
     def calculate_area(self):
         if self.polygon is None:
             return None
+        if self.calculated_area is not None:
+            return self.calculated_area
         return PolygonalMapFeature.polygon_area(self.polygon)
 
 
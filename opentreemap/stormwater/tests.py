@@ -17,7 +17,8 @@ from treemap.tests.base import OTMTestCase
 from django.contrib.gis.geos import Point, Polygon, MultiPolygon
 from django.test.utils import override_settings
 
-from stormwater.models import Bioswale, RainGarden, RainBarrel
+from stormwater.models import (Bioswale, RainGarden, RainBarrel,
+                               PolygonalMapFeature)
 
 ASSERT_ALMOST_EQUAL_AREA_DELTA = 0.00000005
 ASSERT_ALMOST_EQUAL_RUNOFF_REDUCTION_DELTA = 0.00000004
@@ -228,6 +229,31 @@ class PolygonalMapFeatureTest(OTMTestCase):
                                self.polygon_area_sq_meters,
                                delta=ASSERT_ALMOST_EQUAL_AREA_DELTA * self.polygon_area_sq_meters)  # NOQA
 
+    def test_area_stored_on_save(self):
+        bioswale = self._make_map_feature(Bioswale)
+        self.assertAlmostEqual(bioswale.calculated_area,
+                               self.polygon_area_sq_meters,
+                               delta=ASSERT_ALMOST_EQUAL_AREA_DELTA * self.polygon_area_sq_meters)  # NOQA
+
+        # Squares of equal degrees shrink toward the poles
+        bioswale.polygon = self._make_square_polygon(-76, 40)
+        bioswale.save_with_user(self.user)
+        self.assertLess(bioswale.calculated_area,
+                        self.polygon_area_sq_meters)
+
+    def test_fill_calculated_areas(self):
+        bioswale = self._make_map_feature(Bioswale)
+        PolygonalMapFeature.objects.filter(pk=bioswale.pk) \
+            .update(calculated_area=None)
+
+        n_updated = PolygonalMapFeature.fill_calculated_areas(self.instance)
+
+        self.assertEqual(n_updated, 1)
+        self.assertAlmostEqual(
+            PolygonalMapFeature.objects.get(pk=bioswale.pk).calculated_area,
+            self.polygon_area_sq_meters,
+            delta=ASSERT_ALMOST_EQUAL_AREA_DELTA * self.polygon_area_sq_meters)  # NOQA
+
     def assert_basis(self, basis, n_used, n_discarded):
         self.assertEqual(basis['resource']['n_objects_used'], n_used)
         self.assertEqual(basis['resource']['n_objects_discarded'], n_discarded)
@@ -309,6 +335,29 @@ class PolygonalMapFeatureTest(OTMTestCase):
             2 * drainage_area_sq_meters,
             .5, runoff_reduced)
 
+    def test_bulk_area_not_stored(self):
+        drainage_area_sq_meters = 100000000.0
+        self._make_map_feature(Bioswale,
+                               drainage_area=drainage_area_sq_meters)
+        feature = self._make_map_feature(
+            Bioswale,
+            geom=self._make_point(-75.5, 39),
+            polygon=self._make_square_polygon(-75.5, 39),
+            drainage_area=drainage_area_sq_meters)
+        PolygonalMapFeature.objects.filter(pk=feature.pk) \
+            .update(calculated_area=None)
+
+        benefits, basis = Bioswale.benefits.benefits_for_filter(
+            self.instance, Filter('', '', self.instance))
+
+        runoff_reduced = benefits['resource']['stormwater']['value']
+
+        self.assert_basis(basis, 2, 0)
+        self._assert_runoff_reduced(
+            2 * self.polygon_area_sq_meters,
+            2 * drainage_area_sq_meters,
+            .5, runoff_reduced)
+
     def test_bulk_partial_drainage_known(self):
         drainage_area_sq_meters = 100000000.0
         # NOTE
@@ -515,9 +515,28 @@ def bulk_create_with_user(auditables, user):
         updates = model._updated_fields()
         audits.extend(model._make_audits(user, Audit.Type.Insert, updates))
 
-    ModelClass.objects.bulk_create(auditables)
+    if ModelClass._meta.parents:
+        _bulk_insert_with_parents(ModelClass, auditables)
+    else:
+        ModelClass.objects.bulk_create(auditables)
     Audit.objects.bulk_create(audits)
 
+    for model in auditables:
+        model.populate_previous_state()
+
+
+def _bulk_insert_with_parents(ModelClass, objs):
+    """
+    bulk_create does not support multi-table inheritance (e.g. Plot), so
+    insert the rows of each table in turn, starting with the topmost parent.
+    The objects must already have their ids set.
+    """
+    tables = list(reversed(ModelClass._meta.get_parent_list())) + [ModelClass]
+    for table_class in tables:
+        table_class._base_manager._insert(
+            objs, fields=table_class._meta.local_concrete_fields,
+            using=ModelClass.objects.db)
+
 
 class UserTrackingException(Exception):
     pass
@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, pre_delete
+
+from treemap.instance import Instance
+from treemap.models import (Plot, Tree, Species, ITreeCodeOverride,
+                            TreeBenefitsAggregate)
+
+# Instance-wide tree eco benefits maintained incrementally.
+#
+# A tree's benefits depend only on its species, diameter and i-Tree region,
+# so the raw (unconverted) benefits of every tree in an instance are kept as
+# running totals in TreeBenefitsAggregate rows, one per (species, region).
+# Saving or deleting a tree, or moving its plot, subtracts the benefits of
+# the tree's old inputs and adds those of its new inputs, which costs one
+# single-tree eco calculation instead of a full instance summary. The
+# calculation is made by a task queued once the change is committed, so
+# saves never wait for the ecoservice. A tree's region is the one stored on
+# its plot, as for full summaries.
+#
+# Every change to the inputs bumps the instance's eco_rev in the saving
+# transaction, and the totals record the eco_rev they were built from, so
+# a task skips changes the totals already include and a rebuild retries if
+# trees change while it scans them.
+#
+# Totals are only maintained once they have been built for an instance with
+# the rebuild_eco_aggregate management command, which also verifies them.
+# Changing i-Tree code overrides or a species' OTM code invalidates the
+# totals, and unfiltered summaries fall back to the full calculation until
+# they are rebuilt. Changes to an instance's i-Tree regions need a rebuild.
+
+# Relative difference tolerated by verify_aggregate, since the totals
+# accumulate floating point error as trees are added and removed
+_TOLERANCE = 1e-6
+
+# Times rebuild_aggregate scans an instance's trees before giving up on
+# finding a scan that no change was committed during
+_REBUILD_ATTEMPTS = 3
+
+
+def aggregate_benefits(instance):
+    """
+    Return the raw benefits of all trees in the instance in the form
+    returned by the ecoservice eco_summary.json endpoint, or None if the
+    totals are not being maintained for the instance
+    """
+    if not settings.USE_ECO_AGGREGATE:
+        return None
+
+    rows = list(TreeBenefitsAggregate.objects.filter(instance=instance))
+    if not any(row.species_id is None for row in rows):
+        return None
+
+    totals = {}
+    n_trees = 0
+    for row in rows:
+        n_trees += row.n_trees
+        for factor, value in row.benefits.iteritems():
+            totals[factor] = totals.get(factor, 0.0) + value
+
+    totals['n_trees'] = n_trees
+    return {'Benefits': totals}
+
+
+def rebuild_aggregate(instance):
+    """
+    Recompute the benefit totals of every tree in the instance and start
+    maintaining them. Trees sharing a species, region and diameter are
+    computed once. Returns False if trees kept changing while they were
+    being scanned, leaving the existing totals in place.
+    """
+    for __ in xrange(_REBUILD_ATTEMPTS):
+        eco_rev = _current_eco_rev(instance)
+        buckets = _scan_buckets(instance)
+
+        rows = [TreeBenefitsAggregate(
+            instance=instance, species_id=species_id,
+            region_code=region_code, n_trees=n_trees, benefits=totals)
+            for (species_id, region_code), (n_trees, totals)
+            in buckets.iteritems()]
+        rows.append(TreeBenefitsAggregate(
+            instance=instance, species_id=None, region_code='', n_trees=0,
+            eco_rev=eco_rev))
+
+        with transaction.atomic():
+            # Locking the instance holds back changes until the new totals
+            # are committed, so none can be left out of both the scan and
+            # the totals their tasks update
+            if _current_eco_rev(instance, lock=True) != eco_rev:
+                continue
+            _invalidate(instance)
+            TreeBenefitsAggregate.objects.bulk_create(rows)
+            return True
+
+    return False
+
+
+def _scan_buckets(instance):
+    from treemap.ecobenefits import raw_benefits_for_tree
+
+    species_by_id = {s.pk: s for s in
+                     Species.objects.filter(instance=instance)}
+
+    region_code_for = region_code_lookup(instance)
+    computed = {}
+    buckets = {}
+
+    trees = Tree.objects \
+        .filter(instance=instance) \
+        .filter(species__isnull=False) \
+        .filter(diameter__isnull=False) \
+        .filter(species__instance=instance) \
+        .values_list('species_id', 'diameter', 'plot__itree_region_code',
+                     'plot__geom')
+
+    for species_id, diameter, stored_code, geom in trees.iterator():
+        region_code = region_code_for(stored_code, geom)
+        if not region_code or not diameter:
+            continue
+
+        key = (species_id, region_code, diameter)
+        if key not in computed:
+            rawb, err = raw_benefits_for_tree(
+                instance, species_by_id[species_id], diameter, region_code)
+            computed[key] = None if err else rawb['Benefits']
+
+        benefits = computed[key]
+        if benefits is not None:
+            bucket = buckets.setdefault((species_id, region_code), [0, {}])
+            bucket[0] += 1
+            _add_benefits(bucket[1], benefits, 1)
+
+    return buckets
+
+
+def verify_aggregate(instance):
+    """
+    Compare the maintained totals against a full calculation.
+    Return a dict mapping each factor (and 'n_trees') that differs to a
+    (maintained, computed) tuple. Returns None if the totals are not
+    being maintained for the instance.
+    """
+    from treemap.ecobenefits import TreeBenefitsCalculator
+
+    maintained = aggregate_benefits(instance)
+    if maintained is None:
+        return None
+
+    trees = Tree.objects.filter(instance=instance)
+    computed = TreeBenefitsCalculator()._summary(instance, trees)
+
+    maintained = maintained['Benefits']
+    computed = computed['Benefits']
+
+    differences = {}
+    for factor in set(maintained) | set(computed):
+        a = maintained.get(factor, 0.0)
+        b = computed.get(factor, 0.0)
+        if abs(a - b) > _TOLERANCE * max(abs(a), abs(b), 1.0):
+            differences[factor] = (a, b)
+    return differences
+
+
+def record_tree_changes(instance, changes):
+    """
+    Record a list of (old_state, new_state) tree changes made in the
+    current transaction, each state a (species id, diameter, i-Tree region
+    code) tuple or None if the tree did not or does not exist, and queue
+    their application to the totals for when the transaction commits
+    """
+    changes = [(_benefit_inputs(old_state), _benefit_inputs(new_state))
+               for old_state, new_state in changes]
+    changes = [(old_inputs, new_inputs) for old_inputs, new_inputs in changes
+               if old_inputs != new_inputs]
+    if not changes or not settings.USE_ECO_AGGREGATE:
+        return
+
+    # Bumped even when the totals are not maintained, so that a rebuild
+    # scanning the trees can tell that they changed
+    eco_rev = _bump_eco_rev(instance)
+
+    if _is_maintained(instance):
+        from treemap.tasks import update_eco_aggregate
+        transaction.on_commit(lambda: update_eco_aggregate.delay(
+            instance.pk, changes, eco_rev))
+
+
+def update_for_tree_changes(instance, changes, eco_rev):
+    """
+    Apply a list of (old_state, new_state) tree changes recorded by
+    record_tree_changes at `eco_rev`, unless the totals were built after
+    them. The benefits of each distinct species, region and diameter are
+    computed once and each row of totals is updated once.
+    """
+    if not _is_maintained(instance):
+        return
+
+    counts = {}
+    for old_inputs, new_inputs in changes:
+        for inputs, sign in ((old_inputs, -1), (new_inputs, 1)):
+            if inputs is not None:
+                inputs = tuple(inputs)
+                counts[inputs] = counts.get(inputs, 0) + sign
+
+    # Compute benefits before locking any rows, since the ecoservice
+    # may be slow to respond
+    buckets = {}
+    for inputs, count in counts.iteritems():
+        benefits = _raw_benefits(instance, inputs) if count else None
+        if benefits is not None:
+            species_id, region_code, __ = inputs
+            bucket = buckets.setdefault((species_id, region_code), [0, {}])
+            bucket[0] += count
+            _add_benefits(bucket[1], benefits, count)
+
+    with transaction.atomic():
+        marker = TreeBenefitsAggregate.objects \
+            .select_for_update() \
+            .filter(instance=instance, species_id__isnull=True) \
+            .first()
+        if marker is None or marker.eco_rev >= eco_rev:
+            return
+        for (species_id, region_code), (n_trees, totals) in \
+                buckets.iteritems():
+            _adjust(instance, species_id, region_code, n_trees, totals)
+
+        # Benefits cached since the changes were recorded were computed
+        # from the totals without them
+        if buckets:
+            instance.update_revs('eco_rev')
+
+
+def region_code_lookup(instance):
+    """
+    Return a function mapping the i-Tree region code stored on a plot and
+    the plot's geometry to the region code used for its tree by
+    TreeBenefitsCalculator.benefits_for_filter, which uses an instance's
+    only region for all of its trees and otherwise the stored code. Only
+    plots without a stored code have their region found from their
+    location.
+    """
+    regions = instance.itree_regions()
+    if len(regions) == 1:
+        code = regions[0].code
+        return lambda stored_code, geom: code
+
+    # Region geometries are only prepared once a plot needs them
+    prepared = []
+
+    def region_code_for(stored_code, geom):
+        if stored_code is not None:
+            return stored_code
+        if geom is None:
+            return None
+        if not prepared:
+            prepared.extend((region.code, region.geometry.prepared)
+                            for region in regions)
+        return next((code for code, geometry in prepared
+                     if geometry.contains(geom)), None)
+
+    return region_code_for
+
+
+def _is_maintained(instance):
+    return settings.USE_ECO_AGGREGATE and TreeBenefitsAggregate.objects \
+        .filter(instance=instance, species_id__isnull=True) \
+        .exists()
+
+
+def _invalidate(instance):
+    TreeBenefitsAggregate.objects.filter(instance=instance).delete()
+
+
+def _current_eco_rev(instance, lock=False):
+    qs = Instance.objects.filter(pk=instance.pk)
+    if lock:
+        qs = qs.select_for_update()
+    return qs.values_list('eco_rev', flat=True)[0]
+
+
+def _bump_eco_rev(instance):
+    # Use SQL increment, like Instance.update_revs, but without warming
+    # the eco cache, which the view making the change takes care of
+    qs = Instance.objects.filter(pk=instance.pk)
+    qs.update(eco_rev=F('eco_rev') + 1)
+    instance.eco_rev = qs.values_list('eco_rev', flat=True)[0]
+    return instance.eco_rev
+
+
+def _benefit_inputs(state):
+    if state is None:
+        return None
+
+    species_id, diameter, region_code = state
+    if not species_id or not diameter or not region_code:
+        return None
+
+    return (species_id, region_code, diameter)
+
+
+def _raw_benefits(instance, inputs):
+    from treemap.ecobenefits import raw_benefits_for_tree
+
+    species_id, region_code, diameter = inputs
+    species = Species.objects.filter(pk=species_id).first()
+    if species is None:
+        return None
+
+    rawb, err = raw_benefits_for_tree(instance, species, diameter,
+                                      region_code)
+    return None if err else rawb['Benefits']
+
+
+def _adjust(instance, species_id, region_code, n_trees, benefits):
+    bucket, __ = TreeBenefitsAggregate.objects.get_or_create(
+        instance=instance, species_id=species_id, region_code=region_code)
+    bucket = TreeBenefitsAggregate.objects \
+        .select_for_update() \
+        .get(pk=bucket.pk)
+
+    bucket.n_trees += n_trees
+    _add_benefits(bucket.benefits, benefits, 1)
+    bucket.save()
+
+
+def _add_benefits(totals, benefits, sign):
+    for factor, value in benefits.iteritems():
+        if factor != 'n_trees':
+            totals[factor] = totals.get(factor, 0.0) + sign * value
+
+
+def _tree_state(tree, previous=False):
+    if previous:
+        state = tree.get_previous_state()
+        if not state:
+            return None
+        species_id = state.get('species')
+        diameter = state.get('diameter')
+        plot_id = state.get('plot')
+    else:
+        species_id = tree.species_id
+        diameter = tree.diameter
+        plot_id = tree.plot_id
+
+    if plot_id == tree.plot_id:
+        stored_code, geom = tree.plot.itree_region_code, tree.plot.geom
+    else:
+        stored_code, geom = Plot.objects \
+            .filter(pk=plot_id) \
+            .values_list('itree_region_code', 'geom') \
+            .first() or (None, None)
+
+    region_code = region_code_lookup(tree.instance)(stored_code, geom)
+    return (species_id, diameter, region_code)
+
+
+def _update_for_tree_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    tree = instance
+    record_tree_changes(tree.instance, [
+        (None if created else _tree_state(tree, True), _tree_state(tree))])
+
+
+def _update_for_tree_delete(sender, instance, **kwargs):
+    tree = instance
+    record_tree_changes(tree.instance, [(_tree_state(tree), None)])
+
+
+def _update_for_plot_save(sender, instance, created, raw=False, **kwargs):
+    if raw or created:
+        return
+    plot = instance
+    region_code_for = region_code_lookup(plot.instance)
+    old_code = region_code_for(
+        getattr(plot, 'previous_itree_region_code', plot.itree_region_code),
+        plot.get_previous_state().get('geom'))
+    new_code = region_code_for(plot.itree_region_code, plot.geom)
+    if old_code == new_code:
+        return
+
+    record_tree_changes(plot.instance, [
+        ((tree.species_id, tree.diameter, old_code),
+         (tree.species_id, tree.diameter, new_code))
+        for tree in plot.tree_set.all()])
+
+
+def _invalidate_for_override(sender, instance, **kwargs):
+    _invalidate_for_change(instance.instance_species.instance)
+
+
+def _invalidate_for_species_save(sender, instance, created, **kwargs):
+    species = instance
+    previous_code = species.get_previous_state().get('otm_code')
+    if not created and previous_code != species.otm_code:
+        _invalidate_for_change(species.instance)
+
+
+def _invalidate_for_change(instance):
+    # Bumping the eco_rev makes a rebuild that is scanning the trees with
+    # the old codes start again
+    _bump_eco_rev(instance)
+    _invalidate(instance)
+
+
+post_save.connect(_update_for_tree_save, sender=Tree)
+# Use pre_delete so the tree's plot still exists when its plot is deleted
+pre_delete.connect(_update_for_tree_delete, sender=Tree)
+post_save.connect(_update_for_plot_save, sender=Plot)
+post_save.connect(_invalidate_for_override, sender=ITreeCodeOverride)
+post_delete.connect(_invalidate_for_override, sender=ITreeCodeOverride)
+post_save.connect(_invalidate_for_species_save, sender=Species)
@@ -3,11 +3,17 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
-import urllib2
+import binascii
 import urllib
 import json
 import re
 import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from django.conf import settings
 from django.contrib.gis.db.backends.postgis.adapter import PostGISAdapter
@@ -70,11 +76,155 @@ LOG_FUNCTION_FOR_FAILURE_CODE = {
 }
 
 
+class EcoserviceError(Exception):
+    pass
+
+
+class _CircuitBreaker(object):
+    """
+    Counts consecutive failed ecoservice requests. Once there have been
+    ECO_SERVICE_CIRCUIT_FAILURES of them the circuit opens and requests fail
+    without being sent, until ECO_SERVICE_CIRCUIT_RESET_SECONDS have passed.
+    Then a single request is let through, which closes the circuit if it
+    succeeds and opens it again if it fails.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._retry_at = None
+
+    def allow_request(self):
+        with self._lock:
+            if self._retry_at is None:
+                return True
+            elif time.time() >= self._retry_at:
+                # Let this request through, but hold back others until
+                # it has finished
+                self._retry_at = (time.time() +
+                                  settings.ECO_SERVICE_CIRCUIT_RESET_SECONDS)
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._retry_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= settings.ECO_SERVICE_CIRCUIT_FAILURES:
+                if self._retry_at is None:
+                    logger.error("Ecoservice circuit opened after %s "
+                                 "failed requests" % self._failures)
+                self._retry_at = (time.time() +
+                                  settings.ECO_SERVICE_CIRCUIT_RESET_SECONDS)
+
+    def is_open(self):
+        with self._lock:
+            return self._retry_at is not None
+
+
+_circuit_breaker = _CircuitBreaker()
+_session = None
+_session_lock = threading.Lock()
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def _get_session():
+    """
+    Return the process's ecoservice session, which keeps connections alive
+    and retries requests that fail before reaching the ecoservice. All
+    ecoservice endpoints are read-only calculations, so they are safe to
+    retry.
+    """
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=settings.ECO_SERVICE_RETRIES,
+                          connect=settings.ECO_SERVICE_RETRIES,
+                          read=0,
+                          status=settings.ECO_SERVICE_RETRIES,
+                          status_forcelist=(502, 503, 504),
+                          method_whitelist=False,
+                          backoff_factor=settings.ECO_SERVICE_RETRY_BACKOFF,
+                          raise_on_status=False)
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=settings.ECO_SERVICE_MAX_CONNECTIONS,
+                pool_block=True,
+                max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+
+    return _session
+
+
+def _record_metrics(endpoint, seconds, failed):
+    with _metrics_lock:
+        metrics = _metrics.setdefault(endpoint, {
+            'requests': 0, 'failures': 0,
+            'total_seconds': 0.0, 'max_seconds': 0.0})
+        metrics['requests'] += 1
+        metrics['failures'] += 1 if failed else 0
+        metrics['total_seconds'] += seconds
+        metrics['max_seconds'] = max(metrics['max_seconds'], seconds)
+
+
+def get_metrics():
+    """
+    Return a dict mapping each ecoservice endpoint called by this process
+    to its request count, failure count, and total and maximum latency
+    """
+    with _metrics_lock:
+        return {endpoint: dict(metrics)
+                for endpoint, metrics in _metrics.iteritems()}
+
+
+def is_available():
+    """
+    Return False if recent ecoservice requests have failed and new requests
+    are failing immediately
+    """
+    return not _circuit_breaker.is_open()
+
+
+def _geometry_param(adapter):
+    # The postgis adapter stores geometry objects
+    # which are not normally serialzable. str(x) will
+    # turn it into a ewkb encoded string which doesn't
+    # translate well. Instead, we send over ewkt and
+    # the associated ST_XXX call
+    geometry = GEOSGeometry(binascii.hexlify(adapter.ewkb))
+    return "ST_GeomFromEWKT('%s')" % geometry.ewkt
+
+
 def json_benefits_call(endpoint, params, post=False, convert_params=True):
     url = "%s/%s" % (settings.ECO_SERVICE_URL, endpoint)
 
+    # the caller decides if it wants to raise the error
+    # as an exception, or return it as a status code on
+    # a json response. therefore, it's always safe to
+    # return this string, and never raise.
+    general_unhandled_struct = (None, UNKNOWN_ECO_FAILURE)
+
+    # Check for a stale cache first, because the invalidation request
+    # may be the one request the circuit breaker lets through
     if endpoint not in ['invalidate_cache', 'itree_codes.json']:
-        invalidate_ecoservice_cache_if_stale()
+        try:
+            invalidate_ecoservice_cache_if_stale()
+        except EcoserviceError:
+            _record_metrics(endpoint, 0.0, True)
+            return general_unhandled_struct
+
+    if not _circuit_breaker.allow_request():
+        _record_metrics(endpoint, 0.0, True)
+        return general_unhandled_struct
 
     if post:
         if convert_params:
@@ -82,16 +232,8 @@ def json_benefits_call(endpoint, params, post=False, convert_params=True):
 
             # Group all keys called "param" as a list
             for k, v in params:
-                # The postgis adapter stores geometry objects
-                # which are not normally serialzable. str(x) will
-                # turn it into a ewkb encoded string which doesn't
-                # translate well. Instead, we send over ewkt and
-                # the associated ST_XXX call
                 if isinstance(v, PostGISAdapter):
-                    bytestring = v.ewkb
-                    hexstring = ''.join('%02X' % ord(x) for x in bytestring)
-
-                    v = "ST_GeomFromEWKT('%s')" % GEOSGeometry(hexstring).ewkt
+                    v = _geometry_param(v)
                 elif not isinstance(v, unicode):
                     v = str(v)
 
@@ -106,62 +248,75 @@ def json_benefits_call(endpoint, params, post=False, convert_params=True):
             data = json.dumps(paramdata)
         else:
             data = json.dumps(params)
-        req = urllib2.Request(url,
-                              data,
-                              {'Content-Type': 'application/json'})
+        request_kwargs = {
+            'method': 'POST',
+            'url': url,
+            'data': data,
+            'headers': {'Content-Type': 'application/json'}
+        }
     else:
         paramString = "&".join(["%s=%s" % (urllib.quote_plus(str(name)),
                                            urllib.quote_plus(str(val)))
                                 for (name, val) in params])
 
-        # A get request is assumed by urllib2
-        req = url + '?' + paramString
-
-    # the caller decides if it wants to raise the error
-    # as an exception, or return it as a status code on
-    # a json response. therefore, it's always safe to
-    # return this string, and never raise.
-    general_unhandled_struct = (None, UNKNOWN_ECO_FAILURE)
+        request_kwargs = {'method': 'GET', 'url': url + '?' + paramString}
 
+    start = time.time()
     try:
-        result = urllib2.urlopen(req).read()
+        response = _get_session().request(
+            timeout=settings.ECO_SERVICE_TIMEOUT, **request_kwargs)
+    except requests.RequestException:
+        _circuit_breaker.record_failure()
+        _record_metrics(endpoint, time.time() - start, True)
+        logger.error("Error connecting to ecoservice", exc_info=sys.exc_info())
+        return general_unhandled_struct
+
+    # Any server error counts against the ecoservice, not just the
+    # gateway errors the session retries
+    if response.status_code >= 500:
+        _circuit_breaker.record_failure()
+    else:
+        _circuit_breaker.record_success()
+    _record_metrics(endpoint, time.time() - start,
+                    response.status_code >= 400)
+
+    if response.status_code < 400:
+        result = response.content
         if result:
             result = json.loads(result)
         return result, None
-    except urllib2.HTTPError as e:
-        error_body = e.fp.read()
-        for code, patterns in ECOBENEFIT_FAILURE_CODES_AND_PATTERNS.items():
-            for pattern in patterns:
-                match = re.match(pattern, error_body)
-                if match:
-                    # When you pass a dictionary to a Python logger's
-                    # `extra` kwarg, each key in the dictionary is
-                    # added as an attribute on the log message object
-                    # itself. Rollbar specifically looks for an
-                    # attribute named `extra_data` on the log message.
-                    # https://github.com/rollbar/pyrollbar/blob/cbfc2529a2d8847e18f7134aa874eb7c68426e2f/rollbar/logger.py#L97 # NOQA
-                    extra = {
-                        'extra_data': {
-                            'ecobenefit_message': error_body,
-                            'ecobenefit_matched_message_pattern': pattern,
-                            'ecobenefit_failure_code': code
-                        }
+    else:
+        return (None, _failure_code_for_error(response.content))
+
+
+def _failure_code_for_error(error_body):
+    for code, patterns in ECOBENEFIT_FAILURE_CODES_AND_PATTERNS.items():
+        for pattern in patterns:
+            match = re.match(pattern, error_body)
+            if match:
+                # When you pass a dictionary to a Python logger's
+                # `extra` kwarg, each key in the dictionary is
+                # added as an attribute on the log message object
+                # itself. Rollbar specifically looks for an
+                # attribute named `extra_data` on the log message.
+                # https://github.com/rollbar/pyrollbar/blob/cbfc2529a2d8847e18f7134aa874eb7c68426e2f/rollbar/logger.py#L97 # NOQA
+                extra = {
+                    'extra_data': {
+                        'ecobenefit_message': error_body,
+                        'ecobenefit_matched_message_pattern': pattern,
+                        'ecobenefit_failure_code': code
                     }
-                    # We set the text of the log message to the code
-                    # and pattern that were matched rather than the
-                    # fully detailed message so that Rollbar can group
-                    # and count similar failures.
-                    LOG_FUNCTION_FOR_FAILURE_CODE[code](
-                        "ECOBENEFIT FAILURE: %s %s " % (code, pattern),
-                        extra=extra)
-                    return (None, code)
-        else:
-            # If we did not break out of the loop by returning early
-            # that means we received an unknown response from the
-            # ecoservice.
-            LOG_FUNCTION_FOR_FAILURE_CODE[UNKNOWN_ECO_FAILURE](
-                "ECOBENEFIT FAILURE: " + error_body)
-            return general_unhandled_struct
-    except urllib2.URLError:
-        logger.error("Error connecting to ecoservice", exc_info=sys.exc_info())
-        return general_unhandled_struct
+                }
+                # We set the text of the log message to the code
+                # and pattern that were matched rather than the
+                # fully detailed message so that Rollbar can group
+                # and count similar failures.
+                LOG_FUNCTION_FOR_FAILURE_CODE[code](
+                    "ECOBENEFIT FAILURE: %s %s " % (code, pattern),
+                    extra=extra)
+                return code
+
+    # We received an unknown response from the ecoservice.
+    LOG_FUNCTION_FOR_FAILURE_CODE[UNKNOWN_ECO_FAILURE](
+        "ECOBENEFIT FAILURE: " + error_body)
+    return UNKNOWN_ECO_FAILURE
@@ -3,15 +3,24 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
+from copy import deepcopy
+
+from django.conf import settings
+from django.utils import translation
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.gis.geos.point import Point
-from django.db import connection
+from django.db import connection, connections, DEFAULT_DB_ALIAS
 
 from django_tinsel.decorators import json_api_call
 import itertools
+import os
+import threading
+from multiprocessing.pool import ThreadPool
 
 from treemap import ecobackend
-from treemap.ecocache import get_cached_benefits
+from treemap.ecoaggregate import aggregate_benefits
+from treemap.ecocache import (get_cached_benefits, get_memoized_tree_benefits,
+                              get_memoized_trees_benefits)
 
 WATTS_PER_BTU = 0.29307107
 GAL_PER_CUBIC_M = 264.172052
@@ -82,6 +91,9 @@ class BenefitCalculator(object):
 
     benefits_for_object returns a tuple of:
     (dict from above, basis dict, error [or None])
+
+    benefits_for_objects returns a dict mapping each object's id to
+    the benefits_for_object tuple for that object
     """
 
     def benefits_for_filter(self, instance, item_filter):
@@ -90,6 +102,10 @@ class BenefitCalculator(object):
     def benefits_for_object(self, instance, obj):
         return {}
 
+    def benefits_for_objects(self, instance, objs):
+        return {obj.pk: self.benefits_for_object(instance, obj)
+                for obj in objs}
+
 
 class CountOnlyBenefitCalculator(BenefitCalculator):
     def __init__(self, clz):
@@ -115,37 +131,70 @@ class TreeBenefitsCalculator(BenefitCalculator):
         # UnicodeDecodeError
         return unicode(cursor.mogrify(sql, params), 'utf-8')
 
-    def benefits_for_filter(self, instance, item_filter):
-        from treemap.models import Plot, Tree
+    def _ecoservice_summary(self, instance, tree_values, region_code):
+        query = self._make_sql_from_query(tree_values.query)
 
-        instance = item_filter.instance
-        plots = item_filter.get_objects(Plot)
-        trees = Tree.objects.filter(plot__in=plots)
-        n_total_trees = trees.count()
+        # We want to extract x and y coordinates but django
+        # doesn't make this easy since we need to force a join
+        # on plot/mapfeature. To make sure the djago machinery
+        # does that we use "plot__geom" in the values query and then
+        # do this rather dubious string manipulation below
+        if not region_code:
+            targetGeomField = '"treemap_mapfeature"."the_geom_webmercator"'
+            xyGeomFields = 'ST_X(%s), ST_Y(%s)' % \
+                           (targetGeomField, targetGeomField)
 
-        if not instance.has_itree_region():
-            basis = {'plot':
-                     {'n_objects_used': 0,
-                      'n_objects_discarded': n_total_trees}}
-            return ({}, basis)
+            query = query.replace(targetGeomField, xyGeomFields, 1)
 
-        if n_total_trees == 0:
-            basis = {'plot':
-                     {'n_objects_used': 0,
-                      'n_objects_discarded': n_total_trees}}
-            empty_rslt = compute_currency_and_transform_units(
-                instance, {})
-            return (empty_rslt, basis)
+        params = {'query': query,
+                  'instance_id': instance.pk,
+                  'region': region_code or ""}
+
+        rawb, err = ecobackend.json_benefits_call(
+            'eco_summary.json', params.iteritems(), post=True)
+
+        if err:
+            raise ecobackend.EcoserviceError(err)
+
+        return rawb
 
+    def _summary(self, instance, trees):
         # When calculating benefits we can skip region information
         # if there is only one intersecting region or if the
         # instance forces a region on us
         regions = instance.itree_regions()
         if len(regions) == 1:
-            region_code = regions[0].code
-        else:
-            region_code = None
+            return self._region_summary(instance, trees, regions[0].code)
+
+        # Otherwise summarize the trees in each region separately, using
+        # the region codes stored on their plots. Only trees whose plots
+        # have no stored code need their region found from their location.
+        region_codes = trees \
+            .order_by() \
+            .values_list('plot__itree_region_code', flat=True) \
+            .distinct()
+
+        rawbs = []
+        for region_code in set(region_codes):
+            if region_code is None:
+                region_trees = trees.filter(
+                    plot__itree_region_code__isnull=True)
+            elif region_code:
+                region_trees = trees.filter(
+                    plot__itree_region_code=region_code)
+            else:
+                continue  # No region contains these trees
+
+            rawbs.append(self._region_summary(instance, region_trees,
+                                              region_code))
+
+        return _sum_raw_benefits(rawbs)
 
+    def _region_summary(self, instance, trees, region_code):
+        """
+        Summarize the benefits of trees in the region with `region_code`,
+        or of trees in any region if it is None
+        """
         # We want to do a values query that returns the info that
         # we need for an eco calculation:
         # diameter, species id and species code
@@ -168,29 +217,38 @@ class TreeBenefitsCalculator(BenefitCalculator):
                           .filter(species__instance=instance)\
                           .values_list(*values)
 
-        query = self._make_sql_from_query(treeValues.query)
+        return self._ecoservice_summary(instance, treeValues, region_code)
 
-        # We want to extract x and y coordinates but django
-        # doesn't make this easy since we need to force a join
-        # on plot/mapfeature. To make sure the djago machinery
-        # does that we use "plot__geom" above and then
-        # do this rather dubious string manipulation below
-        if not region_code:
-            targetGeomField = '"treemap_mapfeature"."the_geom_webmercator"'
-            xyGeomFields = 'ST_X(%s), ST_Y(%s)' % \
-                           (targetGeomField, targetGeomField)
+    def benefits_for_filter(self, instance, item_filter):
+        from treemap.models import Plot, Tree
 
-            query = query.replace(targetGeomField, xyGeomFields, 1)
+        instance = item_filter.instance
+        plots = item_filter.get_objects(Plot)
+        trees = Tree.objects.filter(plot__in=plots)
+        n_total_trees = trees.count()
 
-        params = {'query': query,
-                  'instance_id': instance.pk,
-                  'region': region_code or ""}
+        if not instance.has_itree_region():
+            basis = {'plot':
+                     {'n_objects_used': 0,
+                      'n_objects_discarded': n_total_trees}}
+            return ({}, basis)
 
-        rawb, err = ecobackend.json_benefits_call(
-            'eco_summary.json', params.iteritems(), post=True)
+        if n_total_trees == 0:
+            basis = {'plot':
+                     {'n_objects_used': 0,
+                      'n_objects_discarded': n_total_trees}}
+            empty_rslt = compute_currency_and_transform_units(
+                instance, {})
+            return (empty_rslt, basis)
 
-        if err:
-            raise Exception(err)
+        # The instance-wide summary is kept up to date incrementally, so
+        # an unfiltered request doesn't need to visit every tree
+        rawb = None
+        if not item_filter.filterstr and not item_filter.displaystr:
+            rawb = aggregate_benefits(instance)
+
+        if rawb is None:
+            rawb = self._summary(instance, trees)
 
         benefits = rawb['Benefits']
 
@@ -214,48 +272,169 @@ class TreeBenefitsCalculator(BenefitCalculator):
         return (rslt, basis)
 
     def benefits_for_object(self, instance, plot):
-        tree = plot.current_tree()
-        error = None
+        return self.benefits_for_objects(instance, [plot])[plot.pk]
 
-        if tree is None:
-            rslt = None
-            error = 'NO_TREE'
-        elif not tree.diameter:
-            rslt = None
-            error = 'MISSING_DBH'
-        elif not tree.species:
-            rslt = None
-            error = 'MISSING_SPECIES'
-        else:
-            region_code = plot.itree_region.code
+    def benefits_for_objects(self, instance, plots):
+        from treemap.models import Tree
 
-            if region_code:
-                params = {'otmcode': tree.species.otm_code,
-                          'diameter': tree.diameter,
-                          'region': region_code,
-                          'instanceid': instance.pk,
-                          'speciesid': tree.species.pk}
+        plots = list(plots)
 
-                rawb, err = ecobackend.json_benefits_call(
-                    'eco.json', params.iteritems())
+        trees_by_plot_id = {}
+        trees = Tree.objects \
+            .filter(plot_id__in=[plot.pk for plot in plots]) \
+            .select_related('species')
+        for tree in trees:
+            trees_by_plot_id.setdefault(tree.plot_id, tree)
 
-                if err:
-                    rslt = {'error': err}
-                    error = err
-                else:
-                    benefits = compute_currency_and_transform_units(
-                        instance, rawb['Benefits'])
+        region_codes = _itree_region_codes_for_plots(instance, plots)
 
-                    rslt = benefits
-            else:
-                rslt = None
+        # Benefits only depend on species, region and diameter, so trees
+        # sharing all three are computed once
+        tree_inputs = set()
+        for plot in plots:
+            tree = trees_by_plot_id.get(plot.pk)
+            region_code = region_codes.get(plot.pk)
+            if tree and tree.diameter and tree.species and region_code:
+                tree_inputs.add((tree.species, tree.diameter, region_code))
+        computed = raw_benefits_for_trees(instance, list(tree_inputs))
+
+        results = {}
+
+        for plot in plots:
+            tree = trees_by_plot_id.get(plot.pk)
+            region_code = region_codes.get(plot.pk)
+            rslt = None
+            error = None
+
+            if tree is None:
+                error = 'NO_TREE'
+            elif not tree.diameter:
+                error = 'MISSING_DBH'
+            elif not tree.species:
+                error = 'MISSING_SPECIES'
+            elif not region_code:
                 error = 'MISSING_REGION'
+            else:
+                rawb, error = computed[
+                    (tree.species, tree.diameter, region_code)]
+                if error:
+                    rslt = {'error': error}
+                else:
+                    rslt = compute_currency_and_transform_units(
+                        instance, deepcopy(rawb['Benefits']))
 
-        basis = {'plot':
-                 {'n_objects_used': 1 if rslt else 0,
-                  'n_objects_discarded': 0 if rslt else 1}}
+            basis = {'plot':
+                     {'n_objects_used': 1 if rslt else 0,
+                      'n_objects_discarded': 0 if rslt else 1}}
 
-        return (rslt, basis, error)
+            results[plot.pk] = (rslt, basis, error)
+
+        return results
+
+
+def raw_benefits_for_tree(instance, species, diameter, region_code):
+    """
+    Return the unconverted (result, error) tuple of the eco.json endpoint
+    for a single tree
+    """
+    return get_memoized_tree_benefits(
+        instance, species, diameter, region_code,
+        lambda: _eco_benefits_for_tree(
+            instance, species, diameter, region_code))
+
+
+def raw_benefits_for_trees(instance, tree_inputs):
+    """
+    Return a dict mapping each of a list of distinct
+    (species, diameter, region_code) tuples to the (result, error) tuple
+    raw_benefits_for_tree would return for it.
+
+    The ecoservice has no endpoint for the benefits of many separate trees.
+    But eco_scenario.json returns the summed benefits of its trees for each
+    year, and a tree with a diameter of 0 has no benefits (modeling relies
+    on this for trees not planted yet). So trees that have not been
+    memoized are sent ECO_BENEFITS_BATCH_SIZE at a time to
+    eco_scenario.json, each with its diameter in a year of its own and 0
+    in every other year, and each tree's benefits are read from its year.
+    A single tree still uses eco.json.
+    """
+    def compute(missing):
+        if len(missing) == 1:
+            species, diameter, region_code = missing[0]
+            return {missing[0]: _eco_benefits_for_tree(
+                instance, species, diameter, region_code)}
+
+        by_region = {}
+        for tree_input in missing:
+            by_region.setdefault(tree_input[2], []).append(tree_input)
+
+        results = {}
+        batch_size = settings.ECO_BENEFITS_BATCH_SIZE
+        for region_code, region_inputs in by_region.iteritems():
+            for start in xrange(0, len(region_inputs), batch_size):
+                batch = region_inputs[start:start + batch_size]
+                results.update(_eco_scenario_benefits_for_trees(
+                    instance, region_code, batch))
+        return results
+
+    return get_memoized_trees_benefits(instance, tree_inputs, compute)
+
+
+def _eco_benefits_for_tree(instance, species, diameter, region_code):
+    params = {'otmcode': species.otm_code,
+              'diameter': diameter,
+              'region': region_code,
+              'instanceid': instance.pk,
+              'speciesid': species.pk}
+
+    return ecobackend.json_benefits_call('eco.json', params.iteritems())
+
+
+def _eco_scenario_benefits_for_trees(instance, region_code, tree_inputs):
+    n_years = len(tree_inputs)
+    scenario_trees = []
+    for year, (species, diameter, __) in enumerate(tree_inputs):
+        diameters = [0] * n_years
+        diameters[year] = diameter
+        scenario_trees.append({'otmcode': species.otm_code,
+                               'species_id': species.pk,
+                               'region': region_code,
+                               'diameters': diameters})
+
+    eco_input = {'region': region_code,
+                 'instance_id': str(instance.pk),
+                 'years': n_years,
+                 'scenario_trees': scenario_trees}
+
+    rawb, err = ecobackend.json_benefits_call(
+        'eco_scenario.json', eco_input, post=True, convert_params=False)
+
+    if err:
+        return {tree_input: (None, err) for tree_input in tree_inputs}
+    return {tree_input: ({'Benefits': benefits}, None)
+            for tree_input, benefits in zip(tree_inputs, rawb['Years'])}
+
+
+def _itree_region_codes_for_plots(instance, plots):
+    """
+    Return a dict mapping plot id to the code of the i-Tree region that
+    contains the plot, or None. Equivalent to MapFeature.itree_region for
+    each plot, but with at most one region query.
+    """
+    if instance.itree_region_default:
+        return {plot.pk: instance.itree_region_default for plot in plots}
+
+    codes = {plot.pk: plot.itree_region_code or None for plot in plots
+             if plot.itree_region_code is not None}
+
+    unassigned = [plot for plot in plots if plot.pk not in codes]
+    if unassigned:
+        regions = [(region.code, region.geometry.prepared)
+                   for region in instance.itree_regions()]
+        for plot in unassigned:
+            codes[plot.pk] = next((code for code, geometry in regions
+                                   if geometry.contains(plot.geom)), None)
+    return codes
 
 
 def compute_currency_and_transform_units(instance, benefits):
@@ -335,6 +514,15 @@ def compute_currency_and_transform_units(instance, benefits):
     return {'plot': rslt}
 
 
+def _sum_raw_benefits(rawbs):
+    """Add up eco_summary.json results"""
+    totals = {'n_trees': 0}
+    for rawb in rawbs:
+        for factor, value in rawb['Benefits'].iteritems():
+            totals[factor] = totals.get(factor, 0) + value
+    return {'Benefits': totals}
+
+
 #TODO: Does this helper exist?
 def _sum_dict(d1, d2):
     if d1 is None:
@@ -414,12 +602,81 @@ def _annotate_basis_with_extra_stats(basis):
             abasis['n_pct_calculated'] = pct
 
 
+_benefits_pool = None
+_benefits_pool_pid = None
+# The database connection of each pool thread, by thread id
+_benefits_pool_connections = {}
+_benefits_pool_lock = threading.Lock()
+
+
+def _get_benefits_pool():
+    # Threads don't survive a fork, so make a pool for each process
+    global _benefits_pool, _benefits_pool_pid
+    with _benefits_pool_lock:
+        if _benefits_pool is None or _benefits_pool_pid != os.getpid():
+            _benefits_pool = ThreadPool(settings.ECO_BENEFITS_THREADS)
+            _benefits_pool_pid = os.getpid()
+            # Connections inherited from the parent process belong to it
+            _benefits_pool_connections.clear()
+        return _benefits_pool
+
+
+def close_benefits_pool():
+    """
+    Stop the threads computing benefits concurrently and close their
+    database connections
+    """
+    global _benefits_pool
+    with _benefits_pool_lock:
+        pool, _benefits_pool = _benefits_pool, None
+        if pool is None or _benefits_pool_pid != os.getpid():
+            return
+        dbs = _benefits_pool_connections.values()
+        _benefits_pool_connections.clear()
+
+    pool.close()
+    pool.join()
+    for db in dbs:
+        # The threads that opened the connections have finished
+        db.allow_thread_sharing = True
+        db.close()
+
+
+def _benefits_for_class_in_thread(args):
+    cls, filter, language = args
+
+    # Each pool thread keeps its own database connection open between
+    # calls, as Django's request cycle knows nothing about it. Only a
+    # connection the database has dropped is replaced.
+    db = connections[DEFAULT_DB_ALIAS]
+    if db.connection is not None and not db.is_usable():
+        db.close()
+    with _benefits_pool_lock:
+        _benefits_pool_connections[threading.current_thread().ident] = db
+
+    with translation.override(language):
+        return _benefits_for_class(cls, filter)
+
+
+def _benefits_by_class(filter):
+    classes = filter.instance.map_feature_classes
+
+    # Other threads can't see data written in an open transaction
+    # (as in tests), so compute serially inside one
+    if (settings.ECO_BENEFITS_THREADS <= 1 or len(classes) <= 1 or
+            connection.in_atomic_block):
+        return [_benefits_for_class(C, filter) for C in classes]
+
+    language = translation.get_language()
+    return _get_benefits_pool().map(
+        _benefits_for_class_in_thread,
+        [(C, filter, language) for C in classes])
+
+
 def get_benefits_for_filter(filter):
     benefits, basis = {}, {}
 
-    for C in filter.instance.map_feature_classes:
-        ft_benefit_groups, ft_basis = _benefits_for_class(C, filter)
-
+    for ft_benefit_groups, ft_basis in _benefits_by_class(filter):
         _combine_benefit_basis(basis, ft_basis)
         _combine_grouped_benefits(benefits, ft_benefit_groups)
 
@@ -3,11 +3,17 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 import hashlib
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
 
 from django.conf import settings
 from django.core.cache import cache
 from django.db.models.signals import post_save, post_delete
 
+from treemap.instance import Instance
 from treemap.models import Plot, ITreeCodeOverride
 
 # Cache the results of plot counts and tree ecobenefit summary requests.
@@ -20,9 +26,28 @@ from treemap.models import Plot, ITreeCodeOverride
 # Plot key is count/plots/<url_name>/<universal_rev>/<filter_hash>
 # Eco key is eco/trees/<url_name>/<universal_rev>/<filter_hash>
 
+#
+# When a rev changes on a busy instance, many requests miss the same key at
+# once. Only the request holding the key's lock computes the value. The
+# others serve the value computed for the previous rev, if there is one,
+# or wait for the lock holder to finish.
+#
+# The latest value for each filter is kept under a key without the rev:
+# Stale key is <prefix>/<url_name>/latest/<filter_hash>
+#
+# It is also served when computing a new value fails because the
+# ecoservice is unavailable.
+
 # Entries will be neither numerous nor large, so let them live for a month
 _TIMEOUT = 60 * 60 * 24 * 30
 
+# Locks expire in case the process holding one dies
+_LOCK_TIMEOUT = 60
+
+# Give up waiting for another request's value and compute it after this
+_LOCK_WAIT_SECONDS = 15
+_LOCK_POLL_SECONDS = 0.1
+
 
 def get_cached_benefits(class_name, filter, compute_value):
     prefix = 'eco/%s' % class_name
@@ -36,6 +61,33 @@ def get_cached_plot_count(filter):
     return _get_or_compute(prefix, filter, compute_value)
 
 
+def instance_revs(instance_id):
+    """
+    Return the (geo_rev, eco_rev, universal_rev) of an instance, which
+    together determine the keys of its cached counts and benefits
+    """
+    return tuple(Instance.objects
+                 .filter(pk=instance_id)
+                 .values_list('geo_rev', 'eco_rev', 'universal_rev')[0])
+
+
+def queue_eco_cache_warming(instance_id):
+    """
+    Queue a warm_eco_cache task for the instance's current revs, unless one
+    has already been queued for them. The task is delayed, and skipped if
+    the revs change again before it runs, so only the latest revs of a
+    burst of edits are warmed.
+    """
+    from treemap.tasks import warm_eco_cache
+
+    revs = instance_revs(instance_id)
+    key = 'eco-warm/%s/%s' % (instance_id, '/'.join(str(r) for r in revs))
+    if cache.add(key, True, _TIMEOUT):
+        warm_eco_cache.apply_async(
+            (instance_id, revs),
+            countdown=settings.WARM_ECO_CACHE_DELAY_SECONDS)
+
+
 def _get_or_compute(prefix, filter, compute_value):
     if not settings.USE_ECO_CACHE:
         value = compute_value()
@@ -43,11 +95,42 @@ def _get_or_compute(prefix, filter, compute_value):
         key = _get_key(prefix, filter)
         value = cache.get(key)
         if value is None:
-            value = compute_value()
-            cache.set(key, value, _TIMEOUT)
+            value = _compute_once(key, _get_stale_key(prefix, filter),
+                                  compute_value)
     return value
 
 
+def _compute_once(key, stale_key, compute_value):
+    from treemap.ecobackend import EcoserviceError
+
+    lock_key = key + '/lock'
+    give_up_at = time.time() + _LOCK_WAIT_SECONDS
+
+    while True:
+        if cache.add(lock_key, True, _LOCK_TIMEOUT):
+            try:
+                value = compute_value()
+                cache.set_many({key: value, stale_key: value}, _TIMEOUT)
+            except EcoserviceError:
+                # Serve the previous value while the ecoservice is failing
+                value = cache.get(stale_key)
+                if value is None:
+                    raise
+            finally:
+                cache.delete(lock_key)
+            return value
+
+        # Another request is computing the value
+        values = cache.get_many([key, stale_key])
+        value = values.get(key, values.get(stale_key))
+        if value is not None:
+            return value
+        elif time.time() > give_up_at:
+            return compute_value()
+
+        time.sleep(_LOCK_POLL_SECONDS)
+
+
 def _get_key(prefix, filter):
     if filter and (filter.filterstr or filter.displaystr):
         # Example of why eco_rev is insufficient when a filter is active:
@@ -67,42 +150,188 @@ def _get_key(prefix, filter):
         # We are computing benefits for features other than trees
         version = filter.instance.universal_rev
 
-    filter_key = '%s/%s' % (filter.filterstr, filter.displaystr)
-    # Explicitly calling `encode()` ensures that the presence of a
-    # unicode symbol in the filter string will not raise a
-    # UnicodeEncodeError exception when calling `md5()`
-    filter_hash = hashlib.md5(filter_key.encode('utf-8')).hexdigest()
     key = "%s/%s/%s/%s" % (prefix,
                            filter.instance.url_name,
                            version,
-                           filter_hash)
+                           _get_filter_hash(filter))
     return key
 
 
+def _get_stale_key(prefix, filter):
+    return "%s/%s/latest/%s" % (prefix,
+                                filter.instance.url_name,
+                                _get_filter_hash(filter))
+
+
+def _get_filter_hash(filter):
+    filter_key = '%s/%s' % (filter.filterstr, filter.displaystr)
+    # Explicitly calling `encode()` ensures that the presence of a
+    # unicode symbol in the filter string will not raise a
+    # UnicodeEncodeError exception when calling `md5()`
+    return hashlib.md5(filter_key.encode('utf-8')).hexdigest()
+
+
+# ----------------------------------------------------------------
+# The benefits of a single tree depend only on its species (and any i-Tree
+# code override for it), i-Tree region and diameter, and many trees share
+# these. Raw single-tree benefits are memoized in a bounded per-process LRU
+# backed by the shared cache.
+#
+# Tree key is eco/tree/<instance_id>/<itree_code_override_rev>/
+#     <species_id>/<otm_code>/<region_code>/<diameter>
+#
+# Currency conversions are applied after the raw benefits are looked up,
+# so changing them needs no invalidation.
+
+_tree_benefits_lru = OrderedDict()
+_tree_benefits_lock = threading.Lock()
+_tree_benefits_stats = {'lru_hits': 0, 'cache_hits': 0, 'misses': 0}
+
+
+def _tree_benefits_key(instance, override_rev, species, diameter,
+                       region_code):
+    return 'eco/tree/%s/%s/%s/%s/%s/%r' % (
+        instance.pk, override_rev, species.pk, species.otm_code,
+        region_code, diameter)
+
+
+def get_memoized_tree_benefits(instance, species, diameter, region_code,
+                               compute_value):
+    """
+    Return the (raw benefits, error) tuple returned by `compute_value` for
+    a tree with the given inputs, computing it only if it has not been
+    memoized. Errors are not memoized.
+    """
+    tree = (species, diameter, region_code)
+    return get_memoized_trees_benefits(
+        instance, [tree], lambda trees: {tree: compute_value()})[tree]
+
+
+def get_memoized_trees_benefits(instance, trees, compute_values):
+    """
+    Like get_memoized_tree_benefits, for a list of distinct
+    (species, diameter, region_code) tuples. `compute_values` is called at
+    most once, with the trees that have not been memoized, and returns a
+    dict mapping each of them to its (raw benefits, error) tuple.
+    Returns a dict mapping every tree to its tuple.
+    """
+    if not settings.USE_ECO_CACHE:
+        return compute_values(trees) if trees else {}
+
+    override_rev = get_itree_code_override_rev()
+    keys = {tree: _tree_benefits_key(instance, override_rev, *tree)
+            for tree in trees}
+    results = {}
+
+    with _tree_benefits_lock:
+        for tree, key in keys.iteritems():
+            value = _tree_benefits_lru.pop(key, None)
+            if value is not None:
+                # Re-insert the value to mark it most recently used
+                _tree_benefits_lru[key] = value
+                _tree_benefits_stats['lru_hits'] += 1
+                results[tree] = (deepcopy(value), None)
+
+    unknown = [tree for tree in trees if tree not in results]
+    cached = cache.get_many([keys[tree] for tree in unknown])
+    found = {keys[tree]: cached[keys[tree]] for tree in unknown
+             if keys[tree] in cached}
+    missing = [tree for tree in unknown if keys[tree] not in cached]
+
+    computed = {}
+    n_errors = 0
+    if missing:
+        for tree, (value, err) in compute_values(missing).iteritems():
+            if err:
+                n_errors += 1
+                results[tree] = (value, err)
+            else:
+                computed[keys[tree]] = value
+        cache.set_many(computed, _TIMEOUT)
+
+    with _tree_benefits_lock:
+        _tree_benefits_stats['cache_hits'] += len(found)
+        _tree_benefits_stats['misses'] += len(computed) + n_errors
+        for key, value in itertools.chain(found.iteritems(),
+                                          computed.iteritems()):
+            _tree_benefits_lru[key] = value
+        while len(_tree_benefits_lru) > settings.ECO_TREE_BENEFITS_LRU_SIZE:
+            _tree_benefits_lru.popitem(last=False)
+
+    for tree in unknown:
+        value = found.get(keys[tree], computed.get(keys[tree]))
+        if value is not None:
+            results[tree] = (deepcopy(value), None)
+
+    return results
+
+
+def get_tree_benefits_memo_stats():
+    """
+    Return this process's counts of memoized tree benefits found in the
+    LRU, found in the shared cache, and computed
+    """
+    with _tree_benefits_lock:
+        return dict(_tree_benefits_stats)
+
+
+def clear_tree_benefits_lru():
+    with _tree_benefits_lock:
+        _tree_benefits_lru.clear()
+
+
 # ----------------------------------------------------------------
 # The ecoservice keeps a cache of i-Tree code overrides.
 # Store a cache buster in Redis, and keep a local copy.
 # If the local copy is stale, invalidate the cache of the local ecoservice.
 
 _ITREE_CODE_OVERRIDE_REV_KEY = 'itree_code_override_rev'
+_ITREE_CODE_OVERRIDE_REV_CHECK_SECONDS = 5
 my_itree_code_override_rev = None
+_cached_itree_code_override_rev = None
+_cached_itree_code_override_rev_read_at = None
 
 
 def _increment_itree_code_override_rev(*args, **kwargs):
+    global _cached_itree_code_override_rev_read_at
+
     _init_if_needed()
     cache.incr(_ITREE_CODE_OVERRIDE_REV_KEY)
+    # Read the rev again before this process next uses it
+    _cached_itree_code_override_rev_read_at = None
+
+
+def get_itree_code_override_rev():
+    """
+    Return the rev of i-Tree code overrides. Overrides rarely change, so
+    the rev is read from the cache at most every
+    _ITREE_CODE_OVERRIDE_REV_CHECK_SECONDS, and changes made by other
+    processes are picked up within that time.
+    """
+    global _cached_itree_code_override_rev
+    global _cached_itree_code_override_rev_read_at
+
+    now = time.time()
+    read_at = _cached_itree_code_override_rev_read_at
+    if read_at is None or \
+            now - read_at >= _ITREE_CODE_OVERRIDE_REV_CHECK_SECONDS:
+        _cached_itree_code_override_rev = _init_if_needed()
+        _cached_itree_code_override_rev_read_at = now
+
+    return _cached_itree_code_override_rev
 
 
 def invalidate_ecoservice_cache_if_stale():
     from treemap import ecobackend
     global my_itree_code_override_rev
 
-    cached_rev = _init_if_needed()
+    cached_rev = get_itree_code_override_rev()
 
     if my_itree_code_override_rev != cached_rev:
         __, err = ecobackend.json_benefits_call('invalidate_cache', {})
         if err:
-            raise Exception('Failed to invalidate ecoservice cache')
+            raise ecobackend.EcoserviceError(
+                'Failed to invalidate ecoservice cache')
         my_itree_code_override_rev = cached_rev
 
 
@@ -30,7 +30,7 @@ from treemap.search_fields import (
 
 from treemap.species import SPECIES
 from treemap.json_field import JSONField
-from treemap.lib.object_caches import udf_defs
+from treemap.lib.object_caches import udf_defs, itree_regions
 from treemap.species.codes import (species_codes_for_regions,
                                    all_species_codes, ITREE_REGION_CHOICES)
 from treemap.DotDict import DotDict
@@ -295,6 +295,10 @@ class Instance(models.Model):
     # Monotonically increasing number used to invalidate my InstanceAdjuncts
     adjuncts_timestamp = models.BigIntegerField(default=0)
 
+    # Monotonically increasing number used to invalidate only the species
+    # maps held with my InstanceAdjuncts
+    species_rev = models.BigIntegerField(default=0)
+
     """
     Flag indicating whether canopy data is available and should be displayed.
     """
@@ -352,6 +356,9 @@ class Instance(models.Model):
 
     custom_layers = _make_config_property('custom_layers', [])
 
+    # The geo_rev when hide_at_zoom was last recomputed
+    hide_at_zoom_geo_rev = _make_config_property('hide_at_zoom_geo_rev')
+
     non_admins_can_export = models.BooleanField(default=True)
 
     @property
@@ -619,16 +626,23 @@ class Instance(models.Model):
         for attr in attrs:
             setattr(self, attr, getattr(qs[0], attr))
 
+        if settings.USE_ECO_CACHE and settings.WARM_ECO_CACHE:
+            from treemap.ecocache import queue_eco_cache_warming
+            transaction.on_commit(lambda: queue_eco_cache_warming(self.pk))
+
     def itree_regions(self, **extra_query):
         from treemap.models import ITreeRegion, ITreeRegionInMemory
 
-        query = {'geometry__intersects': self.bounds.geom}
-        query.update(extra_query)
-
         if self.itree_region_default:
             return [ITreeRegionInMemory(self.itree_region_default)]
-        else:
+        elif extra_query:
+            query = {'geometry__intersects': self.bounds.geom}
+            query.update(extra_query)
             return ITreeRegion.objects.filter(**query)
+        else:
+            # Checked on every instance request, so served from the
+            # instance's object cache rather than a spatial query
+            return itree_regions(self)
 
     def has_itree_region(self):
         return bool(self.itree_regions())
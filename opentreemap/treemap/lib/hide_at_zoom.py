@@ -7,8 +7,6 @@ from math import floor
 
 from django.db import connection
 
-from treemap.models import MapFeature
-
 GRID_PIXELS = 2
 MAX_ZOOM = 14
 MIN_ZOOM = 0
@@ -27,34 +25,81 @@ MIN_ZOOM = 0
 # current tree dot size of 5 pixels.
 
 
-def recompute_hide_at_zoom(instance, verbose=False):
-    # TODO: skip if geo_rev hasn't changed
+def recompute_hide_at_zoom(instance, verbose=False, force=False):
+    if not force and instance.hide_at_zoom_geo_rev == instance.geo_rev:
+        if verbose:
+            print('\nSkipping instance %s, geo_rev has not changed'
+                  % instance.url_name)
+        return
+
     if verbose:
         print('\nUpdating instance %s' % instance.url_name)
 
-    MapFeature.objects.all() \
-        .filter(instance=instance) \
-        .update(hide_at_zoom=None)
+    with connection.cursor() as cursor:
+        cursor.execute(_SQL_FETCH, {'instance_id': instance.id})
+        features = cursor.fetchall()
+
+    hide_at_zoom = _compute_hide_at_zoom(
+        [(id, x, y) for id, feature_type, x, y, __ in features
+         if feature_type == 'Plot'],
+        verbose)
+
+    changed = [(id, hide_at_zoom.get(id))
+               for id, __, __, __, old_value in features
+               if hide_at_zoom.get(id) != old_value]
+
+    if changed:
+        ids, values = zip(*changed)
+        with connection.cursor() as cursor:
+            cursor.execute(_SQL_UPDATE, {'ids': list(ids),
+                                         'values': list(values)})
+        instance.update_geo_rev()
+
+    if verbose:
+        print('Changed %s of %s features' % (len(changed), len(features)))
+
+    # Only set the one config key, in case `instance` is stale
+    instance.hide_at_zoom_geo_rev = instance.geo_rev
+    with connection.cursor() as cursor:
+        cursor.execute(_SQL_SET_GEO_REV, {'instance_id': instance.id,
+                                          'geo_rev': instance.geo_rev})
+
+
+def _compute_hide_at_zoom(plots, verbose=False):
+    """
+    Given (id, x, y) tuples sorted by id, return a dict mapping the id of
+    each plot that should be hidden to the zoom level it is hidden at.
+
+    Starting at the highest zoom, the plots still visible at each zoom
+    level are hashed into grid cells. The first plot in each cell stays
+    visible and the rest are hidden at that zoom. Keeping the plot with
+    the lowest id makes the result stable across runs.
+    """
+    hide_at_zoom = {}
+    visible = plots
 
-    _print_summary(instance, MAX_ZOOM + 1, verbose)
+    _print_summary(MAX_ZOOM + 1, len(visible), verbose)
     for zoom in range(MAX_ZOOM, MIN_ZOOM - 1, -1):
         grid_size_wm = _get_grid_size_wm(GRID_PIXELS, zoom)
-        with connection.cursor() as cursor:
-            cursor.execute(_SQL_RECOMPUTE, {
-                'instance_id': instance.id,
-                'grid_size': grid_size_wm,
-                'zoom': zoom
-            })
-        _print_summary(instance, zoom, verbose)
+        occupied = set()
+        still_visible = []
+        for plot in visible:
+            id, x, y = plot
+            cell = (floor(x / grid_size_wm), floor(y / grid_size_wm))
+            if cell in occupied:
+                hide_at_zoom[id] = zoom
+            else:
+                occupied.add(cell)
+                still_visible.append(plot)
+        visible = still_visible
+        _print_summary(zoom, len(visible), verbose)
 
-    instance.update_geo_rev()
+    return hide_at_zoom
 
 
-def _print_summary(instance, zoom, verbose):
+def _print_summary(zoom, n_visible, verbose):
     if verbose:
-        features = MapFeature.objects.filter(instance=instance,
-                                             hide_at_zoom=None)
-        print("{1:>2}  {0:>7}".format(features.count(), zoom))
+        print("{1:>2}  {0:>7}".format(n_visible, zoom))
 
 
 def _get_grid_size_wm(grid_pixels, zoom):
@@ -68,44 +113,39 @@ def _get_grid_size_wm(grid_pixels, zoom):
 # Notes:
 # 1) Ignore non-plots. They aren't numerous, and it simplifies
 #    both the tiler and opt-out of green infrastructure types.
+#    Their hide_at_zoom is cleared.
 # 2) Not using ST_SnapToGrid because results were not consistent across runs.
 
-_SQL_RECOMPUTE = """
-    WITH featuresToHide AS (
-        WITH mapfeature AS (
-            /* Get all plots in instance with hide_at_zoom not set */
-             SELECT f.id, f.the_geom_webmercator
-             FROM treemap_mapfeature f
-             INNER JOIN treemap_instance i ON f.instance_id=i.id
-             WHERE i.id=%(instance_id)s
-               AND f.feature_type='Plot'
-               AND f.hide_at_zoom IS NULL
-        )
-        SELECT mapfeature.id FROM mapfeature
-        LEFT OUTER JOIN
-            /* Choose one feature from each grid cell */
-            (SELECT DISTINCT ON (geom)
-                id,
-                ST_MakePoint(floor(ST_X(the_geom_webmercator) / %(grid_size)s),
-                             floor(ST_Y(the_geom_webmercator) / %(grid_size)s))
-                    AS geom
-              FROM mapfeature
-            ) AS distinctRows
-            ON mapfeature.id = distinctRows.id
-        /* Now get the features NOT chosen */
-        WHERE distinctRows.id IS NULL
-    )
+_SQL_FETCH = """
+    SELECT id, feature_type,
+           ST_X(the_geom_webmercator), ST_Y(the_geom_webmercator),
+           hide_at_zoom
+    FROM treemap_mapfeature
+    WHERE instance_id = %(instance_id)s
+    ORDER BY id;
+    """
+
+_SQL_UPDATE = """
     UPDATE treemap_mapfeature f
-    SET hide_at_zoom = %(zoom)s
-    FROM featuresToHide
-    WHERE f.id = featuresToHide.id;
+    SET hide_at_zoom = changed.hide_at_zoom
+    FROM unnest(%(ids)s::integer[], %(values)s::integer[])
+        AS changed(id, hide_at_zoom)
+    WHERE f.id = changed.id;
+    """
+
+_SQL_SET_GEO_REV = """
+    UPDATE treemap_instance
+    SET config = jsonb_set(COALESCE(NULLIF(config, ''), '{}')::jsonb,
+                           '{hide_at_zoom_geo_rev}',
+                           to_jsonb(%(geo_rev)s::integer))::text
+    WHERE id = %(instance_id)s;
     """
 
 
 def update_hide_at_zoom_after_delete(feature):
     if feature.feature_type == 'Plot':
-        _reveal_a_hidden_plot(
-            feature.instance, feature.geom, feature.hide_at_zoom)
+        update_hide_at_zoom_after_bulk_delete(
+            feature.instance, [(feature.geom, feature.hide_at_zoom)])
 
 
 def update_hide_at_zoom_after_move(feature, user, point_old):
@@ -120,46 +160,111 @@ def update_hide_at_zoom_after_move(feature, user, point_old):
         feature.hide_at_zoom = None
         feature.save_with_user(user)
 
-        _reveal_a_hidden_plot(feature.instance, point_old, hide_at_zoom_old)
+        update_hide_at_zoom_after_bulk_delete(
+            feature.instance, [(point_old, hide_at_zoom_old)])
 
 
-def _reveal_a_hidden_plot(instance, point, hide_at_zoom):
-    min_zoom = MIN_ZOOM - 1 if hide_at_zoom is None else hide_at_zoom
+def update_hide_at_zoom_after_bulk_move(instance, moves):
+    """
+    Like update_hide_at_zoom_after_move for many plots at once.
+    `moves` is a list of (plot id, old point, old hide_at_zoom) tuples.
+    """
+    if not moves:
+        return
 
-    for zoom in range(MAX_ZOOM, min_zoom, -1):
-        grid_size_wm = _get_grid_size_wm(GRID_PIXELS, zoom)
+    with connection.cursor() as cursor:
+        cursor.execute(_SQL_SHOW, {'ids': [id for id, __, __ in moves]})
+
+    update_hide_at_zoom_after_bulk_delete(
+        instance, [(point, hide_at_zoom) for __, point, hide_at_zoom in moves])
+
+
+def update_hide_at_zoom_after_bulk_delete(instance, removed):
+    """
+    Reveal hidden plots to fill the holes left by removed plots.
+    `removed` is a list of (point, hide_at_zoom) tuples.
+
+    Uses at most one query per zoom level and one update regardless of
+    the number of plots. A hidden plot fills at most one hole.
+    """
+    # Removed plots without a replacement yet, with their hide_at_zoom
+    unresolved = list(removed)
+    # New hide_at_zoom of each revealed plot
+    revealed = {}
+
+    for zoom in range(MAX_ZOOM, MIN_ZOOM - 1, -1):
         # Plot that disappeared was visible at this zoom level.
         # Reveal a hidden plot if there's one in this cell.
+        unresolved = [(point, hide_at_zoom)
+                      for point, hide_at_zoom in unresolved
+                      if hide_at_zoom is None or hide_at_zoom < zoom]
+        if not unresolved:
+            break
+
+        grid_size_wm = _get_grid_size_wm(GRID_PIXELS, zoom)
+
+        def cell_of(point):
+            return (floor(point.x / grid_size_wm),
+                    floor(point.y / grid_size_wm))
+
+        cells = {cell_of(point) for point, __ in unresolved}
+        hidden_by_cell = _get_hidden_plots_by_cell(
+            instance, zoom, grid_size_wm, cells)
+
+        still_unresolved = []
+        for point, hide_at_zoom in unresolved:
+            candidates = [id for id in hidden_by_cell.get(cell_of(point), [])
+                          if id not in revealed]
+            if candidates:
+                revealed[candidates[0]] = hide_at_zoom
+            else:
+                still_unresolved.append((point, hide_at_zoom))
+        unresolved = still_unresolved
+
+    if revealed:
+        ids, values = zip(*revealed.items())
         with connection.cursor() as cursor:
-            cursor.execute(_SQL_REVEAL, {
-                'instance_id': instance.id,
-                'grid_size': grid_size_wm,
-                'zoom': zoom,
-                'hide_at_zoom': hide_at_zoom,
-                'cell_x': floor(point.x / grid_size_wm),
-                'cell_y': floor(point.y / grid_size_wm),
-            })
-            result = cursor.fetchone()
-            if result is not None:
-                # Found one. Its hide_at_zoom has been lowered so it will fill
-                # the hole left by the old plot.
-                return
-
-
-_SQL_REVEAL = """
-    UPDATE treemap_mapfeature f
-    SET hide_at_zoom = %(hide_at_zoom)s
-    FROM (
-         SELECT f.id
-         FROM treemap_mapfeature f
-         INNER JOIN treemap_instance i ON f.instance_id=i.id
-         WHERE i.id = %(instance_id)s
-           AND f.feature_type = 'Plot'
-           AND f.hide_at_zoom >= %(zoom)s
-           AND floor(ST_X(the_geom_webmercator) / %(grid_size)s) = %(cell_x)s
-           AND floor(ST_Y(the_geom_webmercator) / %(grid_size)s) = %(cell_y)s
-         LIMIT 1
-         ) feature_to_reveal
-    WHERE f.id = feature_to_reveal.id
-    RETURNING feature_to_reveal.id;
+            cursor.execute(_SQL_UPDATE, {'ids': list(ids),
+                                         'values': list(values)})
+
+
+def _get_hidden_plots_by_cell(instance, zoom, grid_size_wm, cells):
+    cell_xs, cell_ys = zip(*cells)
+    with connection.cursor() as cursor:
+        cursor.execute(_SQL_HIDDEN_IN_CELLS, {
+            'instance_id': instance.id,
+            'grid_size': grid_size_wm,
+            'zoom': zoom,
+            'cell_xs': list(cell_xs),
+            'cell_ys': list(cell_ys),
+        })
+        rows = cursor.fetchall()
+
+    hidden_by_cell = {}
+    for cell_x, cell_y, id in rows:
+        hidden_by_cell.setdefault((cell_x, cell_y), []).append(id)
+    return hidden_by_cell
+
+
+_SQL_SHOW = """
+    UPDATE treemap_mapfeature
+    SET hide_at_zoom = NULL
+    WHERE id = ANY(%(ids)s::integer[]);
+    """
+
+# The bounding box test lets the spatial index find the plots in each cell
+_SQL_HIDDEN_IN_CELLS = """
+    SELECT cell.x, cell.y, f.id
+    FROM unnest(%(cell_xs)s::float8[], %(cell_ys)s::float8[]) AS cell(x, y)
+    INNER JOIN treemap_mapfeature f
+      ON f.the_geom_webmercator && ST_MakeEnvelope(
+            cell.x * %(grid_size)s, cell.y * %(grid_size)s,
+            (cell.x + 1) * %(grid_size)s, (cell.y + 1) * %(grid_size)s,
+            3857)
+     AND floor(ST_X(f.the_geom_webmercator) / %(grid_size)s) = cell.x
+     AND floor(ST_Y(f.the_geom_webmercator) / %(grid_size)s) = cell.y
+    WHERE f.instance_id = %(instance_id)s
+      AND f.feature_type = 'Plot'
+      AND f.hide_at_zoom >= %(zoom)s
+    ORDER BY f.id;
     """
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.db import connection
+
+from treemap.models import ITreeRegion, MapFeature
+
+# MapFeature.itree_region_code stores the code of the i-Tree region
+# containing each map feature ('' if none does), so eco calculations can
+# group trees by region without a spatial query per tree.
+#
+# It is set whenever a map feature is saved with a new location.
+# These functions set it for features created or moved in bulk, and fill
+# it for existing features.
+
+
+def assign_itree_region_codes(instance, features):
+    """
+    Set itree_region_code on unsaved map features of an instance, testing
+    their locations against the instance's regions in memory
+    """
+    regions = [(region.code, region.geometry.prepared)
+               for region in ITreeRegion.objects.filter(
+                   geometry__intersects=instance.bounds.geom)]
+
+    for feature in features:
+        feature.itree_region_code = next(
+            (code for code, geometry in regions
+             if geometry.contains(feature.geom)), '')
+
+
+def fill_itree_region_codes(instance, force=False):
+    """
+    Set itree_region_code on the instance's map features that don't have
+    one, or on all of them if `force` is True (e.g. after i-Tree regions
+    have been reloaded). Returns the number of features updated.
+    """
+    sql = _SQL_FILL if force else _SQL_FILL + _SQL_ONLY_MISSING
+    with connection.cursor() as cursor:
+        cursor.execute(sql % {'feature_table': MapFeature._meta.db_table,
+                              'region_table': ITreeRegion._meta.db_table},
+                       {'instance_id': instance.pk})
+        return cursor.rowcount
+
+
+_SQL_FILL = """
+    UPDATE %(feature_table)s f
+    SET itree_region_code = COALESCE(
+        (SELECT r.code
+         FROM %(region_table)s r
+         WHERE ST_Contains(r.geometry, f.the_geom_webmercator)
+         LIMIT 1), '')
+    WHERE f.instance_id = %%(instance_id)s
+    """
+
+_SQL_ONLY_MISSING = """
+      AND f.itree_region_code IS NULL
+    """
@@ -3,6 +3,8 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
+from copy import copy
+
 from django.conf import settings
 from django.db.models import F
 
@@ -15,6 +17,9 @@ from django.db.models import F
 # When an adjunct object is modified (saved to the db or deleted), invalidate
 # the appropriate instance's cache and update its timestamp. The timestamp
 # update will cause the change to propagate to any other servers.
+#
+# Species maps are tracked by their own rev (instance.species_rev), so
+# editing species doesn't drop an instance's other adjunct objects.
 
 _adjuncts = {}
 
@@ -48,6 +53,27 @@ def udf_defs(instance, model_name=None):
         return _udf_defs_from_db(instance, model_name)
 
 
+def itree_regions(instance):
+    if settings.USE_OBJECT_CACHES:
+        return _get_adjuncts(instance).itree_regions(instance)
+    else:
+        return _itree_regions_from_db(instance)
+
+
+def species_resolver(instance, region_code):
+    """
+    Return a function that maps an OTM code to the instance Species that
+    Species.get_by_code would return for it in the specified region, or
+    None. The function returns copies, which callers may modify.
+    """
+    if settings.USE_OBJECT_CACHES:
+        species_map = _get_adjuncts(instance).species_map(
+            instance.species_rev, region_code)
+    else:
+        species_map = _species_map_from_db(instance, region_code)
+    return species_map.get
+
+
 def clear_caches():
     global _adjuncts
     _adjuncts = {}
@@ -63,6 +89,51 @@ def invalidate_adjuncts(*args, **kwargs):
         increment_adjuncts_timestamp(instance)
 
 
+def invalidate_boundary_adjuncts(*args, **kwargs):
+    # Called by 'save' and 'delete' signal handlers for Boundary.
+    # Compiled search filters embed boundary geometries, so editing or
+    # deleting a boundary must invalidate them for every instance that
+    # uses it. Newly created boundaries can't be referenced by a cached
+    # filter yet.
+    if settings.USE_FILTER_CACHE and not kwargs.get('created'):
+        boundary = kwargs['instance']  # 'instance' is a Django term here
+        for instance in boundary.instance_set.all():
+            increment_adjuncts_timestamp(instance)
+
+
+def invalidate_itree_region_adjuncts(*args, **kwargs):
+    # Called by 'save' and 'delete' signal handlers for ITreeRegion and
+    # InstanceBounds, which determine the regions intersecting an instance.
+    # Regions are loaded rarely and can cover many instances, so a region
+    # change invalidates every instance.
+    if settings.USE_OBJECT_CACHES:
+        from treemap.models import Instance, ITreeRegion
+        obj = kwargs['instance']  # 'instance' is a Django term here
+        if isinstance(obj, ITreeRegion):
+            instances = Instance.objects.all()
+        else:
+            instances = Instance.objects.filter(bounds_id=obj.pk)
+        instances.update(adjuncts_timestamp=F('adjuncts_timestamp') + 1)
+
+
+def invalidate_species_adjuncts(*args, **kwargs):
+    # Called by 'save' and 'delete' signal handlers for Species and
+    # ITreeCodeOverride, which only affect the species maps
+    if settings.USE_OBJECT_CACHES:
+        from treemap.models import Instance, Species
+        obj = kwargs['instance']  # 'instance' is a Django term here
+        if isinstance(obj, Species):
+            instance = obj.instance
+            qs = Instance.objects.filter(pk=instance.id)
+            qs.update(species_rev=F('species_rev') + 1)
+            # Update rev from DB so this instance sees the change
+            instance.species_rev = qs[0].species_rev
+        else:
+            Instance.objects \
+                .filter(species__pk=obj.instance_species_id) \
+                .update(species_rev=F('species_rev') + 1)
+
+
 def increment_adjuncts_timestamp(instance):
     # Increment the timestamp carefully.
     # Don't call save(), to avoid storing possibly-stale data in "instance".
@@ -100,6 +171,44 @@ def _udf_defs_from_db(instance, model_name):
         defs = defs.filter(model_type=model_name)
     return list(defs)
 
+
+def _itree_regions_from_db(instance):
+    from treemap.models import ITreeRegion
+    return list(ITreeRegion.objects.filter(
+        geometry__intersects=instance.bounds.geom))
+
+
+def _species_map_from_db(instance, region_code):
+    from treemap.models import Species, ITreeCodeOverride
+    return _SpeciesMap(
+        Species.objects.filter(instance=instance).order_by('pk'),
+        ITreeCodeOverride.objects
+        .filter(instance_species__instance=instance,
+                region__code=region_code)
+        .select_related('instance_species')
+        .order_by('pk'),
+        region_code)
+
+
+class _SpeciesMap(object):
+    def __init__(self, species, overrides, region_code):
+        self._region_code = region_code
+        self._by_otm_code = {}
+        for s in species:
+            self._by_otm_code.setdefault(s.otm_code, s)
+        self._by_itree_code = {}
+        for override in overrides:
+            self._by_itree_code.setdefault(override.itree_code,
+                                           override.instance_species)
+
+    def get(self, otm_code):
+        from treemap.species.codes import get_itree_code
+        species = self._by_otm_code.get(otm_code)
+        if species is None:
+            itree_code = get_itree_code(self._region_code, otm_code)
+            species = self._by_itree_code.get(itree_code)
+        return copy(species) if species is not None else None
+
 # ------------------------------------------------------------------------
 # Fetch info from cache
 
@@ -118,6 +227,10 @@ class _InstanceAdjuncts:
         self._user_role_ids = {}
         self._permissions = {}
         self._udf_defs = {}
+        self._itree_regions = None
+        self._itree_regions_bounds_id = None
+        self._species_maps = {}
+        self._species_rev = instance.species_rev
         self.timestamp = instance.adjuncts_timestamp
 
     def permissions(self, user, model_name):
@@ -139,6 +252,24 @@ class _InstanceAdjuncts:
             self._load_udf_defs()
         return self._udf_defs.get(model_name, [])
 
+    def itree_regions(self, instance):
+        # Checking the caller's bounds_id catches an instance being given
+        # new bounds, which doesn't touch the instance's adjuncts_timestamp
+        if (self._itree_regions is None or
+                self._itree_regions_bounds_id != instance.bounds_id):
+            self._itree_regions = _itree_regions_from_db(instance)
+            self._itree_regions_bounds_id = instance.bounds_id
+        return self._itree_regions
+
+    def species_map(self, species_rev, region_code):
+        if species_rev > self._species_rev:
+            self._species_maps = {}
+            self._species_rev = species_rev
+        if region_code not in self._species_maps:
+            self._species_maps[region_code] = _species_map_from_db(
+                self._instance, region_code)
+        return self._species_maps[region_code]
+
     def _load_roles(self):
         from treemap.models import InstanceUser
 
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ObjectDoesNotExist
+
+from treemap.instance import Instance
+from treemap.lib.itree_region import fill_itree_region_codes
+
+
+class Command(BaseCommand):
+    help = ('Stores the code of the i-Tree region containing each map '
+            'feature, for all instances or specified instance')
+
+    def add_arguments(self, parser):
+        parser.add_argument('instance_url_name', nargs='?', default=None)
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help='Recompute codes that are already stored, e.g. after '
+                 'i-Tree regions have been reloaded')
+
+    def handle(self, *args, **options):
+        if options['instance_url_name'] is None:
+            instances = Instance.objects.all()
+        else:
+            url_name = options['instance_url_name']
+            try:
+                instances = [Instance.objects.get(url_name=url_name)]
+            except ObjectDoesNotExist:
+                raise CommandError('Instance "%s" not found' % url_name)
+
+        for instance in instances:
+            n_updated = fill_itree_region_codes(instance, options['force'])
+            self.stdout.write('%s: stored i-Tree region codes for %s map '
+                              'features' % (instance.url_name, n_updated))
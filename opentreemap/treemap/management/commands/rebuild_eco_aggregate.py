@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ObjectDoesNotExist
+
+from treemap.ecoaggregate import rebuild_aggregate, verify_aggregate
+from treemap.instance import Instance
+from treemap.models import Tree
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the incrementally maintained eco benefit totals for '
+            'all instances or specified instance')
+
+    def add_arguments(self, parser):
+        parser.add_argument('instance_url_name', nargs='?', default=None)
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            dest='verify',
+            default=False,
+            help='Compare existing totals with a full calculation instead '
+                 'of rebuilding them')
+
+    def handle(self, *args, **options):
+        if options['instance_url_name'] is None:
+            instance_ids = Tree.objects \
+                .order_by('instance_id') \
+                .distinct('instance_id') \
+                .values_list('instance_id', flat=True)
+            instances = Instance.objects.filter(pk__in=list(instance_ids))
+        else:
+            url_name = options['instance_url_name']
+            try:
+                instances = [Instance.objects.get(url_name=url_name)]
+            except ObjectDoesNotExist:
+                raise CommandError('Instance "%s" not found' % url_name)
+
+        for instance in instances:
+            if not instance.has_itree_region():
+                continue
+            if options['verify']:
+                self._verify(instance)
+            elif rebuild_aggregate(instance):
+                self.stdout.write('Rebuilt eco benefit totals for %s'
+                                  % instance.url_name)
+            else:
+                self.stdout.write('%s: trees kept changing while eco '
+                                  'benefit totals were being rebuilt, '
+                                  'try again later' % instance.url_name)
+
+    def _verify(self, instance):
+        differences = verify_aggregate(instance)
+        if differences is None:
+            self.stdout.write('%s: eco benefit totals have not been built'
+                              % instance.url_name)
+        elif not differences:
+            self.stdout.write('%s: eco benefit totals are correct'
+                              % instance.url_name)
+        else:
+            for factor, (maintained, computed) in sorted(
+                    differences.iteritems()):
+                self.stdout.write('%s: %s is %s, expected %s'
+                                  % (instance.url_name, factor,
+                                     maintained, computed))
@@ -14,10 +14,16 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('instance_url_name', nargs='?', default=None)
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help='Recompute even if geo_rev has not changed')
 
     def handle(self, *args, **options):
         if options['instance_url_name'] is None:
-            _update_all_instances()
+            _update_all_instances(options['force'])
 
         else:
             url_name = options['instance_url_name']
@@ -26,10 +32,11 @@ class Command(BaseCommand):
             except ObjectDoesNotExist:
                 raise CommandError('Instance "%s" not found' % url_name)
 
-            recompute_hide_at_zoom(instance, verbose=True)
+            recompute_hide_at_zoom(instance, verbose=True,
+                                   force=options['force'])
 
 
-def _update_all_instances():
+def _update_all_instances(force):
     instance_ids = MapFeature.objects \
         .values('instance_id') \
         .annotate(n=Count('instance_id')) \
@@ -38,4 +45,4 @@ def _update_all_instances():
 
     for id in instance_ids:
         instance = Instance.objects.get(id=id)
-        recompute_hide_at_zoom(instance, verbose=True)
+        recompute_hide_at_zoom(instance, verbose=True, force=force)
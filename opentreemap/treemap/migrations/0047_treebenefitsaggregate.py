@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import treemap.json_field
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('treemap', '0046_auto_20170907_0937'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TreeBenefitsAggregate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('species_id', models.IntegerField(null=True)),
+                ('region_code', models.CharField(blank=True, max_length=40)),
+                ('n_trees', models.IntegerField(default=0)),
+                ('benefits', treemap.json_field.JSONField(blank=True, default=dict)),
+                ('instance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='treemap.Instance')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='treebenefitsaggregate',
+            unique_together=set([('instance', 'species_id', 'region_code')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('treemap', '0047_treebenefitsaggregate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mapfeature',
+            name='itree_region_code',
+            field=models.CharField(default=None, max_length=40, null=True,
+                                   blank=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('treemap', '0048_mapfeature_itree_region_code'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='treebenefitsaggregate',
+            name='eco_rev',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('treemap', '0049_treebenefitsaggregate_eco_rev'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='instance',
+            name='species_rev',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
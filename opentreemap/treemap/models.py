@@ -18,7 +18,7 @@ from django.http import Http404
 from django.contrib.gis.db import models
 from django.contrib.gis.measure import D
 from django.db import IntegrityError, transaction
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import (UserManager, AbstractBaseUser,
@@ -34,8 +34,13 @@ from treemap.decorators import classproperty
 from treemap.images import save_uploaded_image
 from treemap.units import Convertible
 from treemap.udf import UDFModel
-from treemap.instance import Instance
-from treemap.lib.object_caches import invalidate_adjuncts
+from treemap.instance import Instance, InstanceBounds
+from treemap.json_field import JSONField
+from treemap.lib.object_caches import (invalidate_adjuncts,
+                                       invalidate_boundary_adjuncts,
+                                       invalidate_itree_region_adjuncts,
+                                       invalidate_species_adjuncts,
+                                       species_resolver)
 
 
 def _action_format_string_for_location(action):
@@ -520,22 +525,7 @@ class Species(PendingAuditable, models.Model):
         ITreeCodeOverride that has a itree_code matching the specified otm_code
         in the specified region.
         """
-        species = Species.objects.filter(instance=instance, otm_code=otm_code)
-        if species.exists():
-            return species[0]
-        else:
-            species_ids = \
-                Species.objects.filter(instance=instance).values('pk')
-            region = ITreeRegion.objects.get(code=region_code)
-            itree_code = get_itree_code(region_code, otm_code)
-            overrides = ITreeCodeOverride.objects.filter(
-                itree_code=itree_code,
-                region=region,
-                instance_species_id__in=species_ids)
-            if overrides.exists():
-                return overrides[0].instance_species
-            else:
-                return None
+        return species_resolver(instance, region_code)(otm_code)
 
     def get_itree_code(self, region_code=None):
         if not region_code:
@@ -563,6 +553,10 @@ class Species(PendingAuditable, models.Model):
                            'cultivar', 'other_part_of_name',)
 
 
+post_save.connect(invalidate_species_adjuncts, sender=Species)
+post_delete.connect(invalidate_species_adjuncts, sender=Species)
+
+
 class InstanceUser(Auditable, models.Model):
     instance = models.ForeignKey(Instance)
     user = models.ForeignKey(User)
@@ -645,6 +639,12 @@ class MapFeature(Convertible, UDFModel, PendingAuditable):
     hide_at_zoom = models.IntegerField(
         null=True, blank=True, default=None, db_index=True)
 
+    # Code of the i-Tree region containing `geom`, or '' if there is none.
+    # Kept up to date on save so eco calculations need no spatial query;
+    # null until filled by the fill_itree_region_codes management command.
+    itree_region_code = models.CharField(
+        max_length=40, null=True, blank=True, default=None)
+
     users_can_delete_own_creations = True
 
     @classproperty
@@ -653,7 +653,7 @@ class MapFeature(Convertible, UDFModel, PendingAuditable):
         # If we ever implement the ability to lock down a model instance,
         # `readonly` should be removed from this list.
         return PendingAuditable.always_writable | {
-            'hide_at_zoom', 'geom', 'readonly'}
+            'hide_at_zoom', 'geom', 'readonly', 'itree_region_code'}
 
     def __init__(self, *args, **kwargs):
         super(MapFeature, self).__init__(*args, **kwargs)
@@ -666,7 +666,8 @@ class MapFeature(Convertible, UDFModel, PendingAuditable):
     @classproperty
     def do_not_track(cls):
         return PendingAuditable.do_not_track | UDFModel.do_not_track | {
-            'feature_type', 'mapfeature_ptr', 'hide_at_zoom'}
+            'feature_type', 'mapfeature_ptr', 'hide_at_zoom',
+            'itree_region_code'}
 
     @property
     def _is_generic(self):
@@ -707,6 +708,18 @@ class MapFeature(Convertible, UDFModel, PendingAuditable):
 
         self.updated_at = timezone.now()
         self.updated_by = user
+
+        old_geom = self.get_previous_state().get('geom')
+        # Kept so the benefit totals can move a moved plot's trees out of
+        # their old region
+        self.previous_itree_region_code = self.itree_region_code
+        if self.itree_region_code is None or old_geom is None or \
+                not old_geom.equals(self.geom):
+            self.itree_region_code = ITreeRegion.objects \
+                .filter(geometry__contains=self.geom) \
+                .values_list('code', flat=True) \
+                .first() or ''
+
         super(MapFeature, self).save_with_user(user, *args, **kwargs)
 
     def clean(self):
@@ -921,6 +934,10 @@ class MapFeature(Convertible, UDFModel, PendingAuditable):
 
     @property
     def itree_region(self):
+        if self.itree_region_code is not None and \
+                not self.instance.itree_region_default:
+            return ITreeRegionInMemory(self.itree_region_code or None)
+
         regions = self.instance.itree_regions(geometry__contains=self.geom)
         if regions:
             return regions[0]
@@ -1467,6 +1484,10 @@ class Boundary(models.Model):
         b.geom = MultiPolygon(polygon)
         return b
 
+post_save.connect(invalidate_boundary_adjuncts, sender=Boundary)
+# Use pre_delete so the instance relationships still exist
+pre_delete.connect(invalidate_boundary_adjuncts, sender=Boundary)
+
 
 class ITreeRegionAbstract(object):
     def __unicode__(self):
@@ -1495,6 +1516,11 @@ class ITreeRegion(ITreeRegionAbstract, models.Model):
     objects = models.GeoManager()
 
 
+post_save.connect(invalidate_itree_region_adjuncts, sender=ITreeRegion)
+post_delete.connect(invalidate_itree_region_adjuncts, sender=ITreeRegion)
+post_save.connect(invalidate_itree_region_adjuncts, sender=InstanceBounds)
+
+
 class ITreeCodeOverride(models.Model, Auditable):
     instance_species = models.ForeignKey(Species)
     region = models.ForeignKey(ITreeRegion)
@@ -1506,3 +1532,26 @@ class ITreeCodeOverride(models.Model, Auditable):
     def __init__(self, *args, **kwargs):
         super(ITreeCodeOverride, self).__init__(*args, **kwargs)
         self.populate_previous_state()
+
+
+post_save.connect(invalidate_species_adjuncts, sender=ITreeCodeOverride)
+post_delete.connect(invalidate_species_adjuncts, sender=ITreeCodeOverride)
+
+
+class TreeBenefitsAggregate(models.Model):
+    """
+    Running totals of the raw eco benefits of an instance's trees, grouped
+    by species and i-Tree region. Maintained by treemap.ecoaggregate.
+
+    The row without a species marks that the totals have been built, and
+    holds the instance eco_rev they were built from.
+    """
+    instance = models.ForeignKey(Instance)
+    species_id = models.IntegerField(null=True)
+    region_code = models.CharField(max_length=40, blank=True)
+    n_trees = models.IntegerField(default=0)
+    benefits = JSONField(blank=True, default=dict)
+    eco_rev = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('instance', 'species_id', 'region_code',)
@@ -3,11 +3,17 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
+import json
+import threading
+import time
+
+from collections import OrderedDict
 from json import loads
 from datetime import datetime
 from functools import partial
 from itertools import groupby, chain
 
+from django.conf import settings
 from django.db.models import Q
 
 from opentreemap.util import dotted_split
@@ -188,12 +194,10 @@ def create_filter(instance, filterstr, mapping):
 
     Returns a Q object that can be applied to a model of your choice
     """
-    if filterstr is not None and filterstr != '':
-        query = loads(filterstr)
-        convert_filter_units(instance, query)
-        q = _parse_filter(query, mapping)
+    if instance and settings.USE_FILTER_CACHE:
+        q = _get_compiled_filters(instance).get(instance, filterstr, mapping)
     else:
-        q = FilterContext()
+        q = _compile_filter(instance, filterstr, mapping)
 
     if instance:
         q = q & FilterContext(instance=instance)
@@ -201,6 +205,113 @@ def create_filter(instance, filterstr, mapping):
     return q
 
 
+def _compile_filter(instance, filterstr, mapping):
+    if filterstr is not None and filterstr != '':
+        query = loads(filterstr)
+        convert_filter_units(instance, query)
+        return _parse_filter(query, mapping)
+    else:
+        return FilterContext()
+
+
+# ------------------------------------------------------------------------
+# Compiled filter cache
+#
+# Parsing a filter string means unit conversion, a boundary fetch for each
+# IN_BOUNDARY predicate and building a FilterContext tree. The result only
+# depends on the filter string, the mapping, the instance's display units,
+# and the instance's UDF definitions and boundaries, so keep compiled
+# filters in local memory.
+#
+# Like the adjunct object caches, validity is tracked via
+# instance.adjuncts_timestamp, which is incremented when UDF definitions
+# change and when a boundary belonging to the instance is edited or
+# deleted. The timestamp lives in the database, so invalidation propagates
+# to every process. Compiled filters contain querysets for collection UDF
+# subqueries, so they are never pickled into the shared cache.
+#
+# Filters are compiled from several threads at once (see
+# ecobenefits._benefits_by_class), so the cache and its stats are only
+# touched while holding _compiled_filters_lock.
+
+_MAX_COMPILED_FILTERS_PER_INSTANCE = 500
+
+_compiled_filters = {}
+_compiled_filters_lock = threading.Lock()
+
+_filter_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'parse_seconds': 0.0,
+    'parse_seconds_saved': 0.0,
+}
+
+
+def filter_cache_stats():
+    with _compiled_filters_lock:
+        stats = dict(_filter_cache_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+
+def clear_filter_cache():
+    global _compiled_filters
+    with _compiled_filters_lock:
+        _compiled_filters = {}
+        _filter_cache_stats.update(hits=0, misses=0, parse_seconds=0.0,
+                                   parse_seconds_saved=0.0)
+
+
+def _get_compiled_filters(instance):
+    with _compiled_filters_lock:
+        compiled = _compiled_filters.get(instance.id)
+        if not compiled or compiled.timestamp < instance.adjuncts_timestamp:
+            compiled = _InstanceCompiledFilters(instance.adjuncts_timestamp)
+            _compiled_filters[instance.id] = compiled
+        return compiled
+
+
+class _InstanceCompiledFilters(object):
+    def __init__(self, timestamp):
+        self._plans = OrderedDict()
+        self.timestamp = timestamp
+
+    def get(self, instance, filterstr, mapping):
+        key = self._key(instance, filterstr, mapping)
+        with _compiled_filters_lock:
+            plan = self._plans.pop(key, None)
+            if plan is not None:
+                _filter_cache_stats['hits'] += 1
+                _filter_cache_stats['parse_seconds_saved'] += plan[1]
+                # Reinsert to keep the most recently used plans at the end
+                self._plans[key] = plan
+                return plan[0]
+
+        # Compile without holding the lock, since it may query boundaries.
+        # Threads that miss the same key at once each compile it.
+        start = time.time()
+        q = _compile_filter(instance, filterstr, mapping)
+        plan = (q, time.time() - start)
+
+        with _compiled_filters_lock:
+            _filter_cache_stats['misses'] += 1
+            _filter_cache_stats['parse_seconds'] += plan[1]
+
+            self._plans.pop(key, None)
+            if len(self._plans) >= _MAX_COMPILED_FILTERS_PER_INSTANCE:
+                self._plans.popitem(last=False)
+            self._plans[key] = plan
+        return plan[0]
+
+    def _key(self, instance, filterstr, mapping):
+        # Filter values are converted from display units, so the compiled
+        # filter is only valid for the current unit configuration
+        units = json.dumps(instance.config.get('value_display', {}),
+                           sort_keys=True)
+        return (filterstr or '', units, tuple(sorted(mapping.items())))
+
+
 def _parse_filter(query, mapping):
     if type(query) is dict:
         return _parse_query_dict(query, mapping)
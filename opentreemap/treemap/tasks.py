@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from celery import shared_task
+
+from treemap.ecoaggregate import update_for_tree_changes
+from treemap.ecobenefits import get_benefits_for_filter
+from treemap.ecocache import get_cached_plot_count, instance_revs
+from treemap.instance import Instance
+from treemap.search import Filter
+
+
+@shared_task
+def warm_eco_cache(instance_id, revs=None):
+    """
+    Cache the unfiltered plot count and eco benefits of an instance for
+    its current revs, so map page requests don't have to compute them.
+    Does nothing if the instance's revs are no longer `revs`, since the
+    task queued for the newer revs will warm them.
+    """
+    if revs is not None and tuple(revs) != instance_revs(instance_id):
+        return
+
+    instance = Instance.objects.get(pk=instance_id)
+    filter = Filter('', '', instance)
+
+    get_cached_plot_count(filter)
+    get_benefits_for_filter(filter)
+
+
+@shared_task
+def update_eco_aggregate(instance_id, changes, eco_rev):
+    """
+    Apply tree changes committed at `eco_rev` to the instance's benefit
+    totals (see treemap/ecoaggregate.py)
+    """
+    instance = Instance.objects.get(pk=instance_id)
+    update_for_tree_changes(instance, changes, eco_rev)
@@ -1,4 +1,4 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.test.utils import override_settings
 
 test_settings = {
@@ -10,6 +10,8 @@ test_settings = {
     # Without this we'd need to invalidate the cache before every test.
     'USE_OBJECT_CACHES': False,
     'USE_ECO_CACHE': False,
+    'WARM_ECO_CACHE': False,
+    'USE_FILTER_CACHE': False,
 
     'CELERY_TASK_ALWAYS_EAGER': True,
     'CELERY_TASK_EAGER_PROPAGATES': True
@@ -25,3 +27,14 @@ class OTMTestCase(TestCase):
         self.assertTrue(key in ve.error_dict,
                         'Expected "%s" to be a key in error_dict %s' %
                         (key, ve.error_dict))
+
+
+@override_settings(**test_settings)
+class OTMTransactionTestCase(TransactionTestCase):
+    """
+    Base class for OTM2 tests which need their changes to be committed,
+    e.g. to be seen by other threads.
+    """
+    # Restore the data loaded by migrations (like i-Tree regions) after
+    # the tables are flushed
+    serialized_rollback = True
@@ -4,19 +4,25 @@ from __future__ import unicode_literals
 from __future__ import division
 
 import json
+import threading
+
+import requests
 
 from unittest.case import skip
 
 from django.core.cache import cache
+from django.db import connection
 from django.test import override_settings
 
+from treemap.instance import Instance
 from treemap.models import (Plot, Tree, Species, ITreeRegion,
                             ITreeCodeOverride, BenefitCurrencyConversion)
 from treemap.tests import (make_instance, make_commander_user, make_request,
-                           OTMTestCase)
+                           create_mock_system_user, OTMTestCase)
+from treemap.tests.base import OTMTransactionTestCase
 from treemap.tests.test_urls import UrlTestCase
 
-from treemap import ecobackend
+from treemap import ecobackend, ecobenefits, ecocache, ecoaggregate
 from treemap.ecobenefits import (TreeBenefitsCalculator,
                                  _combine_benefit_basis,
                                  _annotate_basis_with_extra_stats,
@@ -24,7 +30,19 @@ from treemap.ecobenefits import (TreeBenefitsCalculator,
 from treemap.views.tree import search_tree_benefits
 from treemap.search import Filter
 from treemap.ecocache import (get_cached_benefits, get_cached_plot_count,
-                              invalidate_ecoservice_cache_if_stale)
+                              invalidate_ecoservice_cache_if_stale, _get_key,
+                              get_memoized_tree_benefits,
+                              clear_tree_benefits_lru)
+from treemap import tasks
+from treemap.tasks import warm_eco_cache
+
+
+def _run_commit_hooks():
+    # Test transactions are never committed, so run the callbacks queued
+    # for when they would be
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for __, callback in callbacks:
+        callback()
 
 
 class EcoTestCase(UrlTestCase):
@@ -126,6 +144,61 @@ class EcoTest(EcoTestCase):
         self.assert_benefit_value(bens, BenefitCategory.CO2STORAGE,
                                   'lbs', 6575)
 
+    def test_benefits_for_objects_computes_shared_inputs_once(self):
+        calls = []
+        mockbenefits = ecobackend.json_benefits_call
+
+        def counting_benefits_call(*args, **kwargs):
+            calls.append(args)
+            return mockbenefits(*args, **kwargs)
+        ecobackend.json_benefits_call = counting_benefits_call
+
+        plot2 = Plot(geom=self.instance.center, instance=self.instance)
+        plot2.save_with_user(self.user)
+        Tree(plot=plot2, instance=self.instance, species=self.species,
+             diameter=1630).save_with_user(self.user)
+
+        empty_plot = Plot(geom=self.instance.center, instance=self.instance)
+        empty_plot.save_with_user(self.user)
+
+        results = TreeBenefitsCalculator().benefits_for_objects(
+            self.instance, [self.plot, plot2, empty_plot])
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual(results[self.plot.pk][0], results[plot2.pk][0])
+        self.assertEqual('NO_TREE', results[empty_plot.pk][2])
+
+    def test_benefits_for_objects_batches_distinct_inputs(self):
+        calls = []
+
+        def eco_scenario(endpoint, params, post=False, convert_params=True):
+            calls.append((endpoint, params))
+            # Each year's benefits are the sum over trees of their
+            # diameters that year
+            return {'Years': [
+                {'electricity': sum(t['diameters'][year]
+                                    for t in params['scenario_trees'])}
+                for year in range(params['years'])]}, None
+        ecobackend.json_benefits_call = eco_scenario
+
+        plots = [self.plot]
+        for diameter in (10, 20, 30):
+            plot = Plot(geom=self.instance.center, instance=self.instance)
+            plot.save_with_user(self.user)
+            Tree(plot=plot, instance=self.instance, species=self.species,
+                 diameter=diameter).save_with_user(self.user)
+            plots.append(plot)
+
+        results = TreeBenefitsCalculator().benefits_for_objects(
+            self.instance, plots)
+
+        self.assertEqual(['eco_scenario.json'],
+                         [endpoint for endpoint, __ in calls])
+        self.assertEqual(4, calls[0][1]['years'])
+        for plot, diameter in zip(plots, (1630, 10, 20, 30)):
+            energy = results[plot.pk][0]['plot'][BenefitCategory.ENERGY]
+            self.assertAlmostEqual(diameter, energy['value'])
+
     def testSearchBenefits(self):
         request = make_request(
             {'q': json.dumps({'tree.readonly': {'IS': False}})})  # all trees
@@ -403,6 +476,293 @@ class EcoCacheTest(UrlTestCase):
         count = get_cached_plot_count(self.filter)
         self.assertEqual(1, count)
 
+    def test_concurrent_miss_serves_previous_rev_value(self):
+        self.get_cached_tree_benefits(self.filter, lambda: self.benefits)
+        self.filter.instance.update_eco_rev()
+
+        # Simulate another request computing the value for the new rev
+        cache.add(_get_key('eco/Plot', self.filter) + '/lock', True)
+
+        benefits = self.get_cached_tree_benefits(self.filter, lambda: 'others')
+        self.assertEqual(benefits, self.benefits)
+
+    def test_lock_is_released_after_computing(self):
+        self.get_cached_tree_benefits(self.filter, lambda: self.benefits)
+        self.assertIsNone(
+            cache.get(_get_key('eco/Plot', self.filter) + '/lock'))
+
+    def test_serves_previous_value_when_ecoservice_fails(self):
+        self.get_cached_tree_benefits(self.filter, lambda: self.benefits)
+        self.filter.instance.update_eco_rev()
+
+        def fail():
+            raise ecobackend.EcoserviceError(ecobackend.UNKNOWN_ECO_FAILURE)
+
+        benefits = self.get_cached_tree_benefits(self.filter, fail)
+        self.assertEqual(benefits, self.benefits)
+
+        # The failure is not cached
+        benefits = self.get_cached_tree_benefits(self.filter, lambda: 'new')
+        self.assertEqual(benefits, 'new')
+
+    def test_tree_benefits_are_memoized(self):
+        species = Species(instance=self.instance, genus='g', otm_code='CEAT')
+        species.save_with_user(self.user)
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return {'Benefits': {'electricity': 1.0}}, None
+
+        clear_tree_benefits_lru()
+        for __ in range(2):
+            rawb, err = get_memoized_tree_benefits(
+                self.instance, species, 5.0, 'NoEastXXX', compute)
+            rawb['Benefits']['electricity'] = 2.0
+        self.assertEqual(1, len(calls))
+
+        # Found in the shared cache when the LRU is empty
+        clear_tree_benefits_lru()
+        rawb, err = get_memoized_tree_benefits(
+            self.instance, species, 5.0, 'NoEastXXX', compute)
+        self.assertEqual(1, len(calls))
+        self.assertEqual({'Benefits': {'electricity': 1.0}}, rawb)
+
+        get_memoized_tree_benefits(
+            self.instance, species, 6.0, 'NoEastXXX', compute)
+        self.assertEqual(2, len(calls))
+
+    def test_override_change_invalidates_tree_benefits(self):
+        species = Species(instance=self.instance, genus='g', otm_code='CEAT')
+        species.save_with_user(self.user)
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return {'Benefits': {}}, None
+
+        get_memoized_tree_benefits(
+            self.instance, species, 5.0, 'NoEastXXX', compute)
+        ITreeCodeOverride(
+            instance_species=species,
+            region=ITreeRegion.objects.get(code='NoEastXXX'),
+            itree_code='CEM OTHER'
+        ).save_with_user(self.user)
+        get_memoized_tree_benefits(
+            self.instance, species, 5.0, 'NoEastXXX', compute)
+        self.assertEqual(2, len(calls))
+
+    def test_warm_task_caches_count(self):
+        plot = Plot(geom=self.instance.center, instance=self.instance)
+        plot.save_with_user(self.user)
+
+        warm_eco_cache(self.instance.pk)
+
+        plot = Plot(geom=self.instance.center, instance=self.instance)
+        plot.save_with_user(self.user)
+
+        count = get_cached_plot_count(self.filter)
+        self.assertEqual(1, count)
+
+    def test_warm_task_skips_outdated_revs(self):
+        plot = Plot(geom=self.instance.center, instance=self.instance)
+        plot.save_with_user(self.user)
+        revs = ecocache.instance_revs(self.instance.pk)
+        self.instance.update_geo_rev()
+
+        warm_eco_cache(self.instance.pk, revs)
+
+        plot = Plot(geom=self.instance.center, instance=self.instance)
+        plot.save_with_user(self.user)
+
+        count = get_cached_plot_count(self.filter)
+        self.assertEqual(2, count)
+
+    @override_settings(WARM_ECO_CACHE=True)
+    def test_burst_of_rev_updates_queues_one_warm_task(self):
+        queued = []
+
+        class FakeWarmTask(object):
+            def apply_async(self, args, countdown):
+                queued.append(args)
+
+        warm_task = tasks.warm_eco_cache
+        tasks.warm_eco_cache = FakeWarmTask()
+        try:
+            self.instance.update_geo_rev()
+            self.instance.update_eco_rev()
+            self.instance.update_universal_rev()
+            _run_commit_hooks()
+        finally:
+            tasks.warm_eco_cache = warm_task
+
+        revs = ecocache.instance_revs(self.instance.pk)
+        self.assertEqual([(self.instance.pk, revs)], queued)
+
+
+@override_settings(ECO_SERVICE_CIRCUIT_FAILURES=2,
+                   ECO_SERVICE_CIRCUIT_RESET_SECONDS=60)
+class EcoserviceCircuitBreakerTest(OTMTestCase):
+    def test_opens_after_consecutive_failures(self):
+        breaker = ecobackend._CircuitBreaker()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open())
+        self.assertFalse(breaker.allow_request())
+
+    def test_lets_one_request_through_after_reset_time(self):
+        breaker = ecobackend._CircuitBreaker()
+        breaker.record_failure()
+        breaker.record_failure()
+
+        with override_settings(ECO_SERVICE_CIRCUIT_RESET_SECONDS=0):
+            breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+
+        breaker.record_success()
+        self.assertFalse(breaker.is_open())
+        self.assertTrue(breaker.allow_request())
+
+
+class _FakeEcoserviceResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.content = '{}'
+
+
+class _FakeEcoserviceSession(object):
+    def __init__(self):
+        self.urls = []
+        self.status_code = 200
+        self.error = None
+
+    def request(self, method, url, timeout, **kwargs):
+        self.urls.append(url)
+        if self.error:
+            raise self.error
+        return _FakeEcoserviceResponse(self.status_code)
+
+
+@override_settings(ECO_SERVICE_CIRCUIT_FAILURES=1,
+                   ECO_SERVICE_CIRCUIT_RESET_SECONDS=60)
+class EcoserviceHalfOpenCircuitTest(OTMTestCase):
+    def setUp(self):
+        self.orig_breaker = ecobackend._circuit_breaker
+        self.orig_session = ecobackend._session
+        self.orig_rev = ecocache.my_itree_code_override_rev
+
+        ecobackend._circuit_breaker = ecobackend._CircuitBreaker()
+        self.session = ecobackend._session = _FakeEcoserviceSession()
+
+    def tearDown(self):
+        ecobackend._circuit_breaker = self.orig_breaker
+        ecobackend._session = self.orig_session
+        ecocache.my_itree_code_override_rev = self.orig_rev
+
+    def test_trial_request_invalidates_stale_cache_and_closes(self):
+        with override_settings(ECO_SERVICE_CIRCUIT_RESET_SECONDS=0):
+            ecobackend._circuit_breaker.record_failure()
+        rev = ecocache.get_itree_code_override_rev()
+        ecocache.my_itree_code_override_rev = rev - 1
+
+        result, err = ecobackend.json_benefits_call('eco_summary.json', [])
+
+        self.assertIsNone(err)
+        self.assertEqual(2, len(self.session.urls))
+        self.assertIn('invalidate_cache', self.session.urls[0])
+        self.assertEqual(rev, ecocache.my_itree_code_override_rev)
+        self.assertTrue(ecobackend.is_available())
+
+    def test_server_error_opens_circuit(self):
+        ecocache.my_itree_code_override_rev = \
+            ecocache.get_itree_code_override_rev()
+        self.session.status_code = 500
+
+        result, err = ecobackend.json_benefits_call('eco_summary.json', [])
+
+        self.assertIsNotNone(err)
+        self.assertFalse(ecobackend.is_available())
+
+    def test_timeout_opens_circuit(self):
+        ecocache.my_itree_code_override_rev = \
+            ecocache.get_itree_code_override_rev()
+        self.session.error = requests.Timeout()
+
+        result, err = ecobackend.json_benefits_call('eco_summary.json', [])
+
+        self.assertEqual(ecobackend.UNKNOWN_ECO_FAILURE, err)
+        self.assertFalse(ecobackend.is_available())
+
+    def test_blocked_invalidation_returns_failure(self):
+        ecobackend._circuit_breaker.record_failure()
+        rev = ecocache.get_itree_code_override_rev()
+        ecocache.my_itree_code_override_rev = rev - 1
+
+        result, err = ecobackend.json_benefits_call('eco_summary.json', [])
+
+        self.assertEqual(ecobackend.UNKNOWN_ECO_FAILURE, err)
+        self.assertEqual([], self.session.urls)
+
+
+# Add the Bioswale map feature type without a feature backend
+@override_settings(FEATURE_BACKEND_FUNCTION=None, ECO_BENEFITS_THREADS=4)
+class EcoBenefitsThreadsTest(OTMTransactionTestCase):
+    def setUp(self):
+        # Flushed by any previous test case like this one
+        create_mock_system_user()
+
+        def mockbenefits(*args, **kwargs):
+            return {'Benefits': {'electricity': 187.0,
+                                 'co2_storage': 6575.0}}, None
+
+        self.orig_benefits_fn = ecobackend.json_benefits_call
+        ecobackend.json_benefits_call = mockbenefits
+
+        region = ITreeRegion.objects.get(code='NoEastXXX')
+        self.instance = make_instance(point=region.geometry.point_on_surface)
+        self.instance.add_map_feature_types(['Bioswale'])
+        user = make_commander_user(self.instance)
+
+        species = Species(otm_code='CEAT', genus='cedrus',
+                          species='atlantica', max_diameter=2000,
+                          max_height=100, instance=self.instance)
+        species.save_with_user(user)
+        plot = Plot(geom=self.instance.center, instance=self.instance)
+        plot.save_with_user(user)
+        Tree(plot=plot, instance=self.instance, species=species,
+             diameter=10).save_with_user(user)
+
+    def tearDown(self):
+        ecobackend.json_benefits_call = self.orig_benefits_fn
+        ecobenefits.close_benefits_pool()
+
+    def test_concurrent_benefits_match_serial_benefits(self):
+        filter = Filter('', '', self.instance)
+        with override_settings(ECO_BENEFITS_THREADS=1):
+            serial = ecobenefits.get_benefits_for_filter(filter)
+
+        threads = set()
+        in_thread = ecobenefits._benefits_for_class_in_thread
+
+        def record_thread(args):
+            threads.add(threading.current_thread())
+            return in_thread(args)
+
+        ecobenefits._benefits_for_class_in_thread = record_thread
+        try:
+            concurrent = ecobenefits.get_benefits_for_filter(filter)
+        finally:
+            ecobenefits._benefits_for_class_in_thread = in_thread
+
+        self.assertTrue(threads)
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual(serial, concurrent)
+
 
 class EcoserviceCacheBusterTest(OTMTestCase):
     def setUp(self):
@@ -434,3 +794,164 @@ class EcoserviceCacheBusterTest(OTMTestCase):
         invalidate_ecoservice_cache_if_stale()
 
         self.assertTrue(self.cache_invalidated)
+
+
+_ECO_FACTORS = ('aq_nox_avoided', 'aq_nox_dep', 'aq_ozone_dep',
+                'aq_pm10_avoided', 'aq_pm10_dep', 'aq_sox_avoided',
+                'aq_sox_dep', 'aq_voc_avoided', 'bvoc', 'co2_avoided',
+                'co2_sequestered', 'co2_storage', 'electricity',
+                'hydro_interception', 'natural_gas')
+
+
+def _benefits_for_diameter(diameter):
+    benefits = {factor: 0.0 for factor in _ECO_FACTORS}
+    benefits['electricity'] = 2.0 * diameter
+    benefits['co2_storage'] = 20.0 * diameter
+    return benefits
+
+
+def _mock_benefits_by_diameter(endpoint, params, post=False, **kwargs):
+    # Stands in for the ecoservice, with benefits proportional to diameter.
+    # eco_summary.json runs the query it is sent, whose first column is the
+    # diameter, so summaries and single trees agree the way they do in the
+    # ecoservice.
+    params = dict(params)
+    if endpoint == 'eco.json':
+        return {'Benefits': _benefits_for_diameter(
+            float(params['diameter']))}, None
+
+    cursor = connection.cursor()
+    cursor.execute(params['query'])
+    totals = {factor: 0.0 for factor in _ECO_FACTORS}
+    n_trees = 0
+    for row in cursor.fetchall():
+        n_trees += 1
+        for factor, value in _benefits_for_diameter(row[0]).iteritems():
+            totals[factor] += value
+    totals['n_trees'] = n_trees
+    return {'Benefits': totals}, None
+
+
+class EcoAggregateTest(EcoTestCase):
+    def setUp(self):
+        super(EcoAggregateTest, self).setUp()
+        ecobackend.json_benefits_call = _mock_benefits_by_diameter
+        clear_tree_benefits_lru()
+
+        self.plot = Plot(geom=self.instance.center, instance=self.instance)
+        self.plot.save_with_user(self.user)
+        self.tree = Tree(plot=self.plot, instance=self.instance,
+                         species=self.species, diameter=5)
+        self.tree.save_with_user(self.user)
+
+    def test_benefits_for_object(self):
+        rslt, basis, error = TreeBenefitsCalculator()\
+            .benefits_for_object(self.instance, self.plot)
+
+        self.assertIsNone(error)
+        energy = rslt['plot'][BenefitCategory.ENERGY]
+        self.assertAlmostEqual(10.0, energy['value'])
+
+    def test_benefits_for_filter(self):
+        rslt, basis = TreeBenefitsCalculator()\
+            .benefits_for_filter(self.instance,
+                                 Filter('', '', self.instance))
+
+        self.assertEqual(1, basis['plot']['n_objects_used'])
+        co2storage = rslt['plot'][BenefitCategory.CO2STORAGE]
+        self.assertAlmostEqual(100.0, co2storage['value'])
+
+    def test_aggregate_is_maintained_as_trees_change(self):
+        self.assertIsNone(ecoaggregate.aggregate_benefits(self.instance))
+        ecoaggregate.rebuild_aggregate(self.instance)
+
+        plot = Plot(geom=self.instance.center, instance=self.instance)
+        plot.save_with_user(self.user)
+        tree = Tree(plot=plot, instance=self.instance,
+                    species=self.species, diameter=10)
+        tree.save_with_user(self.user)
+
+        self.tree.diameter = 100
+        self.tree.save_with_user(self.user)
+        _run_commit_hooks()
+
+        benefits = ecoaggregate.aggregate_benefits(self.instance)
+        self.assertEqual(2, benefits['Benefits']['n_trees'])
+        self.assertEqual({}, ecoaggregate.verify_aggregate(self.instance))
+
+        tree.delete_with_user(self.user)
+        _run_commit_hooks()
+
+        benefits = ecoaggregate.aggregate_benefits(self.instance)
+        self.assertEqual(1, benefits['Benefits']['n_trees'])
+        self.assertAlmostEqual(200.0, benefits['Benefits']['electricity'])
+        self.assertEqual({}, ecoaggregate.verify_aggregate(self.instance))
+
+    def test_rebuild_includes_trees_changed_during_scan(self):
+        scan_buckets = ecoaggregate._scan_buckets
+        scans = []
+
+        def scan_and_change_tree(instance):
+            buckets = scan_buckets(instance)
+            if not scans:
+                self.tree.diameter = 100
+                self.tree.save_with_user(self.user)
+            scans.append(buckets)
+            return buckets
+
+        ecoaggregate._scan_buckets = scan_and_change_tree
+        try:
+            self.assertTrue(ecoaggregate.rebuild_aggregate(self.instance))
+            self.assertEqual(2, len(scans))
+            self.assertEqual(
+                {}, ecoaggregate.verify_aggregate(self.instance))
+        finally:
+            ecoaggregate._scan_buckets = scan_buckets
+
+    def test_changes_included_in_rebuild_are_not_applied_again(self):
+        ecoaggregate.rebuild_aggregate(self.instance)
+        eco_rev = Instance.objects.get(pk=self.instance.pk).eco_rev
+        changes = [(None, (self.species.pk, 'NoEastXXX', 5))]
+
+        ecoaggregate.update_for_tree_changes(
+            self.instance, changes, eco_rev)
+        benefits = ecoaggregate.aggregate_benefits(self.instance)
+        self.assertEqual(1, benefits['Benefits']['n_trees'])
+
+        ecoaggregate.update_for_tree_changes(
+            self.instance, changes, eco_rev + 1)
+        benefits = ecoaggregate.aggregate_benefits(self.instance)
+        self.assertEqual(2, benefits['Benefits']['n_trees'])
+
+    @override_settings(USE_ECO_CACHE=True)
+    def test_cached_benefits_include_changes_applied_after_commit(self):
+        def cached_benefits():
+            instance = Instance.objects.get(pk=self.instance.pk)
+            rslt, basis = ecobenefits._benefits_for_class(
+                Plot, Filter('', '', instance))
+            energy = rslt['plot'][BenefitCategory.ENERGY]['value']
+            return basis['plot']['n_objects_used'], energy
+
+        cache.clear()
+        ecoaggregate.rebuild_aggregate(self.instance)
+        self.assertEqual((1, 10.0), cached_benefits())
+
+        plot = Plot(geom=self.instance.center, instance=self.instance)
+        plot.save_with_user(self.user)
+        Tree(plot=plot, instance=self.instance, species=self.species,
+             diameter=10).save_with_user(self.user)
+
+        # Until the change is applied the totals are extrapolated
+        self.assertEqual((1, 20.0), cached_benefits())
+
+        _run_commit_hooks()
+        self.assertEqual((2, 30.0), cached_benefits())
+
+    def test_override_invalidates_aggregate(self):
+        ecoaggregate.rebuild_aggregate(self.instance)
+        ITreeCodeOverride(
+            instance_species=self.species,
+            region=ITreeRegion.objects.get(code='NoEastXXX'),
+            itree_code='CEM OTHER').save_with_user(self.user)
+
+        self.assertIsNone(ecoaggregate.aggregate_benefits(self.instance))
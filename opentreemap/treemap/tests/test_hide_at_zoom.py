@@ -6,10 +6,12 @@ from __future__ import division
 from django.contrib.gis.geos import Point
 from django.db.models import Count
 
+from treemap.instance import Instance
 from treemap.models import Plot
-from treemap.lib.hide_at_zoom import (recompute_hide_at_zoom,
-                                      update_hide_at_zoom_after_delete,
-                                      update_hide_at_zoom_after_move)
+from treemap.lib.hide_at_zoom import (
+    recompute_hide_at_zoom, update_hide_at_zoom_after_delete,
+    update_hide_at_zoom_after_move, update_hide_at_zoom_after_bulk_delete,
+    update_hide_at_zoom_after_bulk_move)
 from treemap.tests import make_instance, make_commander_user
 from treemap.tests.base import OTMTestCase
 
@@ -73,3 +75,51 @@ class HideAtZoomTests(OTMTestCase):
         plot = Plot.objects.get(hide_at_zoom=10)
         point = (1, plot.geom.y)
         self.move_and_assert_counts(plot, point, {14: 1, 10: 1})
+
+    def test_bulk_delete(self):
+        plots = [Plot.objects.get(hide_at_zoom=None),
+                 Plot.objects.get(hide_at_zoom=10)]
+        removed = [(plot.geom, plot.hide_at_zoom) for plot in plots]
+        for plot in plots:
+            plot.delete_with_user(self.user)
+
+        update_hide_at_zoom_after_bulk_delete(self.instance, removed)
+        self.assert_counts({10: 1})
+
+    def test_bulk_move(self):
+        plots = [Plot.objects.get(hide_at_zoom=None),
+                 Plot.objects.get(hide_at_zoom=10)]
+        moves = [(plot.pk, plot.geom, plot.hide_at_zoom) for plot in plots]
+        for plot in plots:
+            plot.geom = Point(1, plot.geom.y)
+            plot.save_with_user(self.user)
+
+        update_hide_at_zoom_after_bulk_move(self.instance, moves)
+        self.assert_counts({10: 1})
+
+    def test_recompute_skipped_if_geo_rev_unchanged(self):
+        Plot.objects.update(hide_at_zoom=None)
+        recompute_hide_at_zoom(self.instance)
+        self.assert_counts({})
+
+        self.instance.update_geo_rev()
+        recompute_hide_at_zoom(self.instance)
+        self.assert_counts({14: 2, 10: 1})
+
+    def test_recompute_keeps_config_saved_meanwhile(self):
+        stale_instance = Instance.objects.get(pk=self.instance.pk)
+        self.instance.annual_rainfall_inches = 50
+        self.instance.save()
+
+        stale_instance.update_geo_rev()
+        recompute_hide_at_zoom(stale_instance)
+
+        instance = Instance.objects.get(pk=self.instance.pk)
+        self.assertEqual(50, instance.annual_rainfall_inches)
+        self.assertEqual(instance.geo_rev, instance.hide_at_zoom_geo_rev)
+
+    def test_recompute_only_bumps_geo_rev_on_change(self):
+        geo_rev = self.instance.geo_rev
+        recompute_hide_at_zoom(self.instance, force=True)
+        self.assertEqual(geo_rev, self.instance.geo_rev)
+        self.assert_counts({14: 2, 10: 1})
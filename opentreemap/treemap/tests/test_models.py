@@ -11,6 +11,7 @@ from django.core.exceptions import ValidationError
 from treemap.models import (Tree, Instance, Plot, FieldPermission, Species,
                             ITreeRegion, ValidationMixin)
 from treemap.audit import Audit, ReputationMetric, Role
+from treemap.lib.itree_region import fill_itree_region_codes
 from treemap.tests import (make_instance, make_commander_user,
                            make_user_with_default_role, make_user,
                            make_simple_boundary)
@@ -443,6 +444,35 @@ class InstanceTest(OTMTestCase):
 
         self.assertEqual(instance.has_itree_region(), True)
 
+    def test_plot_stores_itree_region_code(self):
+        p1 = Point(0, 0)
+        instance = make_instance(point=p1)
+        user = make_commander_user(instance)
+        ITreeRegion.objects.create(
+            code='NoEastXXX', geometry=MultiPolygon((p1.buffer(10))))
+
+        plot = Plot(geom=p1, instance=instance)
+        plot.save_with_user(user)
+        self.assertEqual(plot.itree_region_code, 'NoEastXXX')
+
+        plot.geom = Point(100, 100)
+        plot.save_with_user(user)
+        self.assertEqual(plot.itree_region_code, '')
+
+    def test_fill_itree_region_codes(self):
+        p1 = Point(0, 0)
+        instance = make_instance(point=p1)
+        user = make_commander_user(instance)
+        ITreeRegion.objects.create(
+            code='NoEastXXX', geometry=MultiPolygon((p1.buffer(10))))
+        plot = Plot(geom=p1, instance=instance)
+        plot.save_with_user(user)
+        Plot.objects.filter(pk=plot.pk).update(itree_region_code=None)
+
+        self.assertEqual(fill_itree_region_codes(instance), 1)
+        self.assertEqual(
+            Plot.objects.get(pk=plot.pk).itree_region_code, 'NoEastXXX')
+
 
 class Car(ValidationMixin):
     def __init__(self, weight):
@@ -5,9 +5,14 @@ from django.test import TestCase
 from django.test.utils import override_settings
 
 from treemap.audit import FieldPermission
+from django.contrib.gis.geos import MultiPolygon, Point
+
 from treemap.lib.object_caches import (clear_caches, role_field_permissions,
-                                       field_permissions, udf_defs)
-from treemap.models import InstanceUser
+                                       field_permissions, udf_defs,
+                                       itree_regions, species_resolver)
+from treemap.instance import Instance, InstanceBounds
+from treemap.models import (InstanceUser, ITreeRegion, ITreeCodeOverride,
+                            Species)
 from treemap.tests import (make_instance, make_commander_user,
                            make_user)
 from treemap.udf import UserDefinedFieldDefinition
@@ -211,3 +216,108 @@ class UDFDefinitionCacheTest(TestCase):
         self.instance.adjuncts_timestamp += 1
         self.instance.save()
         self.assert_udf_name('Tree', 'c')
+
+
+@override_settings(USE_OBJECT_CACHES=True)
+class ITreeRegionCacheTest(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.instance = make_instance(point=Point(0, 0))
+        self.region = ITreeRegion.objects.create(
+            code='NoEastXXX', geometry=MultiPolygon(Point(0, 0).buffer(10)))
+        self.instance.refresh_from_db()
+
+    def assert_region_codes(self, codes):
+        self.assert_region_codes_for(self.instance, codes)
+
+    def assert_region_codes_for(self, instance, codes):
+        self.assertEqual([r.code for r in itree_regions(instance)], codes)
+
+    def test_regions_cached(self):
+        self.assert_region_codes(['NoEastXXX'])  # load cache
+        with self.assertNumQueries(0):
+            self.assert_region_codes(['NoEastXXX'])
+
+    def test_region_delete(self):
+        self.assert_region_codes(['NoEastXXX'])  # load cache
+        self.region.delete()
+        self.instance.refresh_from_db()
+        self.assert_region_codes([])
+
+    def test_bounds_update(self):
+        self.assert_region_codes(['NoEastXXX'])  # load cache
+        bounds = self.instance.bounds
+        bounds.geom = MultiPolygon(Point(1000, 1000).buffer(10))
+        bounds.save()
+        self.instance.refresh_from_db()
+        self.assert_region_codes([])
+
+    def test_bounds_replaced(self):
+        self.assert_region_codes(['NoEastXXX'])  # load cache
+        instance = Instance.objects.get(pk=self.instance.pk)
+        instance.bounds = InstanceBounds.create_from_point(1000, 1000)
+        instance.save()
+        self.assert_region_codes_for(instance, [])
+
+    def test_default_region_skips_lookup(self):
+        self.instance.itree_region_default = 'PiedmtCLT'
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [r.code for r in self.instance.itree_regions()],
+                ['PiedmtCLT'])
+
+
+@override_settings(USE_OBJECT_CACHES=True)
+class SpeciesResolverCacheTest(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.instance = make_instance()
+        self.user = make_commander_user(self.instance)
+        self.maple = Species(instance=self.instance, otm_code='ACRU',
+                             genus='Acer', species='rubrum')
+        self.maple.save_with_user(self.user)
+        self.custom = Species(instance=self.instance, otm_code='',
+                              genus='Custom')
+        self.custom.save_with_user(self.user)
+        self.instance.refresh_from_db()
+
+    def resolve(self, otm_code):
+        return species_resolver(self.instance, 'NoEastXXX')(otm_code)
+
+    def test_resolves_otm_code(self):
+        self.assertEqual(self.resolve('ACRU').pk, self.maple.pk)
+        self.assertIsNone(self.resolve('ACSA2'))
+
+    def test_cached(self):
+        self.resolve('ACRU')  # load cache
+        with self.assertNumQueries(0):
+            self.assertEqual(self.resolve('ACRU').pk, self.maple.pk)
+
+    def test_returns_copies(self):
+        self.resolve('ACRU').otm_code = 'foo'
+        self.assertEqual(self.resolve('ACRU').otm_code, 'ACRU')
+
+    def test_override_matches_itree_code(self):
+        self.resolve('ACSA2')  # load cache
+        ITreeCodeOverride(
+            instance_species=self.custom,
+            region=ITreeRegion.objects.get(code='NoEastXXX'),
+            itree_code='ACSA2'
+        ).save_with_user(self.user)
+        self.instance.refresh_from_db()
+        self.assertEqual(self.resolve('ACSA2').pk, self.custom.pk)
+
+    def test_species_update(self):
+        self.resolve('ACRU')  # load cache
+        self.maple.otm_code = 'ACSA2'
+        self.maple.save_with_user(self.user)
+        self.instance.refresh_from_db()
+        self.assertIsNone(self.resolve('ACRU'))
+
+    def test_species_update_keeps_other_adjuncts(self):
+        field_permissions(self.user, self.instance)  # load cache
+        self.maple.otm_code = 'ACSA2'
+        self.maple.save_with_user(self.user)
+        self.instance.refresh_from_db()
+        with self.assertNumQueries(0):
+            field_permissions(self.user, self.instance)
@@ -12,6 +12,7 @@ from functools import partial
 from django.db.models import Q
 from django.db import connection
 from django.db.models.query import QuerySet
+from django.test.utils import override_settings
 from django.utils.tree import Node
 
 from django.contrib.gis.geos import Point, MultiPolygon
@@ -1018,3 +1019,61 @@ class SearchTests(OTMTestCase):
                     # Range encompasses p1's prune but not p1's water action
                     {'MIN': '2013-09-01 00:00:00',
                      'MAX': '2013-10-31 00:00:00'}}))
+
+
+@override_settings(USE_FILTER_CACHE=True)
+class CompiledFilterCacheTests(OTMTestCase):
+    def setUp(self):
+        search.clear_filter_cache()
+        self.instance = make_instance(point=Point(0, 0))
+        self.commander = make_commander_user(self.instance)
+
+        self.boundary = Boundary.objects.create(
+            geom=MultiPolygon(make_simple_polygon(0)),
+            name='whatever',
+            category='whatever',
+            sort_order=1)
+        self.instance.boundaries.add(self.boundary)
+
+        self.plot = Plot(geom=Point(0.5, 0.5), instance=self.instance)
+        self.plot.save_with_user(self.commander)
+
+        self.filterstr = json.dumps({'plot.geom':
+                                     {'IN_BOUNDARY': self.boundary.pk}})
+
+    def tearDown(self):
+        search.clear_filter_cache()
+
+    def _plot_ids(self):
+        plots = search.Filter(self.filterstr, '', self.instance)\
+                      .get_objects(Plot)
+        return {p.pk for p in plots}
+
+    def test_compiled_filter_is_reused(self):
+        self.assertEqual({self.plot.pk}, self._plot_ids())
+        self.assertEqual({self.plot.pk}, self._plot_ids())
+
+        stats = search.filter_cache_stats()
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(0.5, stats['hit_rate'])
+
+    def test_boundary_edit_invalidates_compiled_filter(self):
+        self.assertEqual({self.plot.pk}, self._plot_ids())
+
+        self.boundary.geom = MultiPolygon(make_simple_polygon(5))
+        self.boundary.save()
+        self.instance.refresh_from_db()
+
+        self.assertEqual(set(), self._plot_ids())
+        self.assertEqual(2, search.filter_cache_stats()['misses'])
+
+    def test_unit_config_is_part_of_key(self):
+        filterstr = json.dumps({'plot.width': {'MAX': 12}})
+        search.create_filter(self.instance, filterstr, search.DEFAULT_MAPPING)
+
+        set_attr_on_json_field(
+            self.instance, 'config.value_display.plot.width.units', 'ft')
+        search.create_filter(self.instance, filterstr, search.DEFAULT_MAPPING)
+
+        self.assertEqual(2, search.filter_cache_stats()['misses'])
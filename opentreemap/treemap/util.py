@@ -4,13 +4,14 @@ from __future__ import unicode_literals
 from __future__ import division
 
 import datetime
+import itertools
 from collections import OrderedDict
 
 from urlparse import urlparse
 
 from django.apps import apps
 from django.shortcuts import get_object_or_404, resolve_url
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils.encoding import force_str
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.conf import settings
@@ -204,6 +205,23 @@ def get_json_response(filename):
     return response
 
 
+def get_streaming_csv_response(filename, chunks):
+    # add BOM to support CSVs in MS Excel, as in `get_csv_response`
+    chunks = itertools.chain([u'\ufeff'.encode('utf8')], chunks)
+    return _get_streaming_response(filename, 'text/csv', chunks)
+
+
+def get_streaming_json_response(filename, chunks):
+    return _get_streaming_response(filename, 'application/json', chunks)
+
+
+def _get_streaming_response(filename, content_type, chunks):
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename=%s;' % filename
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
 def can_read_as_super_admin(request):
     if not hasattr(request.user, 'is_super_admin'):
         return False